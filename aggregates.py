@@ -0,0 +1,226 @@
+# Map aggregates (mean/median/min/max per state) answered from the rollup tables.
+# The daily and monthly rollups (data1050/migrations/002_rollups.sql) hold count/sum/min/max
+# and a quantile sketch per state and day/month. A requested date range is split into whole
+# months, whole days at either end of those months and the raw hours at the very edges; each
+# part is read from the coarsest table that covers it and the pieces are merged per state.
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from database import query_database
+from metrics import stage
+
+# Width of the sketch bins in ug/m3 (must match refresh_airquality_rollups in 002_rollups.sql)
+SKETCH_BIN_WIDTH = 0.5
+SKETCH_MAX_BIN = 2000
+
+AGGREGATES = ('mean', 'median', 'min', 'max')
+
+# Histogram bin width per particulate in ug/m3 (index points for aqi), a multiple of
+# SKETCH_BIN_WIDTH so the sketch bins regroup exactly; the same edges are used for every state and
+# date range
+HIST_BIN_WIDTH = {'pm25': 1.0, 'pm10': 2.0, 'aqi': 5.0}
+
+
+def _to_datetime(value):
+    # the date picker sends 'YYYY-MM-DD' (or a full ISO timestamp)
+    return datetime.fromisoformat(str(value)[:10])
+
+
+def _floor_day(ts):
+    return datetime(ts.year, ts.month, ts.day)
+
+
+def _ceil_day(ts):
+    floor = _floor_day(ts)
+    return floor if floor == ts else floor + timedelta(days=1)
+
+
+def _ceil_month(day):
+    floor = datetime(day.year, day.month, 1)
+    if floor == day:
+        return floor
+    return datetime(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def _floor_month(day):
+    return datetime(day.year, day.month, 1)
+
+
+def plan_ranges(start_date, end_date):
+    """
+    Split the dashboard's date range (BETWEEN start_date AND end_date, i.e. every hour from
+    start_date 00:00 up to and including end_date 00:00) into the parts answered by each table.
+
+    :param start_date: (str) first day of the range
+    :param end_date: (str) last day of the range
+    :return plan: (dict) 'months': [start, end) of whole months, 'days': list of [start, end) day ranges,
+        'hours': list of [start, end] raw hour ranges (inclusive); empty ranges are left out
+    """
+    lo = _to_datetime(start_date)
+    hi = _to_datetime(end_date)
+    plan = {'months': None, 'days': [], 'hours': []}
+    if hi < lo:
+        return plan
+
+    # whole days are the ones whose 24 hours all fall inside [lo, hi]
+    first_day = _ceil_day(lo)
+    last_day = _floor_day(hi + timedelta(hours=1))  # exclusive
+    if first_day >= last_day:
+        plan['hours'].append((lo, hi))
+        return plan
+
+    first_month = _ceil_month(first_day)
+    last_month = _floor_month(last_day)
+    if first_month < last_month:
+        plan['months'] = (first_month, last_month)
+        day_ranges = [(first_day, first_month), (last_month, last_day)]
+    else:
+        day_ranges = [(first_day, last_day)]
+    plan['days'] = [(start, end) for start, end in day_ranges if start < end]
+
+    if lo < first_day:
+        plan['hours'].append((lo, first_day - timedelta(hours=1)))
+    if last_day <= hi:
+        plan['hours'].append((last_day, hi))
+    return plan
+
+
+def build_summary_query(plan, particulate):
+    """
+    :param plan: (dict) output of plan_ranges
+    :param particulate: (str) 'pm25', 'pm10' or 'aqi' (also used as a column name for the raw edge hours)
+    :return query, params: (str, dict) query returning one merged row per state:
+        state, n, total, min, max, sketch_bins, sketch_counts
+    """
+    pieces = []
+    params = {'particulate': particulate, 'bin_width': SKETCH_BIN_WIDTH, 'max_bin': SKETCH_MAX_BIN}
+    rollup_columns = 'state, n, total, min, max, sketch_bins, sketch_counts'
+    if plan['months'] is not None:
+        pieces.append(f"""SELECT {rollup_columns} FROM airquality_monthly
+        WHERE particulate = %(particulate)s AND state IN %(state)s AND month >= %(month_start)s AND month < %(month_end)s""")
+        params['month_start'], params['month_end'] = plan['months']
+    for i, (start, end) in enumerate(plan['days']):
+        pieces.append(f"""SELECT {rollup_columns} FROM airquality_daily
+        WHERE particulate = %(particulate)s AND state IN %(state)s AND day >= %(day_start_{i})s AND day < %(day_end_{i})s""")
+        params[f'day_start_{i}'], params[f'day_end_{i}'] = start, end
+    for i, (start, end) in enumerate(plan['hours']):
+        # raw hours at the range edges: each row becomes a one-value sketch
+        pieces.append(f"""SELECT state, count(*), sum({particulate}), min({particulate}), max({particulate}),
+            array_agg(LEAST(GREATEST(CAST(floor({particulate} / %(bin_width)s) AS int), 0), %(max_bin)s)),
+            array_agg(1)
+        FROM airquality
+        WHERE state IN %(state)s AND year BETWEEN %(hour_year_start_{i})s AND %(hour_year_end_{i})s
+        AND timestamp BETWEEN %(hour_start_{i})s AND %(hour_end_{i})s
+        AND {particulate} IS NOT NULL AND {particulate} <> 'NaN'
+        GROUP BY state""")
+        params[f'hour_start_{i}'], params[f'hour_end_{i}'] = start, end
+        params[f'hour_year_start_{i}'], params[f'hour_year_end_{i}'] = start.year, end.year  # partition pruning
+
+    union = '\n        UNION ALL\n        '
+    query = f"""WITH pieces ({rollup_columns}) AS (
+        {union.join(pieces)}
+    ), stats AS (
+        SELECT state, sum(n) AS n, sum(total) AS total, min(min) AS min, max(max) AS max
+        FROM pieces GROUP BY state
+    ), sketch AS (
+        SELECT state, u.bin, sum(u.n) AS n
+        FROM pieces, unnest(sketch_bins, sketch_counts) AS u(bin, n)
+        GROUP BY state, u.bin
+    )
+    SELECT s.state, s.n, s.total, s.min, s.max, array_agg(k.bin ORDER BY k.bin), array_agg(k.n ORDER BY k.bin)
+    FROM stats s JOIN sketch k USING (state)
+    GROUP BY s.state, s.n, s.total, s.min, s.max"""
+    return query, params
+
+
+def sketch_quantile(bins, counts, q, lower=None, upper=None):
+    """
+    :param bins: (array) sketch bin indices, ascending
+    :param counts: (array) number of values in each bin
+    :param q: (float) quantile in [0, 1]
+    :param lower: (float) exact minimum of the values, used to clamp the estimate
+    :param upper: (float) exact maximum of the values, used to clamp the estimate
+    :return value: (float) estimated quantile, interpolated linearly inside its bin
+    """
+    bins = np.asarray(bins, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    total = counts.sum()
+    if total == 0:
+        return np.nan
+    cumulative = np.cumsum(counts)
+    target = q * total
+    i = min(int(np.searchsorted(cumulative, target)), len(bins) - 1)
+    before = cumulative[i] - counts[i]
+    value = (bins[i] + (target - before) / counts[i]) * SKETCH_BIN_WIDTH
+    if lower is not None:
+        value = max(value, lower)
+    if upper is not None:
+        value = min(value, upper)
+    return value
+
+
+def summarize(rows):
+    """
+    :param rows: (list) rows returned by the summary query
+    :return df: (dataframe) one row per state with n, mean, median, min and max, and the merged
+        sketch (sketch_bins, sketch_counts) for histograms
+    """
+    records = []
+    for state, n, total, lower, upper, bins, counts in rows:
+        n = int(n)  # sum() over bigint counts comes back as a Decimal
+        records.append({
+            'state': state,
+            'n': n,
+            'mean': float(total) / n,
+            'median': sketch_quantile(bins, counts, 0.5, lower, upper),
+            'min': float(lower),
+            'max': float(upper),
+            'sketch_bins': np.asarray(bins, dtype=int),
+            'sketch_counts': np.asarray(counts, dtype=int),
+        })
+    return pd.DataFrame(records, columns=['state', 'n'] + list(AGGREGATES) + ['sketch_bins', 'sketch_counts'])
+
+
+def histogram(summary, particulate, combine=False):
+    """
+    :param summary: (dataframe) output of state_summary
+    :param particulate: (str) 'pm25', 'pm10' or 'aqi'
+    :param combine: (bool) add up all states into a single histogram
+    :return df: (dataframe) non-empty bins: state (None when combined), bin (left edge), count
+    """
+    width = HIST_BIN_WIDTH[particulate]
+    per_bin = int(round(width / SKETCH_BIN_WIDTH))
+    frames = []
+    for state, bins, counts in zip(summary['state'], summary['sketch_bins'], summary['sketch_counts']):
+        if len(bins) == 0:
+            continue
+        hist_bins, index = np.unique(bins // per_bin, return_inverse=True)
+        frames.append(pd.DataFrame({'state': state, 'bin': hist_bins * width,
+                                    'count': np.bincount(index, weights=counts).astype(int)}))
+    if not frames:
+        return pd.DataFrame(columns=['state', 'bin', 'count'])
+    df = pd.concat(frames, ignore_index=True)
+    if combine:
+        df = df.groupby('bin', as_index=False)['count'].sum()
+        df.insert(0, 'state', None)
+    return df
+
+
+def state_summary(state, start_date, end_date, particulate):
+    """
+    :param state: (tuple) states to aggregate
+    :param start_date: (str) first day of the range
+    :param end_date: (str) last day of the range
+    :param particulate: (str) 'pm25', 'pm10' or 'aqi'
+    :return df: (dataframe) per state n, mean, median, min and max over the range
+    """
+    plan = plan_ranges(start_date, end_date)
+    if plan['months'] is None and not plan['days'] and not plan['hours']:
+        return summarize([])
+    query, params = build_summary_query(plan, particulate)
+    params['state'] = tuple(state)
+    rows = query_database(query, params)
+    with stage('summarize'):
+        return summarize(rows)
@@ -1,13 +1,29 @@
+import time
+_import_start = time.perf_counter()  # reported as airquality_startup_import_seconds on /metrics
 import dash
 from datetime import date
 import pandas as pd
-import psycopg2 as psycopg2
 from dash import dcc
 from dash import html
 from dash.dependencies import Input, Output, State
-import plotly.express as px
-import json
-import time
+from dash.exceptions import PreventUpdate
+import gzip
+import io
+import os
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, jsonify, request, send_file, stream_with_context
+from database import pool_stats
+from metrics import annotate, stage, timed
+import metrics
+import snapshot
+from aggregates import AGGREGATES, HIST_BIN_WIDTH, histogram
+from cache import cache_key, cache_settings, result_cache, seconds_until_next_ingest
+from storage import PARTICULATES, storage
+from downsample import downsample
+from geo import URL_PREFIX, load_variants, variant_for_zoom
 
 # Setting dictionary (fonts, colors, etc.)
 settings = {
@@ -17,6 +33,15 @@ settings = {
     'background-2': '#e7e7de',
     'company': '#2dcf11',
     'map_zoom': 3.25,
+    'line_buckets': 600,  # min/max buckets per line series, about the chart width in pixels
+    # run the line chart's query as a Dash long callback in a separate process, so it does not hold a
+    # gunicorn worker (requires diskcache, multiprocess and psutil); off by default, as the process
+    # start and the once a second polling make every click at least a second slower (see README)
+    'background_callbacks': os.environ.get('BACKGROUND_CALLBACKS', '0') == '1',
+    'callback_cache_dir': os.environ.get('CALLBACK_CACHE_DIR',
+                                         os.path.join(tempfile.gettempdir(), 'airquality-callbacks')),
+    # longest date range /export serves in one request (the rows are loaded into the worker)
+    'export_max_days': int(os.environ.get('EXPORT_MAX_DAYS', 366)),
     'font-family': 'Open Sans, sans-serif'
 }
 
@@ -29,6 +54,30 @@ app = dash.Dash(
 )
 application = app.server
 
+
+# Connection pool metrics (wait and checkout times) for this worker
+@application.route('/pool-stats')
+def pool_stats_route():
+    return jsonify(pool_stats())
+
+
+# Result cache hit/miss counters for this worker
+@application.route('/cache-stats')
+def cache_stats_route():
+    return jsonify(result_cache.stats())
+
+
+# Seconds this module took to import, and whether the worker was forked from a preloaded master
+# (set by gunicorn.conf.py)
+startup_stats = {'import_seconds': 0.0, 'preloaded': 0}
+
+# Per stage request timings of this worker in the Prometheus format on /metrics (see metrics.py),
+# with its memory and startup time
+metrics.init_app(application, collectors=[('airquality_pool', pool_stats), ('airquality_cache', result_cache.stats),
+                                          ('airquality_process', metrics.process_memory),
+                                          ('airquality_startup', startup_stats.copy)])
+
+
 # State dictionary (for later)
 states = {'Alabama': 'AL', 'Alaska': 'AK', 'Arizona': 'AZ', 'Arkansas': 'AR', 'California': 'CA', 'Colorado': 'CO',
           'Connecticut': 'CT', 'Delaware': 'DE', 'Florida': 'FL', 'Georgia': 'GA', 'Hawaii': 'HI', 'Idaho': 'ID',
@@ -42,46 +91,44 @@ states = {'Alabama': 'AL', 'Alaska': 'AK', 'Arizona': 'AZ', 'Arkansas': 'AR', 'C
           'Wisconsin': 'WI', 'Wyoming': 'WY'}
 states_query = tuple(states.keys())
 
+# Axis and legend labels of the particulate dropdown values
+PARTICULATE_LABELS = {'pm25': 'PM2.5', 'pm10': 'PM10', 'aqi': 'AQI'}
 
-# --- Functions to build graphics ---
+# State geometries, simplified per zoom range and served once to the browser (see geo.py); built
+# once per host, and shared by the workers when gunicorn preloads the app
+geojson_variants = load_variants(states_query)
+geojson_by_url = {variant['url']: variant for variant in geojson_variants}
 
-def query_database(query):
-    """
-    :param query: (str) query to send to airquality database
-    :return rows: (list of lists) all rows returned from sql query
-    """
-    rds_host = "airquality.ce6w097amgsa.us-west-1.rds.amazonaws.com"
-    # name = "" # these values are hidden for public repo for
-    # password = "" # more information on connecting to the
-    # db_name = "" # database, contact me directly!
-    name = "postgres"
-    password = "L2PnKR!&M2eGL5"
-    db_name = "postgres"
 
-    conn = psycopg2.connect(host=rds_host,
-                            database=db_name,
-                            user=name,
-                            password=password)
-    cur = conn.cursor()
-    cur.execute(query)
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+# Cacheable state geometries referenced by URL from the map figures
+@application.route('/geojson/<name>')
+def geojson_route(name):
+    variant = geojson_by_url.get(URL_PREFIX + name)
+    if variant is None:
+        return Response(status=404)
+    headers = {'Cache-Control': 'public, max-age=31536000, immutable', 'ETag': variant['etag'],
+               'Vary': 'Accept-Encoding'}
+    if request.headers.get('If-None-Match') == variant['etag']:
+        return Response(status=304, headers=headers)
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        return Response(variant['gzip'], mimetype='application/geo+json', headers=headers)
+    return Response(gzip.decompress(variant['gzip']), mimetype='application/geo+json', headers=headers)
 
-    return rows
 
+# --- Functions to build graphics ---
 
+@timed('build_map')
 def build_map(data, particulate_val):
     """
     :param data: (dataframe) Data to be plotted
-    :param particulate_val: (str) Value for particulate matter (pm25 or pm10)
-    :return fig: (figure) plotly mapbox figure
+    :param particulate_val: (str) Value for particulate matter (pm25, pm10 or aqi)
+    :return fig: (figure) plotly mapbox figure (the geometries are referenced by URL, see geo.py)
     """
-    with open(r'static/gz_2010_us_040_00_5m.json') as fp:
-        geojson = json.load(fp)
-    particulate_val_formatted = 'PM2.5' if particulate_val == 'pm25' else 'PM10'
-    fig = px.choropleth_mapbox(data, geojson=geojson,
-                               featureidkey="properties.NAME", locations='state', color=particulate_val,
+    import plotly.express as px  # imported on first use (or by warm_up), see gunicorn.conf.py
+    particulate_val_formatted = PARTICULATE_LABELS[particulate_val]
+    fig = px.choropleth_mapbox(data, geojson=variant_for_zoom(geojson_variants, 3)['url'],
+                               locations='state', color=particulate_val,
                                color_continuous_scale="RdYlGn_r",
                                mapbox_style="open-street-map",
                                zoom=3, center={"lat": 37.0902, "lon": -95.7129},
@@ -90,22 +137,35 @@ def build_map(data, particulate_val):
                                template='seaborn'
                                )
     fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0},
-                      paper_bgcolor='#aad3df')
+                      paper_bgcolor='#aad3df',
+                      uirevision='map')  # keep the user's pan/zoom across filter changes
     return fig
 
 
-def build_line(data, state, particulate):
+@timed('build_line')
+def build_line(data, state, particulate, window=None):
     """
     :param data: (dataframe) Data to be plotted
     :param state: (tuple) states to be plotted
-    :param particulate: (str) Value for particulate matter (pm25 or pm10)
+    :param particulate: (str) Value for particulate matter (pm25, pm10 or aqi)
+    :param window: (tuple) visible (start, end) timestamps to plot, None for all of the data
     :return fig: (figure) plotly mapbox figure
     """
+    import plotly.express as px
+    if window is not None:
+        data = data[(data['timestamp'] >= window[0]) & (data['timestamp'] <= window[1])]
+
+    # each series is reduced to about the chart width, keeping the peaks and dips (see downsample.py)
     if len(state) >= 50:
-        data = data.groupby('timestamp', as_index=False).mean()
+        with stage('groupby'):
+            data = data.groupby('timestamp', as_index=False)[particulate].mean()
+        with stage('downsample'):
+            data = downsample(data, particulate, settings['line_buckets'])
         fig = px.line(data, x='timestamp', y=particulate, template='seaborn')
     else:
-        data = data.sort_values(by='timestamp')
+        with stage('downsample'):
+            data = data.sort_values(by=['state', 'timestamp'], kind='stable')
+            data = downsample(data, particulate, settings['line_buckets'], by='state')
         fig = px.line(data, x='timestamp', y=particulate, color='state', template='seaborn')
 
     fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0},
@@ -121,17 +181,27 @@ def build_line(data, state, particulate):
     return fig
 
 
-def build_hist(data, state, particulate):
+@timed('build_hist')
+def build_hist(summary, state, particulate):
     """
-    :param data: (dataframe) Data to be plotted
+    :param summary: (dataframe) per state summary with the merged sketches (see aggregates.state_summary)
     :param state: (tuple) states to be plotted
-    :param particulate: (str) Value for particulate matter (pm25 or pm10)
+    :param particulate: (str) Value for particulate matter (pm25, pm10 or aqi)
     :return fig: (figure) plotly mapbox figure
     """
+    import plotly.express as px
+    # bins are counted on the server (from the rollup sketches), only edges and counts are sent
+    width = HIST_BIN_WIDTH[particulate]
     if len(state) >= 50:
-        fig = px.histogram(data, x=particulate, template='seaborn')
+        data = histogram(summary, particulate, combine=True)
+        data[particulate] = data['bin'] + width / 2
+        fig = px.bar(data, x=particulate, y='count', template='seaborn')
     else:
-        fig = px.histogram(data, x=particulate, color='state', template='seaborn', opacity=0.80)
+        data = histogram(summary, particulate)
+        data[particulate] = data['bin'] + width / 2
+        fig = px.bar(data, x=particulate, y='count', color='state', template='seaborn', opacity=0.80)
+    fig.update_traces(width=width)
+    fig.update_layout(bargap=0)
     fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0},
                       paper_bgcolor=settings['background-2'],
                       plot_bgcolor=settings['background-2'],
@@ -145,15 +215,132 @@ def build_hist(data, state, particulate):
     return fig
 
 
+def data_hours(refresh=False):
+    """
+    :param refresh: (bool) read from storage even if the hours are cached
+    :return first, last: (datetime) first and last hour with data, or None if it cannot be determined
+    """
+    # from the storage partitions, cached briefly: the newest hour is the data version the other
+    # cache keys carry, so it has to notice a Lambda run that finished late
+    key = cache_key('data_hours')
+    hours = None if refresh else result_cache.get(key)
+    if hours is None:
+        try:
+            hours = storage.date_bounds()
+        except Exception as exc:
+            print('Could not read the date bounds:', repr(exc))
+            return None
+        if hours is not None:
+            result_cache.set(key, hours, min(cache_settings['version_ttl'], seconds_until_next_ingest()))
+    return hours
+
+
+def date_bounds():
+    """
+    :return first_day, last_day: (date) first and last day with data (2021 if it cannot be determined)
+    """
+    hours = data_hours()
+    if hours is None:
+        return date(2021, 1, 1), date(2021, 12, 31)
+    return hours[0].date(), hours[1].date()
+
+
+def data_version():
+    """
+    :return version: (str) newest hour in storage, which changes with every ingest (None if unknown)
+    """
+    hours = data_hours()
+    return None if hours is None else hours[1].isoformat()
+
+
+def normalize_filters(start_date, end_date, particulate, state, aggregate_fxn):
+    """
+    :param start_date: (str) first day of the date picker range
+    :param end_date: (str) last day of the date picker range
+    :param particulate: (str) Value for particulate matter (pm25, pm10 or aqi)
+    :param state: (list) selected states (None or empty for all states)
+    :param aggregate_fxn: (str) aggregate for the map
+    :return start_date, end_date, particulate, state, aggregate_fxn: filters with defaults applied
+        (dates as 'YYYY-MM-DD', states as a tuple)
+    """
+    # if there hasn't been any specification for states, show data from all states
+    if state in (None, '') or len(state) == 0:
+        state = states_query
+    else:
+        state = tuple(state)
+
+    # set default values (the latest year in the data, as in the date picker)
+    if not start_date or not end_date:
+        first_day, last_day = date_bounds()
+        start_date = start_date or max(first_day, date(last_day.year, 1, 1))
+        end_date = end_date or last_day
+    start_date = str(start_date)[:10]
+    end_date = str(end_date)[:10]
+
+    if particulate not in PARTICULATES:  # also keeps the column name safe to format into the query
+        particulate = 'pm25'
+
+    if aggregate_fxn not in AGGREGATES:
+        aggregate_fxn = 'median'
+
+    return start_date, end_date, particulate, state, aggregate_fxn
+
+
+def filter_key(start_date, end_date, particulate, state, aggregate_fxn):
+    """
+    :return key: (str) result cache key of apply_filter for normalized filters and the current data
+    """
+    return cache_key('apply_filter', start_date, end_date, particulate, tuple(sorted(state)), aggregate_fxn,
+                     data_version())
+
+
+def default_view():
+    """
+    :return outputs: (dict) figures and stores of the landing page from the snapshot (see snapshot.py),
+        by component id, or None when the snapshot is missing or stale
+    """
+    # the filters the page opens with (the dropdown defaults are normalize_filters' defaults)
+    key = filter_key(*normalize_filters(None, None, None, None, None))
+    version = data_version()
+    outputs = snapshot.lookup('apply_filter', key, version)
+    if outputs is None:
+        return None
+    handle, figure, columns = outputs
+    return {
+        # marked, so that the callbacks fired by the page load leave the embedded figures alone
+        'data-store': dict(handle, initial=True),
+        'map-figure': figure,
+        'map-summary': columns,
+        'quality-line': snapshot.lookup('update_line', cache_key('update_line', key, None), version),
+        'quality-hist': snapshot.lookup('update_hist', cache_key('update_hist', key), version),
+    }
+
+
+def figure_prop(figure):
+    # dcc.Graph keeps its empty default figure unless one is given
+    return {} if figure is None else {'figure': figure}
+
+
 # --- Configure Layout ---
-app.layout = \
-    html.Div(
+# built for every page load, so the date picker follows the data as it grows
+def serve_layout(view=None, bounds=None):
+    """
+    :param view: (dict) outputs of the default view (default: from the snapshot, if it is current)
+    :param bounds: (tuple) first and last day of the date picker (default: from storage)
+    :return layout: (Div) the page
+    """
+    first_day, last_day = bounds or date_bounds()
+    # the default view is embedded when a current snapshot exists, so the first render needs no query
+    if view is None:
+        view = default_view() or {}
+    return html.Div(
         id='whole-container',
         style={
             'background-color': settings['background'],
         },
         children=[
-            dcc.Store(id='data-store'),
+            dcc.Store(id='data-store', data=view.get('data-store')),
+            dcc.Store(id='line-window'),
             # Div for the entire container (background div)
             html.Div(
                 style={
@@ -204,9 +391,9 @@ app.layout = \
                                             html.P("""Change the fields below and click \"Apply Filters\" to 
                                             update the map and figure(s) to the right. The purpose of this dashboard
                                             is to help visualize the quality of air throughout the US. Users can 
-                                            choose to view air quality (PM 2.5 & PM 10) at different locations during
-                                            2021. Air quality data is updated twice per day. 
-                                            """,
+                                            choose to view air quality (PM 2.5 & PM 10) at different locations between
+                                            {first_day.year} and {last_day.year}. Air quality data is updated twice per day. 
+                                            """.format(first_day=first_day, last_day=last_day),
                                                    style={
                                                        'color': settings['text'],
                                                        'margin-bottom': '0px',
@@ -240,11 +427,11 @@ app.layout = \
                                                    }),
                                             dcc.DatePickerRange(
                                                 id='date-picker',
-                                                start_date=date(2021, 1, 1),
-                                                min_date_allowed=date(2021, 1, 1),
-                                                max_date_allowed=date(2021, 12, 31),
-                                                initial_visible_month=date(2021, 12, 31),
-                                                end_date=date(2021, 12, 31),
+                                                start_date=max(first_day, date(last_day.year, 1, 1)),
+                                                min_date_allowed=first_day,
+                                                max_date_allowed=last_day,
+                                                initial_visible_month=last_day,
+                                                end_date=last_day,
                                                 className='DateRangePickerInput',
                                             ),
                                         ],
@@ -280,6 +467,7 @@ app.layout = \
                                                 options=[
                                                     {'label': 'PM 2.5', 'value': 'pm25'},
                                                     {'label': 'PM 10', 'value': 'pm10'},
+                                                    {'label': 'AQI', 'value': 'aqi'},
                                                 ],
                                                 value='pm25'
                                             ),
@@ -316,7 +504,17 @@ app.layout = \
                                                             'width': '100%',
                                                             'border': '1px solid ' + settings['text']
                                                         }),
-                                            dcc.Download(id='apply')
+                                            dcc.Download(id='apply'),
+                                            html.A('Download filtered data (CSV)',
+                                                   id='export-link',
+                                                   href='/export',
+                                                   style={
+                                                       'display': 'block',
+                                                       'margin-top': '10px',
+                                                       'color': settings['text'],
+                                                       'font-size': '13px',
+                                                       'text-align': 'center'
+                                                   }),
                                         ],
                                     ),
 
@@ -392,6 +590,11 @@ app.layout = \
                                                 id='map',
                                                 className='chart-graph',
                                             ),
+                                            dcc.Store(id='map-figure', data=view.get('map-figure')),
+                                            dcc.Store(id='map-summary', data=view.get('map-summary')),
+                                            dcc.Store(id='map-geojson',
+                                                      data=[[variant['min_zoom'], variant['url']]
+                                                            for variant in geojson_variants]),
                                         ],
                                     ),
                                     # Div for graphs below
@@ -403,8 +606,10 @@ app.layout = \
                                         },
                                         children=[
                                             dcc.Tabs(id='tabs',
+                                                     value='line',
                                                      children=[
                                                          dcc.Tab(label='Air Quality vs Time',
+                                                                 value='line',
                                                                  style={
                                                                      'background-color': settings['background'],
                                                                      'border': '3px ' + settings[
@@ -416,15 +621,26 @@ app.layout = \
                                                                  className='custom-tab',
                                                                  selected_className='custom-tab--selected',
                                                                  children=[
-                                                                     dcc.Graph(
-                                                                         id='quality-line',
-                                                                         style={
-                                                                             'height': '300px'
-                                                                         }
-                                                                     )
+                                                                     dcc.Loading(
+                                                                         type='circle',
+                                                                         color=settings['accent'],
+                                                                         children=dcc.Graph(
+                                                                             id='quality-line',
+                                                                             style={
+                                                                                 'height': '300px'
+                                                                             },
+                                                                             **figure_prop(view.get('quality-line'))
+                                                                         ),
+                                                                     ),
+                                                                     html.Div(id='line-progress',
+                                                                              style={
+                                                                                  'color': settings['text'],
+                                                                                  'font-size': '12px'
+                                                                              }),
                                                                  ],
                                                                  ),
                                                          dcc.Tab(label='Air Quality Histogram',
+                                                                 value='hist',
                                                                  style={
                                                                      'background-color': settings['background'],
                                                                      'border': '3px ' + settings[
@@ -436,11 +652,16 @@ app.layout = \
                                                                  className='custom-tab',
                                                                  selected_className='custom-tab--selected',
                                                                  children=[
-                                                                     dcc.Graph(
-                                                                         id='quality-hist',
-                                                                         style={
-                                                                             'height': '300px'
-                                                                         }
+                                                                     dcc.Loading(
+                                                                         type='circle',
+                                                                         color=settings['accent'],
+                                                                         children=dcc.Graph(
+                                                                             id='quality-hist',
+                                                                             style={
+                                                                                 'height': '300px'
+                                                                             },
+                                                                             **figure_prop(view.get('quality-hist'))
+                                                                         ),
                                                                      ),
                                                                  ])
                                                      ]
@@ -457,77 +678,446 @@ app.layout = \
     )
 
 
-# Callback for updating the map and histogram
+# Dash validates a layout function by calling it when it is set; given a validation layout (the
+# same components, without data) it does not, so importing the app runs no query
+app.validation_layout = serve_layout(view={}, bounds=(date(2021, 1, 1), date(2021, 12, 31)))
+app.layout = serve_layout
+
+
+def timed_query(name, fn, *args):
+    """
+    :param name: (str) label of the query in the log
+    :param fn: (function) query to run
+    :return result: fn(*args)
+    """
+    # reported on /metrics as the query_<name> stage (slow requests log it with their other stages)
+    with stage(f'query_{name}'):
+        return fn(*args)
+
+
+def load_data(state, start_date, end_date, particulate):
+    """
+    :param state: (tuple) states to load
+    :param start_date: (str) first day of the range
+    :param end_date: (str) last day of the range
+    :param particulate: (str) Value for particulate matter (pm25, pm10 or aqi)
+    :return df: (dataframe) state, timestamp and particulate value of every hour in the range
+    """
+    # PostgreSQL or local Arrow files, see storage.py
+    return timed_query('rows', storage.load, state, start_date, end_date, particulate)
+
+
+# Hourly rows being loaded in the background for the line chart (load_data key -> future)
+_loading = {}
+_loading_lock = threading.Lock()
+_executor = None
+
+
+def _load_executor():
+    # created on first use, so no thread exists before gunicorn forks its workers
+    global _executor
+    with _loading_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='rows')
+        return _executor
+
+
+def _load_and_cache(key, state, start_date, end_date, particulate):
+    try:
+        df = load_data(state, start_date, end_date, particulate)
+        result_cache.set(key, df)
+        return df
+    finally:
+        with _loading_lock:
+            _loading.pop(key, None)
+
+
+def prefetch_data(state, start_date, end_date, particulate):
+    """
+    Start loading the hourly rows in the background (unless they are cached or already loading).
+    :return future: (Future) resolves to the load_data result, or None if the rows are cached
+    """
+    key = cache_key('load_data', start_date, end_date, particulate, tuple(sorted(state)), data_version())
+    with _loading_lock:
+        future = _loading.get(key)
+    if future is not None:
+        return future
+    if result_cache.get(key) is not None:
+        return None
+    executor = _load_executor()
+    with _loading_lock:
+        future = _loading.get(key)
+        if future is None:
+            future = _loading[key] = executor.submit(_load_and_cache, key, state, start_date, end_date, particulate)
+    return future
+
+
+def cached_data(state, start_date, end_date, particulate):
+    """
+    :return df: (dataframe) load_data result, kept in the result cache for the line chart and exports
+    """
+    key = cache_key('load_data', start_date, end_date, particulate, tuple(sorted(state)), data_version())
+    with _loading_lock:
+        future = _loading.get(key)
+    if future is not None:
+        # started by apply_filter alongside the summary query
+        return future.result()
+    df = result_cache.get(key)
+    if df is None:
+        df = load_data(state, start_date, end_date, particulate)
+        result_cache.set(key, df)
+    return df
+
+
+def cached_summary(state, start_date, end_date, particulate):
+    """
+    :return df: (dataframe) storage.summary result, kept in the result cache for the map and histogram
+    """
+    key = cache_key('summary', start_date, end_date, particulate, tuple(sorted(state)), data_version())
+    summary = result_cache.get(key)
+    if summary is None:
+        # Per state aggregates and sketches, one GROUP BY state query over the daily/monthly rollups
+        summary = timed_query('summary', storage.summary, state, start_date, end_date, particulate)
+        result_cache.set(key, summary)
+    return summary
+
+
+def summary_columns(summary, particulate):
+    """
+    :param summary: (dataframe) per state summary (see aggregates.state_summary)
+    :param particulate: (str) Value for particulate matter (pm25, pm10 or aqi)
+    :return columns: (dict) state list and one list per aggregate, for recoloring the map in the browser
+    """
+    columns = {'particulate': particulate, 'state': summary['state'].tolist(), 'n': summary['n'].tolist()}
+    for aggregate in AGGREGATES:
+        columns[aggregate] = [round(float(value), 3) for value in summary[aggregate]]
+    return columns
+
+
+# Callback for updating the map (the line chart and histogram follow from data-store)
 @app.callback(
     [Output('data-store', 'data'),
-     Output('map', 'figure'),
-     Output('quality-line', 'figure'),
-     Output('quality-hist', 'figure')],  # output
+     Output('map-figure', 'data'),
+     Output('map-summary', 'data')],  # output
     [Input('apply-filters-button', 'n_clicks')],  # input
     [State('date-picker', 'start_date'),
      State('date-picker', 'end_date'),
      State('particulate-dropdown', 'value'),
      State('state-dropdown', 'value'),
-     State('aggregate-function', 'value'), ]  # state
+     State('aggregate-function', 'value'),
+     State('data-store', 'data'), ]  # state
 )
-def apply_filter(n_clicks, start_date, end_date, particulate, state, aggregate_fxn):
-    # if there hasn't been any specification for states, show data from all states
-    if state in (None, '') or len(state) == 0:
-        state = (
-            'Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado', 'Connecticut', 'Delaware', 'Florida',
-            'Georgia', 'Hawaii', 'Idaho', 'Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky', 'Louisiana', 'Maine',
-            'Maryland', 'Massachusetts', 'Michigan', 'Minnesota', 'Mississippi', 'Missouri', 'Montana', 'Nebraska',
-            'Nevada', 'New_Hampshire', 'New_Jersey', 'New_Mexico', 'New_York', 'North_Carolina', 'North_Dakota', 'Ohio',
-            'Oklahoma', 'Oregon', 'Pennsylvania', 'Rhode_Island', 'South_Carolina', 'South_Dakota', 'Tennessee',
-            'Texas', 'Utah', 'Vermont', 'Virginia', 'Washington', 'West_Virginia', 'Wisconsin', 'Wyoming')
+@timed('apply_filter', callback=True)
+def apply_filter(n_clicks, start_date, end_date, particulate, state, aggregate_fxn, current=None):
+    if n_clicks is None and current and current.get('initial'):
+        # the page was served with the default view from the snapshot
+        raise PreventUpdate
+    start_date, end_date, particulate, state, aggregate_fxn = normalize_filters(start_date, end_date, particulate,
+                                                                                state, aggregate_fxn)
+    annotate(start_date=start_date, end_date=end_date, particulate=particulate, aggregate=aggregate_fxn,
+             states=list(state) if len(state) < len(states_query) else 'all')
 
-    else:
-        if len(state) > 1:
-            state = tuple(state)
-        else:
-            # if tuple of size 1, format for query
-            state = "(\'" + str(state[0]) + "\')"
-
-    # set default values
-    if particulate in (None, ''):
-        particulate = 'pm25'
+    # identical filter combinations are served from the cache until new data lands (the key holds
+    # the data version), and the default view from the snapshot built after it
+    key = filter_key(start_date, end_date, particulate, state, aggregate_fxn)
+    cached = result_cache.get(key)
+    if cached is not None and 'summary' in cached:
+        return [cached['handle'], cached['map'], cached['summary']]
+    outputs = snapshot.lookup('apply_filter', key, data_version())
+    if outputs is not None:
+        return outputs
 
-    if aggregate_fxn in (None, ''):
-        aggregate_fxn = 'median'
+    # the line chart's hourly rows load on another connection while the summary query runs
+    # (a background callback loads them in its own process instead)
+    if not settings['background_callbacks']:
+        prefetch_data(state, start_date, end_date, particulate)
 
-    # set query according to filters
-    query = f"""SELECT state, make_timestamp(CAST(year AS int), CAST(month AS int), CAST(day AS int), CAST(utc_hour AS int), 0, CAST(0.0 AS double precision)) AS timestamp, {particulate} FROM airquality
-    WHERE make_timestamp(CAST(year AS int), CAST(month AS int), CAST(day AS int), CAST(utc_hour AS int), 0, CAST(0.0 AS double precision))
-    BETWEEN CAST(\'{start_date}\' AS DATE) and CAST(\'{end_date}\' AS DATE)
-    AND state in {state};
-    """
-
-    # time query (personal/developer use)
-    start = time.time()
-    data = query_database(query)
-    finish = time.time()
-    print("Query Time:", finish - start)
-
-    # Convert data based on aggregate function specification
-    df = pd.DataFrame(data)
-    df.columns = ['state', 'timestamp', str(particulate)]
-    if aggregate_fxn in 'mean':
-        df_map = df.groupby('state', as_index=False).mean()
-    elif aggregate_fxn in 'median':
-        df_map = df.groupby('state', as_index=False).median()
-    elif aggregate_fxn in 'min':
-        df_map = df.groupby('state', as_index=False).min()
-    elif aggregate_fxn in 'max':
-        df_map = df.groupby('state', as_index=False).max()
-    else:
-        df_map = df.groupby('state', as_index=False).median()
+    summary = cached_summary(state, start_date, end_date, particulate)
+    df_map = summary[['state', aggregate_fxn]].rename(columns={aggregate_fxn: particulate})
 
     map = build_map(df_map, particulate)
-    line = build_line(df, state, particulate)
-    hist = build_hist(df, state, particulate)
 
-    return [data, map, line, hist]
+    # the browser only gets a handle on the data (the rows stay on the server, see /export)
+    handle = {'key': key, 'start_date': start_date, 'end_date': end_date, 'particulate': particulate,
+              'states': list(state) if len(state) < len(states_query) else None, 'aggregate': aggregate_fxn,
+              'values': int(summary['n'].sum())}
+    with stage('figure_to_dict'):
+        figure = map.to_dict()
+    # every aggregate per state, so changing the aggregate recolors the map without a request
+    columns = summary_columns(summary, particulate)
+    result_cache.set(key, {'handle': handle, 'map': figure, 'summary': columns})
+    return [handle, figure, columns]
+
+
+def relayout_window(relayout):
+    """
+    :param relayout: (dict) relayoutData of the line chart
+    :return window: (tuple) visible (start, end) timestamps, None for the full range, or False if the
+        event did not change the time axis
+    """
+    if not relayout:
+        return False
+    if relayout.get('xaxis.autorange'):
+        return None
+    if 'xaxis.range[0]' in relayout and 'xaxis.range[1]' in relayout:
+        return pd.Timestamp(relayout['xaxis.range[0]']), pd.Timestamp(relayout['xaxis.range[1]'])
+    if 'xaxis.range' in relayout:
+        return pd.Timestamp(relayout['xaxis.range'][0]), pd.Timestamp(relayout['xaxis.range'][1])
+    return False
+
+
+# Visible time window of the line chart, tagged with the filters it was zoomed under
+@app.callback(
+    Output('line-window', 'data'),
+    [Input('quality-line', 'relayoutData')],
+    [State('data-store', 'data')]
+)
+def update_line_window(relayout, handle):
+    window = relayout_window(relayout)
+    if window is False or not handle:
+        raise PreventUpdate
+    return {'key': handle['key'], 'window': None if window is None else [str(val) for val in window]}
+
+
+@timed('update_line', callback=True)
+def update_line(handle, line_window):
+    """
+    Line chart of the filtered data, redrawn at full resolution for the visible window on zoom.
+    :param handle: (dict) current filters (data-store)
+    :param line_window: (dict) visible window (line-window); ignored when it belongs to older filters
+    :return figure: (dict) line chart
+    """
+    if not handle or (handle.get('initial') and line_window is None):
+        # nothing to show yet, or the page was served with this chart
+        raise PreventUpdate
+
+    window = None
+    if line_window and line_window['key'] == handle['key'] and line_window['window']:
+        window = tuple(pd.Timestamp(val) for val in line_window['window'])
+    annotate(start_date=handle['start_date'], end_date=handle['end_date'], particulate=handle['particulate'],
+             states=handle['states'] or 'all', window=line_window['window'] if window else None)
+
+    key = cache_key('update_line', handle['key'], window)
+    cached = result_cache.get(key)
+    if cached is None and window is None:
+        cached = snapshot.lookup('update_line', key, data_version())
+    if cached is not None:
+        return cached
+
+    state = tuple(handle['states'] or states_query)
+    df = cached_data(state, handle['start_date'], handle['end_date'], handle['particulate'])
+
+    line = build_line(df, state, handle['particulate'], window)
+    # keep the user's zoom when the window is redrawn, reset it for new filters
+    line.update_layout(uirevision=handle['key'])
+    with stage('figure_to_dict'):
+        figure = line.to_dict()
+    result_cache.set(key, figure)
+    return figure
+
+
+def make_long_callback_manager():
+    """
+    :return manager: (DiskcacheLongCallbackManager) runs long callbacks in processes sharing
+        settings['callback_cache_dir']
+    """
+    import diskcache  # optional dependency, only needed with BACKGROUND_CALLBACKS=1
+    from dash.long_callback import DiskcacheLongCallbackManager
+
+    cache = diskcache.Cache(settings['callback_cache_dir'])
+    # the cache opens its SQLite connection at once, and reopens it on first use; closed here so
+    # that a preloaded master does not hand one connection to every worker it forks
+    cache.close()
+    return DiskcacheLongCallbackManager(cache)
+
+
+line_outputs = Output('quality-line', 'figure')
+line_inputs = [Input('data-store', 'data'), Input('line-window', 'data')]
+if settings['background_callbacks']:
+    @app.long_callback(
+        line_outputs,
+        line_inputs,
+        manager=make_long_callback_manager(),
+        progress=Output('line-progress', 'children'),
+        progress_default='',
+        running=[(Output('apply-filters-button', 'disabled'), True, False)],
+    )
+    def update_line_background(set_progress, handle, line_window):
+        if not handle or (handle.get('initial') and line_window is None):
+            return dash.no_update
+        set_progress(f"Loading {handle['values']:,} hourly values...")
+        return update_line(handle, line_window)
+else:
+    app.callback(line_outputs, line_inputs)(update_line)
+
+
+# Histogram of the filtered data, only built while its tab is open
+@app.callback(
+    Output('quality-hist', 'figure'),
+    [Input('data-store', 'data'),
+     Input('tabs', 'value')]
+)
+@timed('update_hist', callback=True)
+def update_hist(handle, tab):
+    if not handle or tab != 'hist' or handle.get('initial'):
+        raise PreventUpdate
+    annotate(start_date=handle['start_date'], end_date=handle['end_date'], particulate=handle['particulate'],
+             states=handle['states'] or 'all')
+
+    key = cache_key('update_hist', handle['key'])
+    cached = result_cache.get(key)
+    if cached is None:
+        cached = snapshot.lookup('update_hist', key, data_version())
+    if cached is not None:
+        return cached
+
+    state = tuple(handle['states'] or states_query)
+    summary = cached_summary(state, handle['start_date'], handle['end_date'], handle['particulate'])
+    hist = build_hist(summary, state, handle['particulate'])
+    with stage('figure_to_dict'):
+        figure = hist.to_dict()
+    result_cache.set(key, figure)
+    return figure
+
+
+# Show the map figure with the state geometries detailed enough for the current zoom, colored by
+# the selected aggregate (from map-summary, so changing it needs no request)
+app.clientside_callback(
+    """
+    function(figure, relayout, aggregate, levels, summary, current) {
+        if (!figure) {
+            return window.dash_clientside.no_update;
+        }
+        var zoom = (relayout && relayout['mapbox.zoom'] !== undefined) ? relayout['mapbox.zoom']
+            : figure.layout.mapbox.zoom;
+        var url = levels[0][1];
+        levels.forEach(function(level) {
+            if (zoom >= level[0]) {
+                url = level[1];
+            }
+        });
+        var triggered = window.dash_clientside.callback_context.triggered.map(function(t) {
+            return t.prop_id;
+        });
+        if (triggered.indexOf('map-figure.data') < 0 && triggered.indexOf('aggregate-function.value') < 0
+                && current && current.data.length && current.data[0].geojson === url) {
+            return window.dash_clientside.no_update;
+        }
+        var values = summary && summary[aggregate];
+        var index = {};
+        if (values) {
+            summary.state.forEach(function(state, i) {
+                index[state] = i;
+            });
+        }
+        return {
+            data: figure.data.map(function(trace) {
+                var update = {geojson: url};
+                if (values) {
+                    update.z = trace.locations.map(function(state) {
+                        return values[index[state]];
+                    });
+                }
+                return Object.assign({}, trace, update);
+            }),
+            layout: figure.layout
+        };
+    }
+    """,
+    Output('map', 'figure'),
+    [Input('map-figure', 'data'),
+     Input('map', 'relayoutData'),
+     Input('aggregate-function', 'value')],
+    [State('map-geojson', 'data'),
+     State('map-summary', 'data'),
+     State('map', 'figure')]
+)
+
+
+# Point the export link at the data behind the current figures
+app.clientside_callback(
+    """
+    function(handle) {
+        if (!handle) {
+            return '/export';
+        }
+        var params = new URLSearchParams({
+            start_date: handle.start_date,
+            end_date: handle.end_date,
+            particulate: handle.particulate
+        });
+        if (handle.states) {
+            params.set('state', handle.states.join(','));
+        }
+        return '/export?' + params.toString();
+    }
+    """,
+    Output('export-link', 'href'),
+    Input('data-store', 'data')
+)
+
+
+def _iter_csv_gzip(df, chunk_rows=50000):
+    # gzip compressed CSV, encoded and compressed a chunk of rows at a time
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    yield compressor.compress((','.join(df.columns) + '\n').encode())
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].to_csv(index=False, header=False)
+        yield compressor.compress(chunk.encode())
+    yield compressor.flush()
+
+
+# Opt-in download of the hourly rows behind a filter combination (gzipped CSV or Parquet)
+@application.route('/export')
+def export_route():
+    args = request.args
+    state = [val for val in args.get('state', '').split(',') if val in states] or None
+    try:
+        start_day, end_day = (date.fromisoformat(args[name]) if args.get(name) else None
+                              for name in ('start_date', 'end_date'))
+    except ValueError:
+        return Response('start_date and end_date must be dates (YYYY-MM-DD)', status=400)
+    # only the days with data are loaded
+    first_day, last_day = date_bounds()
+    start_day = max(start_day, first_day) if start_day else None
+    end_day = min(end_day, last_day) if end_day else None
+    start_date, end_date, particulate, state, _ = normalize_filters(
+        start_day, end_day, args.get('particulate'), state, None)
+    if start_date > end_date:
+        return Response('No data between start_date and end_date', status=400)
+    if (date.fromisoformat(end_date) - date.fromisoformat(start_date)).days >= settings['export_max_days']:
+        return Response(f"Exports are limited to {settings['export_max_days']} days, "
+                        'split the range into several requests', status=400)
+    df = cached_data(state, start_date, end_date, particulate)
+    filename = f'airquality_{particulate}_{start_date}_{end_date}'
+
+    if args.get('format') == 'parquet':
+        buffer = io.BytesIO()
+        try:
+            df.to_parquet(buffer, index=False)
+        except ImportError:
+            return Response('Parquet export needs pyarrow installed on the server', status=501)
+        buffer.seek(0)
+        return send_file(buffer, mimetype='application/vnd.apache.parquet', as_attachment=True,
+                         download_name=filename + '.parquet')
+
+    return Response(stream_with_context(_iter_csv_gzip(df)), mimetype='application/gzip',
+                    headers={'Content-Disposition': f'attachment; filename={filename}.csv.gz'})
+
+
+def warm_up():
+    """
+    Import what the figures need on the first request (plotly.express, and the seaborn template,
+    which plotly loads from its package data on first use), so that a preloading gunicorn master
+    does it once for all of its workers (see gunicorn.conf.py).
+    """
+    import plotly.express  # noqa: F401
+    import plotly.io as pio
+
+    pio.templates['seaborn']
+
 
+startup_stats['import_seconds'] = round(time.perf_counter() - _import_start, 3)
 
 if __name__ == '__main__':
     app.run_server(debug=True)
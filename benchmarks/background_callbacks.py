@@ -0,0 +1,117 @@
+# Checks and times the line chart's background callback (BACKGROUND_CALLBACKS=1, a Dash 2.0
+# long callback run by DiskcacheLongCallbackManager) against the regular callback. The requests
+# go through Dash's HTTP dispatch the way the browser sends them: the click, then one poll every
+# --interval seconds (the long callback's dcc.Interval) until the figure arrives. Checked:
+#  1. the page's initial handle (the landing page already holds the chart) returns dash.no_update,
+#     so the chart is left alone and polling stops;
+#  2. for every scenario the figure equals the one the regular callback builds.
+# Reported per scenario: the regular callback's time and the click-to-figure time in the
+# background (a process started per job, polling and the result passing through the cache
+# directory). Needs the pinned Dash 2.0 (app.long_callback) with diskcache, multiprocess and
+# psutil; the data is synthetic Arrow files in a temporary directory:
+#   python benchmarks/background_callbacks.py
+import argparse
+import inspect
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from dashboard import SCENARIOS
+from storage_backends import make_data, seed_arrow
+
+LINE_OUTPUTS = [('quality-line', 'figure'), ('_long_callback_interval_1', 'disabled'),
+                ('apply-filters-button', 'disabled'), ('line-progress', 'children'), ('_long_callback_store_1', 'data')]
+
+
+def line_request(client, output, n_intervals, handle, store, changed):
+    """
+    :return response: (dict) component id -> changed props of one dispatch of the long callback
+    """
+    body = {'output': output, 'changedPropIds': [changed],
+            'outputs': [{'id': id_, 'property': prop} for id_, prop in LINE_OUTPUTS],
+            'inputs': [{'id': '_long_callback_interval_1', 'property': 'n_intervals', 'value': n_intervals},
+                       {'id': 'data-store', 'property': 'data', 'value': handle},
+                       {'id': 'line-window', 'property': 'data', 'value': None}],
+            'state': [{'id': '_long_callback_store_1', 'property': 'data', 'value': store}]}
+    response = client.post('/_dash-update-component', json=body)
+    if response.status_code == 204:  # PreventUpdate
+        return {}
+    if response.status_code != 200:
+        raise RuntimeError(f'dispatch failed ({response.status_code}): {response.data[:500]!r}')
+    return response.get_json()['response']
+
+
+def run_background(client, output, handle, interval, timeout=120):
+    """
+    :return seconds, figure, progress: (float, dict, list) click to figure time, the figure (None if
+        the callback left the chart alone) and the progress texts shown meanwhile
+    """
+    store, progress = {}, []
+    start = time.perf_counter()
+    response = line_request(client, output, 0, handle, store, 'data-store.data')
+    n_intervals = 0
+    while True:
+        store = response.get('_long_callback_store_1', {}).get('data', store)
+        text = response.get('line-progress', {}).get('children')
+        if text:
+            progress.append(text)
+        if 'quality-line' in response:
+            return time.perf_counter() - start, response['quality-line']['figure'], progress
+        if response.get('_long_callback_interval_1', {}).get('disabled'):
+            return time.perf_counter() - start, None, progress
+        if time.perf_counter() - start > timeout:
+            raise RuntimeError('no result from the background callback')
+        time.sleep(interval)
+        n_intervals += 1
+        response = line_request(client, output, n_intervals, handle, store, '_long_callback_interval_1.n_intervals')
+
+
+def as_json(figure):
+    # figures compared as the browser receives them
+    from plotly.utils import PlotlyJSONEncoder
+    return json.loads(json.dumps(figure, cls=PlotlyJSONEncoder))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Background (long) callback of the line chart vs the regular one')
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--interval', type=float, default=1.0, help="seconds between polls (Dash's default)")
+    args = parser.parse_args()
+
+    import dash
+    if not dash.__version__.startswith('2.'):
+        sys.exit(f'app.long_callback needs the pinned Dash 2 (found {dash.__version__})')
+
+    # the settings are read when storage.py and application.py are first imported
+    directory = tempfile.mkdtemp(prefix='airquality-background-')
+    os.environ.update(STORAGE_BACKEND='arrow', ARROW_DIR=directory, CACHE_BACKEND='memory', SNAPSHOT='0',
+                      BACKGROUND_CALLBACKS='1', CALLBACK_CACHE_DIR=os.path.join(directory, 'callbacks'))
+    seed_arrow(make_data(args.years), directory)
+    import application as app
+
+    client = app.application.test_client()
+    output = next(key for key in app.app.callback_map if 'quality-line.figure' in key)
+    apply_filter, update_line = inspect.unwrap(app.apply_filter), inspect.unwrap(app.update_line)
+
+    state, start_date, end_date, particulate, aggregate = next(iter(SCENARIOS.values()))
+    handle = apply_filter(1, start_date, end_date, particulate, state, aggregate)[0]
+    seconds, figure, _ = run_background(client, output, dict(handle, initial=True), args.interval)
+    assert figure is None, 'the initial handle must leave the chart alone'
+    print(f'initial handle: no update, polling stopped after {seconds:.2f} s')
+
+    print(f"{'scenario':<34}{'regular s':>11}{'background s':>14}  progress")
+    for name, (state, start_date, end_date, particulate, aggregate) in SCENARIOS.items():
+        app.result_cache.clear()
+        handle = apply_filter(1, start_date, end_date, particulate, state, aggregate)[0]
+        app.result_cache.clear()  # both variants load the rows themselves
+        start = time.perf_counter()
+        expected = update_line(handle, None)
+        regular = time.perf_counter() - start
+        app.result_cache.clear()
+        seconds, figure, progress = run_background(client, output, handle, args.interval)
+        assert figure is not None and as_json(figure) == as_json(expected), f'{name}: figures differ'
+        print(f'{name:<34}{regular:>11.2f}{seconds:>14.2f}  {progress[-1] if progress else "-"}')
@@ -0,0 +1,157 @@
+# Local HTTP stand-in for the Berkeley Earth per-state air quality files.
+# Serves synthetic files in the same layout and .txt format as
+#   http://berkeleyearth.lbl.gov/air-quality/maps/cities/United_States/{state}/{state}.txt
+# (8 '%' header lines, then tab separated year, month, day, utc_hour, pm25, pm10, retrospective)
+# with ETag, If-None-Match and Range support, files that can grow by appended hours and an
+# optional artificial latency per request, so the scrapers can be benchmarked offline:
+#   python benchmarks/berkeley_stub.py --port 8765 --latency 0.3
+#   BERKELEY_EARTH_URL=http://localhost:8765/air-quality/maps/cities/United_States python ...
+import argparse
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+PATH_PREFIX = '/air-quality/maps/cities/United_States'
+
+STATES = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado',
+          'Connecticut', 'Delaware', 'Florida', 'Georgia', 'Hawaii', 'Idaho',
+          'Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky', 'Louisiana', 'Maine',
+          'Maryland', 'Massachusetts', 'Michigan', 'Minnesota', 'Mississippi',
+          'Missouri', 'Montana', 'Nebraska', 'Nevada', 'New_Hampshire',
+          'New_Jersey', 'New_Mexico', 'New_York', 'North_Carolina', 'North_Dakota',
+          'Ohio', 'Oklahoma', 'Oregon', 'Pennsylvania', 'Rhode_Island',
+          'South_Carolina', 'South_Dakota', 'Tennessee', 'Texas', 'Utah', 'Vermont',
+          'Virginia', 'Washington', 'West_Virginia', 'Wisconsin', 'Wyoming']
+
+HEADER = """% Berkeley Earth air quality data (synthetic stand-in)
+% Region: {state}
+%
+% Hourly averages of PM2.5 and PM10 in ug/m3
+%
+% Columns:
+% Year, Month, Day, UTC Hour, PM2.5, PM10, Retrospective
+%
+"""
+
+
+def make_rows(state, start=datetime(2021, 1, 1), hours=24 * 365):
+    """
+    :param state: (str) state name (seeds the random values, so the same hour always gets the same values)
+    :param start: (datetime) first hour
+    :param hours: (int) number of hourly rows
+    :return text: (str) data lines in the Berkeley Earth format
+    """
+    offset = int((start - datetime(2000, 1, 1)).total_seconds() // 3600)
+    rng = np.random.default_rng([sum(map(ord, state)), offset])
+    stamps = np.arange(np.datetime64(start, 'h'), np.datetime64(start + timedelta(hours=hours), 'h'))
+    pm25 = np.round(rng.gamma(2.0, 4.0, hours), 1)
+    pm10 = np.round(pm25 * 1.8 + rng.gamma(2.0, 3.0, hours), 1)
+    lines = []
+    for stamp, val25, val10 in zip(stamps.astype(datetime), pm25, pm10):
+        lines.append(f'{stamp.year}\t{stamp.month:>2}\t{stamp.day:>2}\t{stamp.hour:>2}\t{val25}\t{val10}\t0\n')
+    return ''.join(lines)
+
+
+def make_state_file(state, start=datetime(2021, 1, 1), hours=24 * 365):
+    """
+    :param state: (str) state name (written to the header)
+    :param start: (datetime) first hour in the file
+    :param hours: (int) number of hourly rows
+    :return text: (str) file contents in the Berkeley Earth format
+    """
+    return HEADER.format(state=state) + make_rows(state, start, hours)
+
+
+class StubServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the (growing) state files."""
+    daemon_threads = True
+
+    def __init__(self, address, handler, files, end):
+        super().__init__(address, handler)
+        self.files = files
+        self.end = end
+        self.requests_served = 0
+        self.bytes_served = 0
+        self.lock = threading.Lock()
+
+    def append_hours(self, hours):
+        """
+        :param hours: (int) number of new hourly rows to append to every file (as Berkeley Earth does)
+        """
+        with self.lock:
+            for path in self.files:
+                state = path.rsplit('/', 2)[1]
+                self.files[path] += make_rows(state, self.end, hours).encode()
+            self.end += timedelta(hours=hours)
+
+
+def start_server(port=0, latency=0.0, hours=24 * 365, states=STATES, start=datetime(2021, 1, 1)):
+    """
+    :param port: (int) port to listen on (0 picks a free one)
+    :param latency: (float) seconds to sleep before answering each request
+    :param hours: (int) number of hourly rows in each file
+    :param states: (list) states to serve
+    :param start: (datetime) first hour in each file
+    :return server, base_url: (StubServer, str) running server (call shutdown() to stop) and the value
+        to use for BERKELEY_EARTH_URL
+    """
+    files = {f'{PATH_PREFIX}/{state}/{state}.txt': make_state_file(state, start, hours).encode() for state in states}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real server
+        disable_nagle_algorithm = True  # small responses would otherwise wait on delayed ACKs
+
+        def do_GET(self):
+            time.sleep(latency)
+            with self.server.lock:
+                body = self.server.files.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            etag = '"%x-%x"' % (len(body), zlib.crc32(body))
+            status, headers = 200, {'ETag': etag}
+            if self.headers.get('If-None-Match') == etag:
+                status, body = 304, b''
+            elif self.headers.get('Range', '').startswith('bytes='):
+                first = int(self.headers['Range'][len('bytes='):].split('-')[0])
+                if first >= len(body):
+                    self.send_error(416)
+                    return
+                headers['Content-Range'] = f'bytes {first}-{len(body) - 1}/{len(body)}'
+                status, body = 206, body[first:]
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+            with self.server.lock:
+                self.server.requests_served += 1
+                self.server.bytes_served += len(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = StubServer(('127.0.0.1', port), Handler, files, start + timedelta(hours=hours))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}{PATH_PREFIX}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic Berkeley Earth state files')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of delay per request')
+    parser.add_argument('--hours', type=int, default=24 * 365, help='hourly rows per file')
+    args = parser.parse_args()
+    server, base_url = start_server(args.port, args.latency, args.hours)
+    print('Serving', base_url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,237 @@
+# End-to-end benchmark of the dashboard's callbacks and the update Lambda's ingest path, for
+# comparing commits. The data is synthetic (50 states, hourly, --years from 2021 on) and is
+# served either by the local Arrow backend in a temporary directory (in process, no database
+# needed) or by a scratch PostgreSQL database migrated with data1050/migrate.py (its airquality
+# table is truncated and reseeded):
+#   python benchmarks/dashboard.py --years 1
+#   python benchmarks/dashboard.py --years 3 --dsn "$DSN" --compare benchmarks/results/abc1234.json
+# Each scenario runs the pipeline of an "Apply Filters" click: apply_filter (map), update_line and
+# update_hist, with the result cache disabled (--warm keeps it). Reported per scenario: latency
+# percentiles of every callback and of the whole click, the JSON payload sizes, and the Python
+# peak memory of one click (tracemalloc). A throughput run drives the whole scenario mix from
+# --concurrency threads. The ingest part runs the Lambda's fetch/parse/COPY formatting against
+# benchmarks/berkeley_stub.py (and the COPY + upsert itself, rolled back, with --dsn).
+# Results are written as JSON to benchmarks/results/<commit>.json (or --out).
+import argparse
+import inspect
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'data1050'))
+from berkeley_stub import STATES, start_server
+from storage_backends import make_data, point_pool_at, seed_arrow, seed_postgres
+
+FIVE_STATES = ['Utah', 'Idaho', 'Nevada', 'Oregon', 'Washington']
+
+# name -> (states (None for all), start_date, end_date, particulate, aggregate)
+SCENARIOS = {
+    'all states, full year, median': (None, '2021-01-01', '2021-12-31', 'pm25', 'median'),
+    'all states, one month, max': (None, '2021-03-01', '2021-04-01', 'pm25', 'max'),
+    'five states, one month, median': (FIVE_STATES, '2021-03-01', '2021-04-01', 'pm10', 'median'),
+    'five states, full year, mean': (FIVE_STATES, '2021-01-01', '2021-12-31', 'pm25', 'mean'),
+    'one state, one week, mean': (['Utah'], '2021-06-01', '2021-06-08', 'pm25', 'mean'),
+}
+
+
+def payload_bytes(value):
+    # Dash encodes callback outputs with PlotlyJSONEncoder
+    from plotly.utils import PlotlyJSONEncoder
+    return len(json.dumps(value, cls=PlotlyJSONEncoder))
+
+
+def percentiles(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {'p50': round(float(np.percentile(ms, 50)), 2), 'p95': round(float(np.percentile(ms, 95)), 2),
+            'p99': round(float(np.percentile(ms, 99)), 2), 'mean': round(float(ms.mean()), 2)}
+
+
+def click(app, scenario, clear):
+    """
+    :return seconds, outputs: (dict, dict) time of each callback of one "Apply Filters" click and their outputs
+    """
+    # the undecorated callbacks (Dash 2.0's decorator expects its dispatch arguments)
+    apply_filter, update_line, update_hist = (inspect.unwrap(fn) for fn in
+                                              (app.apply_filter, app.update_line, app.update_hist))
+    if clear:
+        app.result_cache.clear()
+    state, start_date, end_date, particulate, aggregate = scenario
+    seconds = {}
+    start = time.perf_counter()
+    handle, map_figure, map_summary = apply_filter(1, start_date, end_date, particulate, state, aggregate)
+    seconds['apply_filter'] = time.perf_counter() - start
+    mark = time.perf_counter()
+    line = update_line(handle, None)
+    seconds['update_line'] = time.perf_counter() - mark
+    mark = time.perf_counter()
+    hist = update_hist(handle, 'hist')
+    seconds['update_hist'] = time.perf_counter() - mark
+    seconds['total'] = time.perf_counter() - start
+    return seconds, {'data-store': handle, 'map': map_figure, 'map-summary': map_summary, 'line': line, 'hist': hist}
+
+
+def run_scenarios(app, repeat, warm):
+    results = {}
+    for name, scenario in SCENARIOS.items():
+        click(app, scenario, clear=True)  # warm up imports, partitions and the connection pool
+        runs = [click(app, scenario, clear=not warm) for _ in range(repeat)]
+        outputs = runs[-1][1]
+        tracemalloc.start()
+        click(app, scenario, clear=not warm)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {
+            'latency_ms': {step: percentiles([seconds[step] for seconds, _ in runs]) for step in runs[0][0]},
+            'payload_bytes': {output: payload_bytes(value) for output, value in outputs.items()},
+            'peak_memory_mb': round(peak / 2 ** 20, 1),
+        }
+        latency = results[name]['latency_ms']['total']
+        print(f"{name:<34}{latency['p50']:>10.1f}{latency['p95']:>10.1f}"
+              f"{sum(results[name]['payload_bytes'].values()) / 1024:>12.1f}{results[name]['peak_memory_mb']:>10.1f}")
+    return results
+
+
+def shifted(scenario, days):
+    # the same query one day later per repeat, so that cold runs never hit another click's cache entry
+    state, start_date, end_date, particulate, aggregate = scenario
+    day = timedelta(days=days)
+    return (state, str(datetime.fromisoformat(start_date) + day)[:10], str(datetime.fromisoformat(end_date) + day)[:10],
+            particulate, aggregate)
+
+
+def run_throughput(app, repeat, concurrency, warm):
+    mix = [scenario if warm else shifted(scenario, i) for i in range(repeat) for scenario in SCENARIOS.values()]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(lambda scenario: click(app, scenario, clear=False), mix))
+    seconds = time.perf_counter() - start
+    return {'concurrency': concurrency, 'clicks': len(mix), 'seconds': round(seconds, 3),
+            'clicks_per_second': round(len(mix) / seconds, 2), 'warm_cache': warm}
+
+
+def run_ingest(base_url, hours, dsn):
+    import aqi
+    import updateDatabase_Lambda as lam
+
+    end = datetime(2021, 1, 1) + timedelta(hours=hours)
+    results = {}
+    for name, latest in (('full', None), ('incremental', end - timedelta(hours=48))):
+        tracemalloc.start()
+        start = time.perf_counter()
+        failed, fetched = [], {}
+        windows = {state: aqi.RollingWindow() for state in STATES}
+        stream = lam.CopyStream(lam.format_state_rows(new_data, state, windows[state]) for state, new_data in
+                                lam.fetch_new_data(STATES, dict.fromkeys(STATES, latest), {}, fetched, failed)
+                                if len(new_data) > 0)
+        if dsn:
+            import psycopg2
+            conn = psycopg2.connect(dsn)
+            with conn.cursor() as cur:
+                rows = lam.add_to_database(cur, stream)
+            conn.rollback()  # keep the seeded data for the next run
+            conn.close()
+        else:
+            rows = 0
+            while True:
+                text = stream.read(1 << 16)
+                if not text:
+                    break
+                rows += text.count('\n')
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {'rows': rows, 'seconds': round(seconds, 3), 'rows_per_second': round(rows / seconds, 1),
+                         'failed_states': failed, 'peak_memory_mb': round(peak / 2 ** 20, 1),
+                         'copy_into_database': bool(dsn)}
+        print(f"ingest {name:<12}{rows:>10} rows{seconds:>8.2f} s{rows / seconds:>12,.0f} rows/s")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, path):
+    with open(path) as fp:
+        previous = json.load(fp)
+    print(f"p50 of a click against {previous['commit']}:")
+    for name, result in results['scenarios'].items():
+        before = previous['scenarios'].get(name)
+        if before is None:
+            continue
+        old, new = before['latency_ms']['total']['p50'], result['latency_ms']['total']['p50']
+        print(f'  {name:<34}{old:>10.1f} ->{new:>10.1f} ms ({new / old:.2f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the dashboard callbacks and the ingest path')
+    parser.add_argument('--years', type=int, default=1, help='years of synthetic hourly data from 2021 on')
+    parser.add_argument('--dsn', help='scratch PostgreSQL database (default: local Arrow files, in process)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=4, help='threads of the throughput run')
+    parser.add_argument('--warm', action='store_true', help='keep the result cache between clicks')
+    parser.add_argument('--ingest-hours', type=int, default=24 * 30, help='hours in each stub state file')
+    parser.add_argument('--latency', type=float, default=0.05, help='stub server latency in seconds')
+    parser.add_argument('--out', help='results file (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    # configure the dashboard before importing it (its settings are read at import)
+    directory = tempfile.mkdtemp(prefix='airquality-bench-')
+    os.environ.update({'CACHE_BACKEND': 'memory', 'SLOW_REQUEST_SECONDS': '1e9', 'SNAPSHOT': '0',
+                       'STORAGE_BACKEND': 'postgres' if args.dsn else 'arrow', 'ARROW_DIR': directory})
+    server, base_url = start_server(latency=args.latency, hours=args.ingest_hours)
+    os.environ['BERKELEY_EARTH_URL'] = base_url
+    if args.dsn:
+        point_pool_at(args.dsn)
+
+    data = make_data(args.years)
+    seed_start = time.perf_counter()
+    if args.dsn:
+        seed_postgres(data, args.dsn)
+    else:
+        seed_arrow(data, directory)
+    print(f'{len(data)} rows seeded into {"PostgreSQL" if args.dsn else directory} '
+          f'in {time.perf_counter() - seed_start:.1f} s')
+    del data
+
+    import application
+
+    print(f"{'scenario':<34}{'p50 ms':>10}{'p95 ms':>10}{'payload KB':>12}{'peak MB':>10}")
+    results = {
+        'commit': git_commit(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'config': {'years': args.years, 'backend': 'postgres' if args.dsn else 'arrow', 'repeat': args.repeat,
+                   'warm_cache': args.warm, 'ingest_hours': args.ingest_hours, 'stub_latency': args.latency},
+        'scenarios': run_scenarios(application, args.repeat, args.warm),
+    }
+    results['throughput'] = run_throughput(application, args.repeat, args.concurrency, args.warm)
+    print(f"throughput: {results['throughput']['clicks_per_second']} clicks/s "
+          f"with {args.concurrency} threads")
+    results['ingest'] = run_ingest(base_url, args.ingest_hours, args.dsn)
+    results['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    server.shutdown()
+
+    out = args.out or os.path.join(ROOT, 'benchmarks', 'results', f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as fp:
+        json.dump(results, fp, indent=1)
+    print('Wrote', out)
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,74 @@
+# Micro-benchmark of the update Lambda's per-state parse: the previous format_date /
+# make_datetime_array loop (one string -> datetime64 per row, over the whole file) against the
+# vectorized make_datetime_array and parse_stream, which drops old rows before any per-row work.
+#   python benchmarks/datetime_parse.py --hours 8760 --new 12
+import argparse
+import io
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data1050'))
+from berkeley_stub import make_state_file
+import updateDatabase_Lambda as lam
+
+
+# --- previous implementation, kept here for comparison ---
+def format_date(array):
+    year = str(int(array[0]))
+    month = str(int(array[1])) if len(str(int(array[1]))) > 1 else '0' + str(int(array[1]))
+    day = str(int(array[2])) if len(str(int(array[2]))) > 1 else '0' + str(int(array[2]))
+    hour = str(int(array[3])) if len(str(int(array[3]))) > 1 else '0' + str(int(array[3]))
+    return np.datetime64(f'{year}-{month}-{day}T{hour}')
+
+
+def legacy_make_datetime_array(data):
+    datetime_array = np.zeros(len(data), dtype='datetime64[h]')
+    for i, val in enumerate(data):
+        datetime_array[i] = format_date(val)
+    return datetime_array
+
+
+def legacy_parse_data(text):
+    return np.loadtxt(io.StringIO(text.replace(' ', '')), comments='%', ndmin=2)
+
+
+def legacy_new_rows(text, latest_datetime):
+    data = legacy_parse_data(text)
+    return data[legacy_make_datetime_array(data) > latest_datetime]
+
+
+def best(stmt, repeat):
+    return min(timeit.repeat(stmt, number=1, repeat=repeat)) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Timestamp construction and new-row parsing benchmark')
+    parser.add_argument('--hours', type=int, default=24 * 365, help='hourly rows in the state file')
+    parser.add_argument('--new', type=int, default=12, help='rows newer than the latest database hour')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    text = make_state_file('Utah', hours=args.hours)
+    body = text.encode()
+    # line aligned chunks, as berkeley.Download.iter_chunks yields them
+    chunks, start = [], 0
+    while start < len(body):
+        end = body.rfind(b'\n', start, start + lam.berkeley.CHUNK_SIZE) + 1 or len(body)
+        chunks.append(body[start:end])
+        start = end
+    data = legacy_parse_data(text)
+    latest = datetime(2021, 1, 1) + timedelta(hours=args.hours - args.new - 1)
+
+    assert (legacy_make_datetime_array(data) == lam.make_datetime_array(data)).all()
+    assert np.array_equal(legacy_new_rows(text, latest), lam.parse_stream(chunks, latest))
+
+    print(f'{args.hours} rows, {args.new} new')
+    print(f"{'datetime array, loop':<32}{best(lambda: legacy_make_datetime_array(data), args.repeat):>10.2f} ms")
+    print(f"{'datetime array, vectorized':<32}{best(lambda: lam.make_datetime_array(data), args.repeat):>10.2f} ms")
+    print(f"{'new rows, parse all + loop':<32}{best(lambda: legacy_new_rows(text, latest), args.repeat):>10.2f} ms")
+    print(f"{'new rows, parse_stream':<32}{best(lambda: lam.parse_stream(chunks, latest), args.repeat):>10.2f} ms")
@@ -0,0 +1,89 @@
+# Before/after EXPLAIN benchmark for the timestamp column migration (001_timestamp_index.sql).
+# Runs the dashboard's old make_timestamp() filter and the new sargable range query with
+# EXPLAIN (ANALYZE, BUFFERS) and reports plan shape and execution times. Meant for a local
+# PostgreSQL stand-in; --seed fills airquality with synthetic hourly rows first, e.g.:
+#   python data1050/migrate.py --dsn "$DSN"
+#   python benchmarks/explain_timestamp_index.py --dsn "$DSN" --seed --years 1
+import argparse
+import json
+import os
+import sys
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data1050'))
+from migrate import default_dsn
+
+STATES = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado',
+          'Connecticut', 'Delaware', 'Florida', 'Georgia', 'Hawaii', 'Idaho',
+          'Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky', 'Louisiana', 'Maine',
+          'Maryland', 'Massachusetts', 'Michigan', 'Minnesota', 'Mississippi',
+          'Missouri', 'Montana', 'Nebraska', 'Nevada', 'New_Hampshire',
+          'New_Jersey', 'New_Mexico', 'New_York', 'North_Carolina', 'North_Dakota',
+          'Ohio', 'Oklahoma', 'Oregon', 'Pennsylvania', 'Rhode_Island',
+          'South_Carolina', 'South_Dakota', 'Tennessee', 'Texas', 'Utah', 'Vermont',
+          'Virginia', 'Washington', 'West_Virginia', 'Wisconsin', 'Wyoming']
+
+BEFORE = """SELECT state, make_timestamp(CAST(year AS int), CAST(month AS int), CAST(day AS int), CAST(utc_hour AS int), 0, CAST(0.0 AS double precision)) AS timestamp, pm25 FROM airquality
+    WHERE make_timestamp(CAST(year AS int), CAST(month AS int), CAST(day AS int), CAST(utc_hour AS int), 0, CAST(0.0 AS double precision))
+    BETWEEN CAST(%(start)s AS DATE) and CAST(%(end)s AS DATE)
+    AND state in %(states)s"""
+
+AFTER = """SELECT state, timestamp, pm25 FROM airquality
+    WHERE state IN %(states)s AND timestamp BETWEEN CAST(%(start)s AS DATE) AND CAST(%(end)s AS DATE)"""
+
+SCENARIOS = [
+    ('one state, one week', {'states': ('Utah',), 'start': '2021-06-01', 'end': '2021-06-08'}),
+    ('three states, one month', {'states': ('Utah', 'Idaho', 'Nevada'), 'start': '2021-03-01', 'end': '2021-04-01'}),
+    ('all states, full year', {'states': tuple(STATES), 'start': '2021-01-01', 'end': '2021-12-31'}),
+]
+
+
+def seed(cur, years):
+    """
+    :param cur: (cursor) database cursor
+    :param years: (int) number of years of synthetic hourly data (starting 2021) per state
+    """
+    cur.execute('TRUNCATE airquality')
+    cur.execute("""INSERT INTO airquality (year, month, day, utc_hour, pm25, pm10, state)
+        SELECT extract(year FROM t), extract(month FROM t), extract(day FROM t), extract(hour FROM t),
+               round((5 + 20 * random())::numeric, 1), round((10 + 40 * random())::numeric, 1), s
+        FROM unnest(%s::text[]) AS s,
+             generate_series(timestamp '2021-01-01', timestamp '2021-01-01' + %s * interval '1 year' - interval '1 hour',
+                             interval '1 hour') AS t""", (STATES, years))
+    cur.execute('ANALYZE airquality')
+
+
+def explain(cur, query, params):
+    """
+    :return (plan root node type, uses index, execution time in ms)
+    """
+    cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query, params)
+    plan = cur.fetchone()[0][0]
+    text = json.dumps(plan['Plan'])
+    return plan['Plan']['Node Type'], 'Index' in text, plan['Execution Time']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='EXPLAIN the airquality date range query before/after the migration')
+    parser.add_argument('--dsn', default=default_dsn())
+    parser.add_argument('--seed', action='store_true', help='replace airquality with synthetic data first')
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per query (best time is reported)')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    if args.seed:
+        seed(cur, args.years)
+        conn.commit()
+
+    print(f"{'scenario':<26}{'query':<8}{'plan':<18}{'index':<7}{'best ms':>10}")
+    for label, params in SCENARIOS:
+        for name, query in (('before', BEFORE), ('after', AFTER)):
+            runs = [explain(cur, query, params) for _ in range(args.repeat)]
+            node, uses_index, _ = runs[0]
+            best = min(run[2] for run in runs)
+            print(f'{label:<26}{name:<8}{node:<18}{str(uses_index):<7}{best:>10.1f}')
+    cur.close()
+    conn.close()
@@ -0,0 +1,72 @@
+# Figure JSON size and build time of the histogram tab before and after binning moved to the
+# server: px.histogram over every hourly value (binned in the browser) against build_hist over
+# the rollup sketches (aggregates.histogram). The sketches are built here the way
+# refresh_airquality_rollups builds them, so no database is needed.
+#   python benchmarks/hist_payload.py --states 49 --days 365
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+from plotly.utils import PlotlyJSONEncoder
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import application
+from aggregates import SKETCH_BIN_WIDTH, SKETCH_MAX_BIN, summarize
+
+
+# --- previous implementation, kept here for comparison ---
+def legacy_build_hist(data, state, particulate):
+    if len(state) >= 50:
+        fig = px.histogram(data, x=particulate, template='seaborn')
+    else:
+        fig = px.histogram(data, x=particulate, color='state', template='seaborn', opacity=0.80)
+    return fig
+
+
+def make_data(states, days):
+    rng = np.random.default_rng(0)
+    stamps = pd.date_range('2021-01-01', periods=24 * days, freq='h')
+    return pd.DataFrame({'state': np.repeat(states, len(stamps)), 'timestamp': np.tile(stamps, len(states)),
+                         'pm25': np.round(rng.gamma(2.0, 4.0, len(states) * len(stamps)), 1)})
+
+
+def sketch_rows(data, particulate):
+    # rows as the summary query returns them: state, n, total, min, max, sketch bins and counts
+    rows = []
+    for state, values in data.groupby('state', sort=False)[particulate]:
+        values = values.to_numpy()
+        bins = np.clip(np.floor(values / SKETCH_BIN_WIDTH).astype(int), 0, SKETCH_MAX_BIN)
+        bins, counts = np.unique(bins, return_counts=True)
+        rows.append((state, len(values), values.sum(), values.min(), values.max(), bins, counts))
+    return rows
+
+
+def measure(build, repeat):
+    size = len(json.dumps(build().to_dict(), cls=PlotlyJSONEncoder))
+    seconds = min(timeit.repeat(lambda: json.dumps(build().to_dict(), cls=PlotlyJSONEncoder),
+                                number=1, repeat=repeat))
+    return size, seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Histogram payload, browser vs server binning')
+    parser.add_argument('--states', type=int, default=49)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    state = application.states_query[:args.states]
+    data = make_data(state, args.days)
+    summary = summarize(sketch_rows(data, 'pm25'))
+
+    print(f'{len(data)} rows ({args.states} states, {args.days} days)')
+    print(f"{'build_hist':<20}{'figure bytes':>14}{'build+JSON ms':>16}")
+    for name, build in (('previous (raw)', lambda: legacy_build_hist(data, state, 'pm25')),
+                        ('server binned', lambda: application.build_hist(summary, state, 'pm25'))):
+        size, seconds = measure(build, args.repeat)
+        print(f'{name:<20}{size:>14}{seconds * 1000:>16.1f}')
@@ -0,0 +1,48 @@
+# Offline benchmark of incremental (ETag + Range) downloads of the Berkeley Earth files against
+# the local stand-in: a first full download of every state, a run where nothing changed and a
+# run after a few hours were appended, reporting bytes transferred and fetch + parse time.
+#   python benchmarks/incremental_fetch.py --hours 8760 --appended 12
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data1050'))
+from berkeley_stub import STATES, start_server
+
+
+def run(lam, server, metadata):
+    """
+    :return seconds, bytes, rows, metadata: fetch + parse time of all states, bytes served, rows parsed
+        and the new metadata per state
+    """
+    bytes_before = server.bytes_served
+    start = time.perf_counter()
+    results = {state: lam.scrape_data(state, metadata.get(state)) for state in STATES}
+    seconds = time.perf_counter() - start
+    rows = sum(len(data) for _, data, _ in results.values())
+    return seconds, server.bytes_served - bytes_before, rows, {state: meta for state, (_, _, meta) in results.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Full vs incremental downloads of all state files')
+    parser.add_argument('--hours', type=int, default=24 * 365, help='hourly rows per state file')
+    parser.add_argument('--appended', type=int, default=12, help='hours appended between runs')
+    args = parser.parse_args()
+
+    server, base_url = start_server(hours=args.hours)
+    os.environ['BERKELEY_EARTH_URL'] = base_url
+    import updateDatabase_Lambda as lam
+
+    print(f"{'run':<22}{'seconds':>10}{'bytes':>14}{'rows parsed':>14}")
+    seconds, nbytes, rows, metadata = run(lam, server, {})
+    print(f"{'full download':<22}{seconds:>10.2f}{nbytes:>14}{rows:>14}")
+    seconds, nbytes, rows, metadata = run(lam, server, metadata)
+    print(f"{'unchanged':<22}{seconds:>10.2f}{nbytes:>14}{rows:>14}")
+    server.append_hours(args.appended)
+    seconds, nbytes, rows, metadata = run(lam, server, metadata)
+    print(f"{f'{args.appended} hours appended':<22}{seconds:>10.2f}{nbytes:>14}{rows:>14}")
+    seconds, nbytes, rows, _ = run(lam, server, {})
+    print(f"{'full (same files)':<22}{seconds:>10.2f}{nbytes:>14}{rows:>14}")
+    server.shutdown()
@@ -0,0 +1,71 @@
+# Figure JSON size and build time of the line chart before and after min/max downsampling
+# (downsample.py), for a year of hourly data, plus a check that every series keeps its extremes.
+#   python benchmarks/line_downsample.py --states 49 --days 365
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+from plotly.utils import PlotlyJSONEncoder
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import application
+
+
+# --- previous implementation, kept here for comparison ---
+def legacy_build_line(data, state, particulate):
+    if len(state) >= 50:
+        data = data.groupby('timestamp', as_index=False)[particulate].mean()
+        fig = px.line(data, x='timestamp', y=particulate, template='seaborn')
+    else:
+        data = data.sort_values(by='timestamp')
+        fig = px.line(data, x='timestamp', y=particulate, color='state', template='seaborn')
+    return fig
+
+
+def make_data(states, days):
+    rng = np.random.default_rng(0)
+    stamps = pd.date_range('2021-01-01', periods=24 * days, freq='h')
+    values = np.round(rng.gamma(2.0, 4.0, len(states) * len(stamps)), 1)
+    values[rng.random(len(values)) < 0.01] = np.nan  # missing hours
+    return pd.DataFrame({'state': np.repeat(states, len(stamps)), 'timestamp': np.tile(stamps, len(states)),
+                         'pm25': values})
+
+
+def measure(build, repeat):
+    figure = build().to_dict()
+    size = len(json.dumps(figure, cls=PlotlyJSONEncoder))
+    seconds = min(timeit.repeat(lambda: json.dumps(build().to_dict(), cls=PlotlyJSONEncoder),
+                                number=1, repeat=repeat))
+    return figure, size, seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Line chart payload with and without downsampling')
+    parser.add_argument('--states', type=int, default=49)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    state = application.states_query[:args.states]
+    data = make_data(state, args.days)
+
+    old, old_size, old_seconds = measure(lambda: legacy_build_line(data, state, 'pm25'), args.repeat)
+    new, new_size, new_seconds = measure(lambda: application.build_line(data, state, 'pm25'), args.repeat)
+
+    # same series and the same extremes in each
+    old_traces = {trace.get('name'): np.asarray(trace['y'], dtype=float) for trace in old['data']}
+    for trace in new['data']:
+        values = np.asarray(trace['y'], dtype=float)
+        assert np.nanmax(values) == np.nanmax(old_traces[trace.get('name')])
+        assert np.nanmin(values) == np.nanmin(old_traces[trace.get('name')])
+
+    points = lambda figure: sum(len(trace['x']) for trace in figure['data'])
+    print(f'{len(data)} rows ({args.states} states, {args.days} days)')
+    print(f"{'build_line':<16}{'points':>10}{'figure bytes':>14}{'build+JSON ms':>16}")
+    print(f"{'previous':<16}{points(old):>10}{old_size:>14}{old_seconds * 1000:>16.1f}")
+    print(f"{'downsampled':<16}{points(new):>10}{new_size:>14}{new_seconds * 1000:>16.1f}")
@@ -0,0 +1,66 @@
+# Figure JSON size and build time of the map before and after the state geometries moved to
+# cacheable /geojson assets: the previous build_map (json.load of the census file on every call,
+# geometry embedded in the figure) against application.build_map (geometry referenced by URL).
+# Also prints the size of each per-zoom GeoJSON variant, which the browser downloads once.
+#   python benchmarks/map_payload.py
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+from plotly.utils import PlotlyJSONEncoder
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import application
+
+
+# --- previous implementation, kept here for comparison ---
+def legacy_build_map(data, particulate_val):
+    with open(os.path.join(ROOT, 'static', 'gz_2010_us_040_00_5m.json')) as fp:
+        geojson = json.load(fp)
+    particulate_val_formatted = 'PM2.5' if particulate_val == 'pm25' else 'PM10'
+    fig = px.choropleth_mapbox(data, geojson=geojson,
+                               featureidkey="properties.NAME", locations='state', color=particulate_val,
+                               color_continuous_scale="RdYlGn_r",
+                               mapbox_style="open-street-map",
+                               zoom=3, center={"lat": 37.0902, "lon": -95.7129},
+                               opacity=0.75,
+                               labels={'state': 'State', particulate_val: particulate_val_formatted},
+                               template='seaborn'
+                               )
+    fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0},
+                      paper_bgcolor='#aad3df')
+    return fig
+
+
+def measure(build, data, repeat):
+    # build + serialization, as in the callback response
+    size = len(json.dumps(build(data, 'pm25').to_dict(), cls=PlotlyJSONEncoder))
+    build_seconds = min(timeit.repeat(lambda: build(data, 'pm25'), number=1, repeat=repeat))
+    total_seconds = min(timeit.repeat(lambda: json.dumps(build(data, 'pm25').to_dict(), cls=PlotlyJSONEncoder),
+                                      number=1, repeat=repeat))
+    return size, build_seconds, total_seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Map figure payload and build time, before and after')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    data = pd.DataFrame({'state': application.states_query,
+                         'pm25': np.random.default_rng(0).gamma(2.0, 4.0, len(application.states_query))})
+
+    print(f"{'build_map':<22}{'figure bytes':>14}{'build ms':>12}{'build+JSON ms':>16}")
+    for name, build in (('previous (embedded)', legacy_build_map), ('by URL', application.build_map)):
+        size, build_seconds, total_seconds = measure(build, data, args.repeat)
+        print(f'{name:<22}{size:>14}{build_seconds * 1000:>12.1f}{total_seconds * 1000:>16.1f}')
+
+    print(f"\n{'GeoJSON variant':<28}{'min zoom':>10}{'bytes':>12}{'gzip bytes':>12}")
+    for variant in application.geojson_variants:
+        print(f"{variant['url'][len('/geojson/'):]:<28}{variant['min_zoom']:>10}{variant['size']:>12}"
+              f"{len(variant['gzip']):>12}")
@@ -0,0 +1,138 @@
+# Decode time and peak RSS of the hourly rows of a full year for all states (what the line chart
+# loads for the default view), before and after PostgresBackend.load moved from fetchall() to
+# COPY ... TO STDOUT decoded into typed NumPy columns (database.copy_columns). Each variant runs
+# in its own process so that its peak RSS is its own; the Python peak (tracemalloc) covers the
+# fetch and decode only.
+# With a scratch database migrated with data1050/migrate.py (its airquality table is truncated
+# and reseeded with --seed), both variants run the real queries:
+#   python benchmarks/pg_decode.py --dsn "$DSN" --seed
+# Without one, the client side is replayed offline: "before" builds the (state, datetime, float)
+# tuples psycopg2 returns and the DataFrame from them, "after" feeds the CSV rows COPY sends, one
+# write per row as psycopg2 does, through database.ColumnSink. The offline "before" time only
+# covers the DataFrame build (psycopg2 builds the tuples in C, faster than Python can here).
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from berkeley_stub import STATES
+from storage_backends import make_data, point_pool_at, seed_postgres
+
+
+def rss_mb():
+    # peak resident set size of this process so far
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:  # not Linux: fall back to the peak so far
+        return rss_mb()
+
+
+def trace_start():
+    # Python allocations are traced in a separate run (tracemalloc slows decoding down)
+    if os.environ.get('PG_DECODE_TRACE') == '1':
+        tracemalloc.start()
+
+
+def run_offline(variant, years):
+    data = make_data(years)
+    data = data[data['timestamp'] < pd.Timestamp('2022-01-01')]
+    if variant == 'before':
+        # the rows fetchall() holds count towards the peak
+        baseline = current_rss_mb()
+        trace_start()
+        rows = list(zip(data['state'].tolist(), data['timestamp'].dt.to_pydatetime().tolist(), data['pm25'].tolist()))
+        del data
+        start = time.perf_counter()
+        df = pd.DataFrame(rows, columns=['state', 'timestamp', 'pm25'])
+        seconds = time.perf_counter() - start
+    else:
+        from database import ColumnSink
+        codes = pd.Categorical(data['state'], categories=STATES).codes
+        hours = data['timestamp'].to_numpy().astype('datetime64[h]').astype(np.int64)
+        # the bytes on the wire (not held by psycopg2, which hands each row over as it arrives)
+        stream = ''.join(f'{code},{hour},{value!r}\n' for code, hour, value in
+                         zip(codes.tolist(), hours.tolist(), data['pm25'].tolist())).encode()
+        ends = np.flatnonzero(np.frombuffer(stream, dtype=np.uint8) == ord('\n')) + 1
+        del data, codes, hours
+        baseline = current_rss_mb()
+        trace_start()
+        start = time.perf_counter()
+        sink = ColumnSink((np.int16, np.int64, np.float32))
+        begin = 0
+        for end in ends:
+            sink.write(stream[begin:end])
+            begin = end
+        codes, hours, values = sink.columns()
+        df = pd.DataFrame({'state': pd.Categorical.from_codes(codes, categories=STATES),
+                           'timestamp': hours.astype('datetime64[h]'), 'pm25': values})
+        seconds = time.perf_counter() - start
+    return df, seconds, baseline
+
+
+def run_database(variant):
+    import storage
+    from database import query_database
+    baseline = current_rss_mb()
+    trace_start()
+    start = time.perf_counter()
+    if variant == 'before':
+        query = """SELECT state, timestamp, pm25 FROM airquality
+        WHERE state IN %(state)s AND year BETWEEN 2021 AND 2021
+        AND timestamp BETWEEN CAST('2021-01-01' AS DATE) AND CAST('2021-12-31' AS DATE)"""
+        df = pd.DataFrame(query_database(query, {'state': tuple(STATES)}), columns=['state', 'timestamp', 'pm25'])
+    else:
+        df = storage.PostgresBackend().load(tuple(STATES), '2021-01-01', '2021-12-31', 'pm25')
+    return df, time.perf_counter() - start, baseline
+
+
+def child(args):
+    if args.dsn:
+        point_pool_at(args.dsn)
+        df, seconds, baseline = run_database(args.variant)
+    else:
+        df, seconds, baseline = run_offline(args.variant, args.years)
+    peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+    print(json.dumps({'variant': args.variant, 'rows': len(df), 'decode_seconds': round(seconds, 3),
+                      'python_peak_mb': round(peak / 2 ** 20, 1), 'baseline_rss_mb': round(baseline, 1), 'peak_rss_mb': round(rss_mb(), 1),
+                      'dataframe_mb': round(df.memory_usage(deep=True).sum() / 2 ** 20, 1)}))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fetchall() vs COPY into typed columns for the line chart rows')
+    parser.add_argument('--dsn', help='scratch PostgreSQL database (default: offline replay)')
+    parser.add_argument('--seed', action='store_true', help='reseed the database with synthetic data first')
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--variant', choices=('before', 'after'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        child(args)
+        sys.exit(0)
+    if args.dsn and args.seed:
+        seed_postgres(make_data(args.years), args.dsn)
+    print(f"{'variant':<10}{'rows':>10}{'decode s':>10}{'peak RSS MB':>13}{'over baseline':>15}"
+          f"{'Python peak MB':>16}{'frame MB':>10}")
+    for variant in ('before', 'after'):
+        command = [sys.executable, __file__, '--variant', variant, '--years', str(args.years)]
+        if args.dsn:
+            command += ['--dsn', args.dsn]
+        result = json.loads(subprocess.check_output(command, text=True).splitlines()[-1])
+        traced = json.loads(subprocess.check_output(command, text=True, env=dict(os.environ, PG_DECODE_TRACE='1'))
+                            .splitlines()[-1])
+        result['python_peak_mb'] = traced['python_peak_mb']
+        print(f"{variant:<10}{result['rows']:>10}{result['decode_seconds']:>10.2f}{result['peak_rss_mb']:>13.1f}"
+              f"{result['peak_rss_mb'] - result['baseline_rss_mb']:>15.1f}{result['python_peak_mb']:>16.1f}"
+              f"{result['dataframe_mb']:>10.1f}")
@@ -0,0 +1,42 @@
+# Offline benchmark of the update Lambda's fetch stage: one state after another (the old loop)
+# versus the concurrent fetch_new_data, both against the local Berkeley Earth stand-in.
+#   python benchmarks/scrape_concurrency.py --latency 0.3 --hours 2000
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data1050'))
+from berkeley_stub import STATES, start_server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sequential vs concurrent scraping of all states')
+    parser.add_argument('--latency', type=float, default=0.3, help='simulated server latency per request (s)')
+    parser.add_argument('--hours', type=int, default=24 * 365, help='hourly rows per state file')
+    args = parser.parse_args()
+
+    server, base_url = start_server(latency=args.latency, hours=args.hours)
+    os.environ['BERKELEY_EARTH_URL'] = base_url
+    import updateDatabase_Lambda as lam
+
+    # only the last day is "new", as on a typical run
+    latest = {state: datetime(2021, 1, 1) + timedelta(hours=args.hours - 25) for state in STATES}
+
+    start = time.perf_counter()
+    sequential = {state: lam.fetch_new_rows(state, latest[state])[1] for state in STATES}
+    sequential_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    failed = []
+    concurrent = dict(lam.fetch_new_data(STATES, latest, {}, {}, failed))
+    concurrent_seconds = time.perf_counter() - start
+    server.shutdown()
+
+    assert not failed and all((concurrent[s] == sequential[s]).all() for s in STATES)
+    rows = sum(len(data) for data in concurrent.values())
+    print(f'{len(STATES)} states, {rows} new rows, {args.latency}s latency, {args.hours} rows per file')
+    print(f'sequential: {sequential_seconds:8.2f} s')
+    print(f'concurrent: {concurrent_seconds:8.2f} s  ({lam.MAX_WORKERS} workers, {lam.berkeley.MAX_PER_HOST} per host)')
+    print(f'speedup:    {sequential_seconds / concurrent_seconds:8.1f}x')
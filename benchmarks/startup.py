@@ -0,0 +1,174 @@
+# Startup time and per worker memory of the dashboard under gunicorn, for tracking regressions.
+# The data is synthetic (50 states, one year) in Arrow files in a temporary directory, so no
+# database is needed. Reported:
+#   import     seconds to import application.py in a fresh interpreter (median of --repeat)
+#   gunicorn   for --workers workers, with and without --preload: seconds until the first request
+#              is answered and until every worker has booted (stopped using CPU), the CPU seconds
+#              the master and workers spent getting there, and the RSS, PSS (shared pages split
+#              between the processes sharing them) and USS (private pages) of every worker after
+#              --requests layout requests, from /proc/<pid>/smaps_rollup (Linux)
+#   python benchmarks/startup.py --workers 4
+# Results are written as JSON to benchmarks/results/startup-<commit>.json (or --out).
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from storage_backends import make_data, seed_arrow
+
+
+def import_seconds(env, repeat):
+    code = 'import time; start = time.perf_counter(); import application; print(time.perf_counter() - start)'
+    runs = [float(subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, env=env, text=True,
+                                          stderr=subprocess.DEVNULL).split()[-1]) for _ in range(repeat)]
+    return round(statistics.median(runs), 3)
+
+
+def children(pid):
+    # direct children of a process, from the parent pid field of /proc/<pid>/stat
+    found = []
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open(f'/proc/{name}/stat') as fp:
+                    fields = fp.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            if int(fields[1]) == pid:
+                found.append(int(name))
+    return sorted(found)
+
+
+def cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as fp:
+        fields = fp.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')  # utime + stime
+
+
+def wait_idle(pids, quiet=0.5):
+    """
+    :return finished: (float) perf_counter time at which the processes last used CPU, once they have
+        been idle for quiet seconds
+    """
+    used = [cpu_seconds(pid) for pid in pids]
+    finished = last_change = time.perf_counter()
+    while time.perf_counter() - last_change < quiet:
+        time.sleep(0.05)
+        now = [cpu_seconds(pid) for pid in pids]
+        if now != used:
+            used, finished = now, time.perf_counter()
+            last_change = finished
+    return finished
+
+
+def memory_mb(pid):
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as fp:
+        for line in fp:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {'rss': round(values['Rss'], 1), 'pss': round(values['Pss'], 1),
+            'uss': round(values['Private_Clean'] + values['Private_Dirty'], 1)}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def get(url, timeout=60):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read()
+
+
+def run_gunicorn(env, workers, preload, requests, log):
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    command = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+               'application:application']
+    if preload:
+        command.insert(3, '--preload')
+    start = time.perf_counter()
+    master = subprocess.Popen(command, cwd=ROOT, env=dict(env, GUNICORN_PRELOAD='1' if preload else '0'),
+                              stdout=log, stderr=log)
+    try:
+        first = None
+        while first is None:
+            if master.poll() is not None:
+                raise RuntimeError('gunicorn exited, see the log')
+            try:
+                get(base + '/_dash-layout', timeout=1)
+                first = time.perf_counter() - start
+            except OSError:
+                time.sleep(0.05)
+        # every worker has booted once none of them is still busy importing the app
+        while len(children(master.pid)) < workers:
+            time.sleep(0.05)
+        pids = children(master.pid)
+        ready = wait_idle(pids) - start
+        for _ in range(requests):
+            get(base + '/_dash-layout')
+        result = {
+            'preload': preload, 'workers': workers,
+            'first_response_seconds': round(first, 2), 'all_workers_seconds': round(ready, 2),
+            'cpu_seconds': round(cpu_seconds(master.pid) + sum(cpu_seconds(pid) for pid in pids), 2),
+            'master_mb': memory_mb(master.pid),
+            'worker_mb': [memory_mb(pid) for pid in pids],
+        }
+    finally:
+        master.terminate()
+        master.wait()
+    result['worker_pss_total_mb'] = round(sum(val['pss'] for val in result['worker_mb']), 1)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Startup time and per worker memory under gunicorn')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3, help='runs of the import timing')
+    parser.add_argument('--requests', type=int, default=20, help='layout requests before measuring memory')
+    parser.add_argument('--out', help='results file (default: benchmarks/results/startup-<commit>.json)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='airquality-startup-')
+    seed_arrow(make_data(1), directory)
+    env = dict(os.environ, STORAGE_BACKEND='arrow', ARROW_DIR=directory, CACHE_BACKEND='memory',
+               SNAPSHOT_DIR=os.path.join(directory, 'snapshot'), PYTHONDONTWRITEBYTECODE='1')
+
+    results = {'commit': git_commit(), 'import_seconds': import_seconds(env, args.repeat), 'gunicorn': []}
+    print(f"import application: {results['import_seconds']:.2f} s")
+    print(f"{'preload':<9}{'first s':>9}{'all s':>8}{'CPU s':>8}{'master RSS':>12}"
+          f"{'worker RSS':>12}{'PSS':>8}{'USS':>8}{'sum PSS':>9}")
+    with open(os.path.join(directory, 'gunicorn.log'), 'w') as log:
+        for preload in (False, True):
+            run = run_gunicorn(env, args.workers, preload, args.requests, log)
+            results['gunicorn'].append(run)
+            workers = run['worker_mb']
+            print(f"{str(preload):<9}{run['first_response_seconds']:>9.2f}{run['all_workers_seconds']:>8.2f}"
+                  f"{run['cpu_seconds']:>8.2f}{run['master_mb']['rss']:>12.1f}"
+                  f"{statistics.mean(val['rss'] for val in workers):>12.1f}"
+                  f"{statistics.mean(val['pss'] for val in workers):>8.1f}"
+                  f"{statistics.mean(val['uss'] for val in workers):>8.1f}{run['worker_pss_total_mb']:>9.1f}")
+
+    out = args.out or os.path.join(ROOT, 'benchmarks', 'results', f"startup-{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as fp:
+        json.dump(results, fp, indent=1)
+    print('Wrote', out)
@@ -0,0 +1,122 @@
+# Compares the storage backends (storage.py) on the dashboard's query mix: hourly rows for the
+# line chart and the per state summary for the map/histograms, for a few filter combinations.
+# Both backends are seeded with the same synthetic data. The Arrow files go to a temporary
+# directory; PostgreSQL is only benchmarked when a DSN of a scratch database (migrated with
+# data1050/migrate.py, its airquality table is truncated) is given:
+#   python benchmarks/storage_backends.py --years 2
+#   python benchmarks/storage_backends.py --years 2 --dsn "$DSN"
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from berkeley_stub import STATES
+
+SCENARIOS = [
+    ('one state, one week', (('Utah',), '2021-06-01', '2021-06-08')),
+    ('three states, one month', (('Utah', 'Idaho', 'Nevada'), '2021-03-01', '2021-04-01')),
+    ('all states, one month', (tuple(STATES), '2021-03-01', '2021-04-01')),
+    ('all states, full year', (tuple(STATES), '2021-01-01', '2021-12-31')),
+]
+
+
+def make_data(years):
+    """
+    :return df: (dataframe) state, timestamp, pm25, pm10 of every hour from 2021 on
+    """
+    rng = np.random.default_rng(0)
+    stamps = pd.date_range('2021-01-01', periods=24 * int(365.25 * years), freq='h')
+    pm25 = np.round(rng.gamma(2.0, 4.0, len(STATES) * len(stamps)), 1)
+    return pd.DataFrame({'state': np.repeat(STATES, len(stamps)), 'timestamp': np.tile(stamps, len(STATES)),
+                         'pm25': pm25, 'pm10': np.round(pm25 * 1.8 + rng.gamma(2.0, 3.0, len(pm25)), 1)})
+
+
+def seed_arrow(data, directory):
+    from storage import write_partition
+    for (state, year), part in data.groupby([data['state'], data['timestamp'].dt.year]):
+        write_partition(directory, state, year, part)
+
+
+def seed_postgres(data, dsn):
+    """
+    Replace the rows of airquality with data, loaded the way the update Lambda loads new rows (AQI
+    from each state's rolling window, COPY into staging, upsert into the year partitions), so the
+    benchmarks query the same layout as production.
+    """
+    import psycopg2
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data1050'))
+    import aqi
+    import updateDatabase_Lambda as lam
+
+    windows = {state: aqi.RollingWindow() for state in data['state'].unique()}
+    conn = psycopg2.connect(dsn)
+    with conn, conn.cursor() as cur:
+        cur.execute('TRUNCATE airquality, aqi_window')
+        years = data['timestamp'].dt.year
+        # the partitions exist before any row arrives, so none of them lands in airquality_default
+        cur.execute("SELECT create_year_partitions('airquality', %s, %s)", (int(years.min()), int(years.max())))
+        stream = lam.CopyStream(
+            lam.format_state_rows(np.column_stack([part['timestamp'].dt.year, part['timestamp'].dt.month,
+                                                   part['timestamp'].dt.day, part['timestamp'].dt.hour,
+                                                   part['pm25'], part['pm10'], np.zeros(len(part))]).astype(float),
+                                  state, windows[state])
+            for state, part in data.sort_values(['state', 'timestamp']).groupby('state', sort=False))
+        lam.add_to_database(cur, stream)
+        aqi.save_windows(cur, windows)
+        cur.execute('SELECT refresh_airquality_rollups(%s)', (data['timestamp'].min().date(),))
+        cur.execute('ANALYZE airquality')
+    conn.close()
+
+
+def point_pool_at(dsn):
+    # the dashboard's pool (database.py) reads its settings at import, so call this before importing it
+    import psycopg2.extensions
+    params = psycopg2.extensions.parse_dsn(dsn)
+    os.environ.update({'RDS_HOSTNAME': params.get('host', 'localhost'), 'RDS_PORT': params.get('port', '5432'),
+                       'RDS_USERNAME': params.get('user', 'postgres'), 'RDS_PASSWORD': params.get('password', ''),
+                       'RDS_DB_NAME': params.get('dbname', 'postgres')})
+
+
+def timings(fn, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return np.median(seconds) * 1000, np.percentile(seconds, 95) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PostgreSQL vs local Arrow files on the dashboard queries')
+    parser.add_argument('--years', type=int, default=1)
+    parser.add_argument('--dsn', help='scratch PostgreSQL database (skipped if not given)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.dsn:
+        point_pool_at(args.dsn)
+
+    data = make_data(args.years)
+    directory = tempfile.mkdtemp(prefix='airquality-arrow-')
+    seed_arrow(data, directory)
+    if args.dsn:
+        seed_postgres(data, args.dsn)
+    import storage
+    backends = [('arrow', storage.ArrowBackend(directory))]
+    if args.dsn:
+        backends.append(('postgres', storage.PostgresBackend()))
+
+    print(f'{len(data)} rows ({len(STATES)} states, {args.years} years), median / p95 ms over {args.repeat} runs')
+    print(f"{'scenario':<26}{'backend':<10}{'rows':>12}{'load':>18}{'summary':>18}")
+    for name, (state, start_date, end_date) in SCENARIOS:
+        for backend_name, backend in backends:
+            rows = len(backend.load(state, start_date, end_date, 'pm25'))  # also warms the partitions
+            load = timings(lambda: backend.load(state, start_date, end_date, 'pm25'), args.repeat)
+            summary = timings(lambda: backend.summary(state, start_date, end_date, 'pm25'), args.repeat)
+            print(f'{name:<26}{backend_name:<10}{rows:>12}{load[0]:>9.1f} /{load[1]:>6.1f}'
+                  f'{summary[0]:>9.1f} /{summary[1]:>6.1f}')
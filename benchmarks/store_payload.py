@@ -0,0 +1,57 @@
+# Size and serialization time of what apply_filter puts in the data-store, before and after it
+# kept the rows on the server: the raw query rows (one [state, timestamp, value] per hour and
+# state) against the compact handle. Dash encodes callback outputs with PlotlyJSONEncoder, so
+# that is what is timed here, plus the gzipped size as sent over a compressing proxy.
+#   python benchmarks/store_payload.py --days 365 --states 50
+import argparse
+import gzip
+import json
+import timeit
+from datetime import datetime, timedelta
+
+import numpy as np
+from plotly.utils import PlotlyJSONEncoder
+
+STATES = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado',
+          'Connecticut', 'Delaware', 'Florida', 'Georgia', 'Hawaii', 'Idaho',
+          'Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky', 'Louisiana', 'Maine',
+          'Maryland', 'Massachusetts', 'Michigan', 'Minnesota', 'Mississippi',
+          'Missouri', 'Montana', 'Nebraska', 'Nevada', 'New Hampshire',
+          'New Jersey', 'New Mexico', 'New York', 'North Carolina', 'North Dakota',
+          'Ohio', 'Oklahoma', 'Oregon', 'Pennsylvania', 'Rhode Island',
+          'South Carolina', 'South Dakota', 'Tennessee', 'Texas', 'Utah', 'Vermont',
+          'Virginia', 'Washington', 'West Virginia', 'Wisconsin', 'Wyoming']
+
+
+def query_rows(states, days):
+    # the rows query_database returns for the filters: (state, timestamp, pm25) tuples
+    rng = np.random.default_rng(0)
+    start = datetime(2021, 1, 1)
+    stamps = [start + timedelta(hours=hour) for hour in range(24 * days)]
+    return [(state, stamp, float(value)) for state in states
+            for stamp, value in zip(stamps, np.round(rng.gamma(2.0, 4.0, len(stamps)), 1))]
+
+
+def measure(value, repeat):
+    encoded = json.dumps(value, cls=PlotlyJSONEncoder)
+    seconds = min(timeit.repeat(lambda: json.dumps(value, cls=PlotlyJSONEncoder), number=1, repeat=repeat))
+    return len(encoded), len(gzip.compress(encoded.encode())), seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='data-store payload of raw rows vs handle')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--states', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    states = STATES[:args.states]
+    rows = query_rows(states, args.days)
+    handle = {'key': 'f' * 40, 'start_date': '2021-01-01', 'end_date': '2021-12-31', 'particulate': 'pm25',
+              'states': states if len(states) < len(STATES) else None, 'aggregate': 'median', 'values': len(rows)}
+
+    print(f'{len(rows)} rows ({args.states} states, {args.days} days)')
+    print(f"{'store':<14}{'bytes':>14}{'gzip bytes':>14}{'encode ms':>12}")
+    for name, value in (('raw rows', rows), ('handle', handle)):
+        size, gz_size, seconds = measure(value, args.repeat)
+        print(f'{name:<14}{size:>14}{gz_size:>14}{seconds * 1000:>12.2f}')
@@ -0,0 +1,93 @@
+# Checks and benchmarks the update Lambda's streaming parser (parse_stream) against the previous
+# path, which wrote res.text.replace(' ', '') to /tmp and read it back with np.loadtxt.
+#  1. the fixtures in benchmarks/fixtures must parse to identical arrays, for any chunking and any
+#     latest_datetime cut-off. They are synthetic files in the Berkeley Earth format (not recorded
+#     downloads): Utah.txt a plain stretch of hours, edge_cases.txt the comments, blank lines,
+#     padding and missing values the parser has to handle;
+#  2. peak Python memory and time of scraping one large, equally synthetic, state file from the
+#     local stand-in (berkeley_stub.py), so the timings are of the parser, not of a real file.
+#   python benchmarks/streaming_parse.py --hours 26280 --new 12
+import argparse
+import glob
+import io
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data1050'))
+from berkeley_stub import start_server
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def previous_parse(text):
+    # what scrape_data did before (minus the /tmp round-trip, which does not change the result)
+    return np.loadtxt(io.StringIO(text.replace(' ', '')), comments='%', ndmin=2)
+
+
+def line_chunks(body, size):
+    # line aligned chunks of about `size` bytes, as berkeley.Download.iter_chunks yields them
+    start = 0
+    while start < len(body):
+        end = body.rfind(b'\n', start, start + size) + 1 or body.find(b'\n', start) + 1 or len(body)
+        yield body[start:end]
+        start = end
+
+
+def check_fixtures(lam):
+    for path in sorted(glob.glob(os.path.join(FIXTURES, '*.txt'))):
+        with open(path, 'rb') as fp:
+            body = fp.read()
+        expected = previous_parse(body.decode('latin-1'))
+        stamps = lam.make_datetime_array(expected)
+        cutoffs = [None] + [stamp.astype(datetime) for stamp in stamps[::max(1, len(stamps) // 7)]]
+        for size in (1, 64, 4096, len(body)):
+            for cutoff in cutoffs:
+                reference = expected if cutoff is None else expected[stamps > np.datetime64(cutoff, 'h')]
+                parsed = lam.parse_stream(line_chunks(body, size), cutoff)
+                assert np.array_equal(parsed, reference, equal_nan=True), (path, size, cutoff)
+        print(f'{os.path.basename(path)}: {len(expected)} rows identical')
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Streaming parser check and memory benchmark')
+    parser.add_argument('--hours', type=int, default=24 * 365 * 3, help='hourly rows in the benchmark file')
+    parser.add_argument('--new', type=int, default=12, help='rows newer than the latest database hour')
+    args = parser.parse_args()
+
+    server, base_url = start_server(hours=args.hours, states=['Utah'])
+    os.environ['BERKELEY_EARTH_URL'] = base_url
+    import updateDatabase_Lambda as lam
+
+    check_fixtures(lam)
+
+    latest = datetime(2021, 1, 1) + timedelta(hours=args.hours - args.new - 1)
+    url = lam.berkeley.state_url('Utah')
+
+    def previous():
+        data = previous_parse(lam.berkeley.fetch_text(url))
+        return data[lam.make_datetime_array(data) > np.datetime64(latest, 'h')]
+
+    old, old_seconds, old_peak = measure(previous)
+    (_, new, _), new_seconds, new_peak = measure(lambda: lam.scrape_data('Utah', None, latest))
+    server.shutdown()
+    assert np.array_equal(old, new, equal_nan=True)
+
+    print(f'full download of {args.hours} rows, {len(new)} new')
+    print(f"{'previous (text + loadtxt)':<28}{old_seconds * 1000:>10.1f} ms{old_peak / 2 ** 20:>10.1f} MiB peak")
+    print(f"{'streaming parse_stream':<28}{new_seconds * 1000:>10.1f} ms{new_peak / 2 ** 20:>10.1f} MiB peak")
@@ -0,0 +1,248 @@
+# Server-side result cache for the dashboard callbacks.
+# The data only changes when the update Lambda runs (twice a day), so the result of a filter
+# combination (query rows, DataFrame and figures) stays valid until the next ingest. Entries are
+# keyed on the normalized filter parameters and the newest hour in storage (the data version, which
+# is itself only cached for version_ttl seconds), so results are recomputed as soon as a run lands
+# however late it finishes; expiry at the next scheduled ingest only bounds their lifetime. The cache
+# is LRU bounded and can live in this process (memory), in a directory shared by all gunicorn
+# workers on the host (filesystem) or in Redis.
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+cache_settings = {
+    'backend': os.environ.get('CACHE_BACKEND', 'filesystem'),  # memory, filesystem or redis
+    'max_entries': int(os.environ.get('CACHE_MAX_ENTRIES', 256)),
+    # writes between two eviction sweeps of the filesystem backend (per process)
+    'evict_every': int(os.environ.get('CACHE_EVICT_EVERY', 32)),
+    'directory': os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'airquality-cache')),
+    'redis_url': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+    # UTC hours at which the EventBridge rule runs the update Lambda, and how long a run takes
+    'ingest_hours_utc': tuple(int(hour) for hour in os.environ.get('INGEST_HOURS_UTC', '0,12').split(',')),
+    'ingest_grace_minutes': int(os.environ.get('INGEST_GRACE_MINUTES', 15)),
+    # seconds the newest hour in storage is cached before it is read again
+    'version_ttl': int(os.environ.get('CACHE_VERSION_TTL', 60)),
+}
+
+
+def seconds_until_next_ingest(now=None):
+    """
+    :param now: (datetime) current UTC time (defaults to now)
+    :return seconds: (float) time until the next scheduled ingest has finished
+    """
+    now = now or datetime.now(timezone.utc)
+    grace = timedelta(minutes=cache_settings['ingest_grace_minutes'])
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    candidates = [midnight + timedelta(days=day, hours=hour) + grace
+                  for day in (0, 1) for hour in cache_settings['ingest_hours_utc']]
+    return min(candidate for candidate in candidates if candidate > now).timestamp() - now.timestamp()
+
+
+def cache_key(*parts):
+    """
+    :param parts: normalized, hashable parameters (e.g. dates, particulate, sorted states, aggregate)
+    :return key: (str) stable key for the parameters
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+class MemoryBackend:
+    """LRU dictionary private to this process."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileSystemBackend:
+    """
+    One pickle per entry in a directory shared by every worker; file mtimes track recent use. The
+    directory is swept every evict_every writes of a process rather than on each write, so it may
+    briefly hold up to evict_every entries per worker over max_entries.
+    """
+
+    def __init__(self, directory, max_entries, evict_every=32):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.evict_every = max(1, evict_every)
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fp:
+                expires_at, value = pickle.load(fp)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires_at < time.time():
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value, ttl):
+        # write to a temporary file and rename, so other workers never read a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump((time.time() + ttl, value), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self._writes += 1
+            sweep = self._writes % self.evict_every == 0
+        if sweep:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                try:
+                    entries.append((os.path.getmtime(os.path.join(self.directory, name)), name))
+                except OSError:
+                    pass
+        entries.sort()
+        for _, name in entries[:max(0, len(entries) - self.max_entries)]:
+            self._remove(os.path.join(self.directory, name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                self._remove(os.path.join(self.directory, name))
+
+
+class RedisBackend:
+    """
+    Entries in Redis with a TTL, shared by every worker and host. The LRU bound is Redis' own:
+    run it with maxmemory and maxmemory-policy allkeys-lru (e.g. redis-server --maxmemory 64mb
+    --maxmemory-policy allkeys-lru for a local stand-in).
+    """
+
+    prefix = 'airquality:cache:'
+
+    def __init__(self, url):
+        import redis  # optional dependency, only needed for this backend
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        payload = self._client.get(self.prefix + key)
+        return pickle.loads(payload) if payload is not None else None
+
+    def set(self, key, value, ttl):
+        self._client.set(self.prefix + key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+                         ex=max(1, int(ttl)))
+
+    def clear(self):
+        for key in self._client.scan_iter(self.prefix + '*'):
+            self._client.delete(key)
+
+
+class ResultCache:
+    """Cache front end: expiry at the next ingest and hit/miss counters (per process)."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'sets': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def get(self, key):
+        """
+        :param key: (str) key from cache_key
+        :return value: cached value or None
+        """
+        try:
+            value = self.backend.get(key)
+        except Exception:
+            # a broken cache must never break the dashboard
+            self._count('errors')
+            value = None
+        self._count('hits' if value is not None else 'misses')
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        :param key: (str) key from cache_key
+        :param value: picklable value
+        :param ttl: (float) seconds to keep the value (defaults to the time until the next ingest)
+        """
+        try:
+            self.backend.set(key, value, ttl if ttl is not None else seconds_until_next_ingest())
+            self._count('sets')
+        except Exception:
+            self._count('errors')
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        """
+        :return stats: (dict) hit/miss counters of this process and the backend in use
+        """
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        stats['backend'] = type(self.backend).__name__
+        return stats
+
+
+def make_backend(settings=cache_settings):
+    """
+    :param settings: (dict) cache settings
+    :return backend: configured cache backend
+    """
+    if settings['backend'] == 'redis':
+        return RedisBackend(settings['redis_url'])
+    if settings['backend'] == 'memory':
+        return MemoryBackend(settings['max_entries'])
+    return FileSystemBackend(settings['directory'], settings['max_entries'], settings['evict_every'])
+
+
+result_cache = ResultCache(make_backend())
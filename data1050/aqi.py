@@ -0,0 +1,215 @@
+# EPA Air Quality Index of each hour, computed at ingest from the hourly PM2.5/PM10 values.
+# The AQI of an hour is the larger of the PM2.5 and PM10 sub-indices of their averages over the
+# 24 hours ending at that hour (EPA breakpoints as revised in 2024; an average needs at least 18
+# of the 24 hours). Each state keeps a rolling window of its last 24 hourly values
+# (RollingWindow), persisted in the aqi_window table (006_aqi.sql) in the same transaction as the
+# rows, so a run only ever looks at its new rows. Shared by the update Lambda (packaged with the
+# .zip file, like berkeley.py) and etl_initial.py; `python data1050/aqi.py` computes the AQI of
+# the rows that are already in the database.
+import argparse
+import io
+import time
+from datetime import timedelta
+
+import numpy as np
+
+WINDOW_HOURS = 24
+MIN_HOURS = 18  # hours with a value needed for a valid 24 hour average
+
+# (concentration low, concentration high, index low, index high) of each category, in ug/m3
+BREAKPOINTS = {
+    'pm25': ((0.0, 9.0, 0, 50), (9.1, 35.4, 51, 100), (35.5, 55.4, 101, 150), (55.5, 125.4, 151, 200),
+             (125.5, 225.4, 201, 300), (225.5, 325.4, 301, 500)),
+    'pm10': ((0, 54, 0, 50), (55, 154, 51, 100), (155, 254, 101, 150), (255, 354, 151, 200),
+             (355, 424, 201, 300), (425, 604, 301, 500)),
+}
+# averages are truncated to this many decimals before the lookup
+DECIMALS = {'pm25': 1, 'pm10': 0}
+CATEGORIES = ('Good', 'Moderate', 'Unhealthy for Sensitive Groups', 'Unhealthy', 'Very Unhealthy', 'Hazardous')
+
+
+def sub_index(average, pollutant):
+    """
+    :param average: (array) 24 hour average concentrations (NaN where there is none)
+    :param pollutant: (str) 'pm25' or 'pm10'
+    :return index: (array) AQI sub-index of each average (NaN where there is none), at most 500
+    """
+    scale = 10 ** DECIMALS[pollutant]
+    average = np.asarray(average, dtype=float)
+    missing = np.isnan(average)
+    truncated = np.floor(np.clip(np.where(missing, 0.0, average), 0, None) * scale + 1e-9) / scale
+    table = np.array(BREAKPOINTS[pollutant], dtype=float)
+    row = table[np.searchsorted(table[:, 0], truncated, side='right') - 1]
+    low_c, high_c, low_i, high_i = row.T
+    index = np.round((high_i - low_i) / (high_c - low_c) * (np.minimum(truncated, high_c) - low_c) + low_i)
+    return np.where(missing, np.nan, index)
+
+
+def category(index):
+    """
+    :param index: (array) AQI values (NaN where there is none)
+    :return category: (array) position in CATEGORIES of each value, -1 where there is none
+    """
+    index = np.asarray(index, dtype=float)
+    found = np.searchsorted([50, 100, 150, 200, 300], np.where(np.isnan(index), 0, index), side='left')
+    return np.where(np.isnan(index), -1, found).astype(np.int8)
+
+
+class RollingWindow:
+    """Last WINDOW_HOURS hourly PM2.5 and PM10 values of one state, ending at last_hour."""
+
+    def __init__(self, last_hour=None, pm25=None, pm10=None):
+        """
+        :param last_hour: (datetime64[h]) newest hour of the window (None for an empty window)
+        :param pm25: (list) WINDOW_HOURS values, oldest first (NaN for hours without a value)
+        :param pm10: (list) WINDOW_HOURS values, oldest first
+        """
+        self.last_hour = None if last_hour is None else np.datetime64(last_hour, 'h')
+        self.values = {name: np.full(WINDOW_HOURS, np.nan) if values is None else np.asarray(values, dtype=float)
+                       for name, values in (('pm25', pm25), ('pm10', pm10))}
+
+    def update(self, hours, pm25, pm10):
+        """
+        Add the new hours to the window.
+        :param hours: (array) datetime64[h] of the new rows, ascending and after last_hour
+        :param pm25: (array) PM2.5 of each new row
+        :param pm10: (array) PM10 of each new row
+        :return aqi, category: (array, array) AQI (NaN without enough data) and category (-1 without)
+            of each new row
+        """
+        if len(hours) == 0:
+            return np.empty(0), np.empty(0, dtype=np.int8)
+        hours = np.asarray(hours, dtype='datetime64[h]')
+        # a dense hourly grid from 23 hours before the first new row to the last one, so that every
+        # new row has its whole window on the grid; its size follows the new rows, not the history
+        start = hours[0] - (WINDOW_HOURS - 1)
+        size = int((hours[-1] - start).astype(int)) + 1
+        positions = (hours - start).astype(int)
+        averages = {}
+        for name, new_values in (('pm25', pm25), ('pm10', pm10)):
+            grid = np.full(size, np.nan)
+            if self.last_hour is not None:
+                previous = np.arange(WINDOW_HOURS) + int((self.last_hour - start).astype(int)) - (WINDOW_HOURS - 1)
+                keep = (previous >= 0) & (previous < size)
+                grid[previous[keep]] = self.values[name][keep]
+            grid[positions] = new_values
+            # running sums: the 24 hour sum and count at j is the difference of two prefix sums
+            sums = np.concatenate(([0.0], np.cumsum(np.nan_to_num(grid))))
+            counts = np.concatenate(([0], np.cumsum(~np.isnan(grid))))
+            total = sums[positions + 1] - sums[positions + 1 - WINDOW_HOURS]
+            count = counts[positions + 1] - counts[positions + 1 - WINDOW_HOURS]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                averages[name] = np.where(count >= MIN_HOURS, total / count, np.nan)
+            self.values[name] = grid[size - WINDOW_HOURS:]
+        self.last_hour = hours[-1]
+        aqi = np.fmax(sub_index(averages['pm25'], 'pm25'), sub_index(averages['pm10'], 'pm10'))
+        return aqi, category(aqi)
+
+
+def load_windows(cur, states):
+    """
+    :param cur: (cursor) database cursor
+    :param states: (list) states to load
+    :return windows: (dict) state -> RollingWindow (empty for states without a stored window)
+    """
+    windows = {state: RollingWindow() for state in states}
+    cur.execute('SELECT state, last_hour, pm25, pm10 FROM aqi_window WHERE state IN %s', (tuple(states),))
+    for state, last_hour, pm25, pm10 in cur.fetchall():
+        windows[state] = RollingWindow(last_hour, pm25, pm10)
+    return windows
+
+
+def save_windows(cur, windows):
+    """
+    :param cur: (cursor) database cursor (the caller commits, together with the rows)
+    :param windows: (dict) state -> RollingWindow
+    """
+    for state, window in windows.items():
+        if window.last_hour is None:
+            continue
+        cur.execute("""INSERT INTO aqi_window (state, last_hour, pm25, pm10) VALUES (%s, %s, %s, %s)
+        ON CONFLICT (state) DO UPDATE SET last_hour = EXCLUDED.last_hour, pm25 = EXCLUDED.pm25, pm10 = EXCLUDED.pm10""",
+                    (state, window.last_hour.astype(object), window.values['pm25'].tolist(),
+                     window.values['pm10'].tolist()))
+
+
+def window_at(cur, state, last_hour):
+    """
+    :param cur: (cursor) database cursor
+    :param state: (str) state
+    :param last_hour: (datetime) newest hour of the window (None for an empty window)
+    :return window: (RollingWindow) window of the state's rows in airquality up to last_hour, e.g. to
+        resume from an hour older than its stored window
+    """
+    window = RollingWindow()
+    if last_hour is None:
+        return window
+    first_hour = last_hour - timedelta(hours=WINDOW_HOURS - 1)
+    cur.execute("""SELECT timestamp, COALESCE(pm25, 'NaN'), COALESCE(pm10, 'NaN') FROM airquality
+    WHERE state = %s AND year BETWEEN %s AND %s AND timestamp BETWEEN %s AND %s ORDER BY timestamp""",
+                (state, first_hour.year, last_hour.year, first_hour, last_hour))
+    rows = cur.fetchall()
+    if rows:
+        window.update(np.array([row[0] for row in rows], dtype='datetime64[h]'),
+                      np.array([row[1] for row in rows], dtype=float), np.array([row[2] for row in rows], dtype=float))
+    return window
+
+
+def backfill_state(cur, state):
+    """
+    Compute the AQI of every row of a state already in airquality, and store its window.
+    :param cur: (cursor) database cursor (the caller commits)
+    :param state: (str) state
+    :return rows: (int) rows updated
+    """
+    cur.execute("""SELECT timestamp, COALESCE(pm25, 'NaN'), COALESCE(pm10, 'NaN') FROM airquality
+    WHERE state = %s ORDER BY timestamp""", (state,))
+    rows = cur.fetchall()
+    if not rows:
+        return 0
+    hours = np.array([row[0] for row in rows], dtype='datetime64[h]')
+    window = RollingWindow()
+    aqi, categories = window.update(hours, np.array([row[1] for row in rows], dtype=float),
+                                    np.array([row[2] for row in rows], dtype=float))
+    cur.execute('CREATE TEMP TABLE aqi_staging (timestamp timestamp, aqi real, aqi_category smallint) ON COMMIT DROP')
+    # one COPY for the state's whole history; hours without an AQI are NULL (\N), as the Lambda writes them
+    lines = []
+    for hour, value, code in zip(hours.astype(object), aqi.tolist(), categories.tolist()):
+        index = '\\N\t\\N' if code < 0 else f'{value:g}\t{code}'
+        lines.append(f'{hour}\t{index}\n')
+    cur.copy_expert('COPY aqi_staging (timestamp, aqi, aqi_category) FROM STDIN', io.StringIO(''.join(lines)))
+    cur.execute("""UPDATE airquality a SET aqi = s.aqi, aqi_category = s.aqi_category
+    FROM aqi_staging s WHERE a.state = %s AND a.timestamp = s.timestamp""", (state,))
+    updated = cur.rowcount
+    cur.execute('DROP TABLE aqi_staging')
+    save_windows(cur, {state: window})
+    return updated
+
+
+if __name__ == '__main__':
+    import psycopg2
+    from migrate import default_dsn
+
+    parser = argparse.ArgumentParser(description='Compute the AQI of the rows already in airquality')
+    parser.add_argument('--dsn', default=default_dsn(), help='libpq connection string')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    start = time.time()
+    total = 0
+    with conn.cursor() as cur:
+        cur.execute('SELECT DISTINCT state FROM airquality ORDER BY state')
+        states = [state for state, in cur.fetchall()]
+        cur.execute('SELECT min(timestamp) FROM airquality')
+        (first,), = cur.fetchall()
+    for state in states:
+        with conn.cursor() as cur:
+            total += backfill_state(cur, state)
+        conn.commit()  # one state at a time
+        print(state)
+    if first is not None:
+        with conn.cursor() as cur:
+            cur.execute('SELECT refresh_airquality_rollups(%s)', (first.date(),))
+        conn.commit()
+    conn.close()
+    print(f'{total} rows updated in {time.time() - start:.1f} s')
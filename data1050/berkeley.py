@@ -0,0 +1,234 @@
+# Downloading the Berkeley Earth per-state air quality files.
+# Shared by the update Lambda and the initial ETL. The files only ever grow by a few hourly
+# lines at the end, so after the first download a fetch sends the stored ETag/Last-Modified
+# (the server answers 304 if nothing changed) together with a Range request for the bytes
+# after the last known length. A few bytes of overlap (the previous last line) are requested
+# as well and compared, so a file that was rewritten rather than appended is detected and
+# downloaded again in full, as is any server that ignores or rejects the Range header.
+# Bodies can be consumed as a stream of line-aligned chunks (open_incremental) so callers
+# never need to hold a whole file in memory.
+import itertools
+import os
+import threading
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import requests # add layer by arn: arn:aws:lambda:us-west-1:770693421928:layer:Klayers-python38-requests:26
+from requests.adapters import HTTPAdapter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+# Overridable to point at a local stand-in, see benchmarks/berkeley_stub.py
+BASE_URL = os.environ.get('BERKELEY_EARTH_URL', 'http://berkeleyearth.lbl.gov/air-quality/maps/cities/United_States')
+
+# Simultaneous requests per host and attempts per file
+MAX_PER_HOST = int(os.environ.get('SCRAPE_MAX_PER_HOST', 8))
+MAX_ATTEMPTS = int(os.environ.get('SCRAPE_MAX_ATTEMPTS', 4))
+
+# Bytes read from the connection at a time
+CHUNK_SIZE = 64 * 1024
+
+# Bytes at the end of the previous download that are fetched again to check the file was only appended to
+TAIL_BYTES = 256
+
+# One keep-alive session shared by all fetch threads (and by warm Lambda invocations)
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=MAX_PER_HOST))
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=MAX_PER_HOST))
+
+_host_limits = defaultdict(lambda: threading.BoundedSemaphore(MAX_PER_HOST))
+_host_limits_lock = threading.Lock()
+
+
+def state_url(state):
+    """
+    :param state: (str) state name as used by Berkeley Earth (e.g. 'New_York')
+    :return url: (str) url of the state's hourly data file
+    """
+    return f'{BASE_URL}/{state}/{state}.txt'
+
+
+def city_url(state, city):
+    """
+    :param state: (str) state name as used by Berkeley Earth (e.g. 'New_York')
+    :param city: (str) city name as used by Berkeley Earth (e.g. 'New_York_City')
+    :return url: (str) url of the city's hourly data file (in the state's directory of the same tree)
+    """
+    return f'{BASE_URL}/{state}/{city}/{city}.txt'
+
+
+def _is_retryable(exception):
+    # connection problems, timeouts and server side errors are worth another attempt; 404s are not
+    if isinstance(exception, requests.HTTPError):
+        return exception.response is not None and (exception.response.status_code >= 500 or
+                                                   exception.response.status_code == 429)
+    return isinstance(exception, (requests.ConnectionError, requests.Timeout))
+
+
+def _host_limit(url):
+    with _host_limits_lock:
+        return _host_limits[urlparse(url).netloc]
+
+
+@retry(retry=retry_if_exception(_is_retryable), stop=stop_after_attempt(MAX_ATTEMPTS),
+       wait=wait_exponential(multiplier=0.5, max=8), reraise=True)
+def _request(url, headers=None):
+    # the body is left unread (stream=True); the caller closes the response
+    res = session.get(url, headers=headers, timeout=(5, 60), stream=True)
+    if res.status_code >= 400:
+        res.close()
+        res.raise_for_status()
+    return res
+
+
+def get(url, headers=None):
+    """
+    :param url: (str) url to download
+    :param headers: (dict) extra request headers
+    :return res: (Response) response with any status below 400 (the body is fully read)
+    """
+    with _host_limit(url):
+        res = _request(url, headers)
+        res.content  # read the body while holding the host slot
+    return res
+
+
+def fetch_text(url):
+    """
+    :param url: (str) url to download
+    :return text: (str) response body
+    """
+    return get(url).text
+
+
+class Download:
+    """
+    Body of a (full or partial) download of a state file, read as a stream of chunks that each
+    end on a line boundary. The host slot and the connection are held until the body has been
+    consumed or close() is called; the metadata for the next fetch is complete after that.
+    """
+
+    def __init__(self, status, url, res=None, chunks=None, pending=b'', content_length=0, tail=b'', metadata=None):
+        self.status = status  # 'unchanged', 'appended' or 'full'
+        self.url = url
+        self.metadata = metadata
+        self._res = res
+        self._chunks = chunks
+        self._pending = pending
+        self._content_length = content_length
+        self._tail = tail
+
+    def iter_chunks(self):
+        """
+        :return: generator of bytes chunks holding complete lines (a trailing partial line is left for the next fetch)
+        """
+        length, tail, pending = self._content_length, self._tail, b''
+        try:
+            # bytes already read past the overlap check come first
+            for chunk in itertools.chain([self._pending], self._chunks or ()):
+                data = pending + chunk
+                end = data.rfind(b'\n') + 1
+                pending = data[end:]
+                if end:
+                    length += end
+                    tail = (tail + data[:end])[-TAIL_BYTES:]
+                    yield data[:end]
+        finally:
+            self.close()
+        if self._res is not None:
+            self.metadata = {
+                'etag': self._res.headers.get('ETag'),
+                'last_modified': self._res.headers.get('Last-Modified'),
+                'content_length': length,
+                'tail': tail.decode('latin-1'),
+            }
+
+    def read(self):
+        """
+        :return text: (str) the complete lines of the body
+        """
+        return b''.join(self.iter_chunks()).decode('latin-1')
+
+    def close(self):
+        """Release the connection and the host slot (safe to call more than once)."""
+        if self._chunks is not None:
+            self._chunks = None
+            self._res.close()
+            _host_limit(self.url).release()
+
+
+def _open(url, headers=None):
+    limit = _host_limit(url)
+    limit.acquire()
+    try:
+        res = _request(url, headers)
+    except Exception:
+        limit.release()
+        raise
+    return res, res.iter_content(CHUNK_SIZE)
+
+
+def _whole_file(url, res=None, chunks=None):
+    if res is None:
+        res, chunks = _open(url)
+    return Download('full', url, res, chunks)
+
+
+def open_incremental(url, metadata=None):
+    """
+    :param url: (str) url of the file
+    :param metadata: (dict) metadata of the previous fetch of this url (None for a first download)
+    :return download: (Download) status 'unchanged' (empty body), 'appended' (only the lines added since
+        the previous fetch) or 'full' (the whole file); download.metadata is to be stored and passed to the
+        next call once the body has been read
+    """
+    if not metadata or not metadata.get('content_length'):
+        return _whole_file(url)
+
+    tail = metadata.get('tail', '').encode('latin-1')
+    offset = metadata['content_length'] - len(tail)
+    headers = {'Range': f'bytes={offset}-', 'Accept-Encoding': 'identity'}
+    if metadata.get('etag'):
+        headers['If-None-Match'] = metadata['etag']
+    if metadata.get('last_modified'):
+        headers['If-Modified-Since'] = metadata['last_modified']
+
+    try:
+        res, chunks = _open(url, headers)
+    except requests.HTTPError as exc:
+        if exc.response is not None and exc.response.status_code == 416:
+            # the file is shorter than before, i.e. it was replaced
+            return _whole_file(url)
+        raise
+
+    download = Download('appended', url, res, chunks, content_length=offset + len(tail), tail=tail)
+    if res.status_code == 304:
+        download.close()
+        return Download('unchanged', url, metadata=metadata)
+    if res.status_code != 206:
+        # the server ignored the Range header and sent the whole file
+        return _whole_file(url, res, chunks)
+
+    # the overlap has to match what was downloaded last time, otherwise this was not a plain append
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= len(tail):
+            break
+    if not head.startswith(tail):
+        download.close()
+        return _whole_file(url)
+    download._pending = head[len(tail):]
+    return download
+
+
+def fetch_incremental(url, metadata=None):
+    """
+    :param url: (str) url of the file
+    :param metadata: (dict) metadata returned by the previous fetch of this url (None for a first download)
+    :return status, text, metadata: (str, str, dict) status is 'unchanged' (text is empty), 'appended'
+        (text holds only the lines added since the previous fetch) or 'full' (text is the whole file);
+        metadata is to be stored and passed to the next call
+    """
+    download = open_incremental(url, metadata)
+    text = download.read()
+    return download.status, text, download.metadata
@@ -1,29 +1,20 @@
-import psycopg2
+import os
+import sys
 import pandas as pd
 from pandas_profiling import ProfileReport
 
+# share the dashboard's connection pool (database.py lives in the repository root)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import database
 
-def query_database(query):
-    rds_host = "airquality.ce6w097amgsa.us-west-1.rds.amazonaws.com"
-    name = "postgres"
-    password = "L2PnKR!&M2eGL5"
-    db_name = "postgres"
-
-    conn = psycopg2.connect(host=rds_host,
-                            database=db_name,
-                            user=name,
-                            password=password)
-    cur = conn.cursor()
-    cur.execute(query)
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
 
+def query_database(query):
+    rows = database.query_database(query)
     return pd.DataFrame(rows)
 
 
-query = f"""SELECT state, make_timestamp(CAST(year AS int), CAST(month AS int), CAST(day AS int), CAST(utc_hour AS int), 0, CAST(0.0 AS double precision)), pm25, pm10 FROM airquality
-    WHERE year = 2021"""
+query = f"""SELECT state, timestamp, pm25, pm10 FROM airquality
+    WHERE timestamp >= '2021-01-01' AND timestamp < '2022-01-01'"""
 data = query_database(query)
 data.columns = ['state', 'date', 'pm2.5', 'pm10']
 profile = ProfileReport(data)
@@ -3,18 +3,112 @@
 # the 50 states and scrape the data from berkeley earth and compile the data into
 # on dataframe. Then, I used pgAdmin4 (for PostgreSQL) to upload a CSV into a database
 # which is hosted on AWS RDS.
+# Downloads are kept in data1050/cache so reruns only fetch what was appended since (see berkeley.py).
+# The whole history is kept by default (airquality is partitioned by year, see
+# migrations/005_partition_by_year.sql); --since-year limits it, e.g. for a small DB instance.
+# City files (--city New_York/New_York_City) are registered in the city table, so the update
+# Lambda keeps them current, and written to a second CSV for airquality_city.
+#
+# `etl_initial.py --backfill db` loads the states straight into the database (`--dsn`), and
+# `etl_initial.py --backfill arrow [--arrow-dir DIR]` into the local Arrow files of storage.py
+# (ARROW_DIR by default), instead of a CSV: files are fetched concurrently and parsed as they
+# stream in (the update Lambda's parser), and each state is written in its own transaction with COPY.
+# A checkpoint file records the last hour written per state, so an interrupted backfill resumes
+# where it stopped, and the first day written but not yet refreshed in the rollups, so a rerun
+# still refreshes them when the previous run stopped after the last state. Only a few states are in memory at a time. The AQI of every hour is computed
+# on the way (see aqi.py), continuing from each state's stored window when resuming (rebuilt from
+# the rows before the resume point when the stored window is newer).
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+import numpy as np
 import pandas as pd
+import psycopg2
+import aqi
+import berkeley
+import updateDatabase_Lambda as lam
+from migrate import default_dsn
+
+# the Arrow writer and settings of the dashboard (storage.py lives in the repository root)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+# checkpoint entry holding the first day the rollups still have to be refreshed from (not a state)
+REFRESH_FROM = 'refresh_from'
+
+
+def download_state_file(state):
+    """
+    :param state: (str) state name
+    :return fp: (str) path of the up to date local copy of the state's file
+    """
+    return download_file(berkeley.state_url(state), state)
+
+
+def download_file(url, name):
+    """
+    :param url: (str) Berkeley Earth file
+    :param name: (str) name of the local copy in CACHE_DIR
+    :return fp: (str) path of the up to date local copy of the file
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    text_fp = os.path.join(CACHE_DIR, f'{name}.txt')
+    meta_fp = os.path.join(CACHE_DIR, f'{name}.json')
+    metadata = None
+    if os.path.exists(text_fp) and os.path.exists(meta_fp):
+        with open(meta_fp) as fp:
+            metadata = json.load(fp)
+
+    status, text, metadata = berkeley.fetch_incremental(url, metadata)
+    if status != 'unchanged':
+        with open(text_fp, 'w' if status == 'full' else 'a', encoding='latin-1', newline='') as fp:
+            fp.write(text)
+        with open(meta_fp, 'w') as fp:
+            json.dump(metadata, fp)
+    return text_fp
+
+
+def read_file(fp):
+    data = pd.read_csv(fp, skiprows=8, delimiter='\t', header=None)
+    data.columns = ['year', 'month', 'day', 'utc_hour', 'pm25', 'pm10', 'retrospective']
+    return data.drop(columns=['retrospective'])
 
 
 def get_state_data(state):
-    url = f'http://berkeleyearth.lbl.gov/air-quality/maps/cities/United_States/{state}/{state}.txt'
-    state_data = pd.read_csv(url, skiprows=8, delimiter='\t', header=None)
-    state_data.columns = ['year', 'month', 'day', 'utc_hour', 'pm25', 'pm10', 'retrospective']
+    state_data = read_file(download_state_file(state))
     state_data['state'] = state
-    state_data = state_data.drop(columns=['retrospective'])
     return state_data
 
 
+def get_city_data(state, city, city_id):
+    city_data = read_file(download_file(berkeley.city_url(state, city), f'{state}__{city}'))
+    city_data['city_id'] = city_id
+    return city_data
+
+
+def register_cities(dsn, cities):
+    """
+    :param dsn: (str) libpq connection string
+    :param cities: (list) (state, city) pairs
+    :return ids: (dict) (state, city) -> id in the city table (added if missing)
+    """
+    conn = psycopg2.connect(dsn)
+    ids = {}
+    with conn, conn.cursor() as cur:
+        for state, city in cities:
+            cur.execute("""INSERT INTO city (state, name) VALUES (%s, %s)
+            ON CONFLICT (state, name) DO UPDATE SET name = EXCLUDED.name RETURNING id""", (state, city))
+            ids[(state, city)] = cur.fetchone()[0]
+    conn.close()
+    return ids
+
+
 states = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado',
           'Connecticut', 'Delaware', 'Florida', 'Georgia', 'Hawaii', 'Idaho',
           'Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky', 'Louisiana', 'Maine',
@@ -25,12 +119,269 @@ states = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado',
           'South_Carolina', 'South_Dakota', 'Tennessee', 'Texas', 'Utah', 'Vermont',
           'Virginia', 'Washington', 'West_Virginia', 'Wisconsin', 'Wyoming']
 
-all_data = pd.DataFrame()
-for state in states:
-    print(state)
-    state_data = get_state_data(state)
-    state_data = state_data.loc[state_data['year'] >= 2021] # change to any year -- only 2021 for small DB instance
-    all_data = pd.concat([all_data, state_data])
+COPY_CHUNK_ROWS = 100000
+
+
+def to_columns(data, state):
+    """
+    :param data: (array) parsed rows of a state file (see updateDatabase_Lambda.parse_stream)
+    :param state: (str) state the rows belong to
+    :return df: (dataframe) typed columns of updateDatabase_Lambda.COLUMNS but the AQI (see add_aqi),
+        plus timestamp
+    """
+    return pd.DataFrame({
+        'year': data[:, 0].astype(np.int16),
+        'month': data[:, 1].astype(np.int8),
+        'day': data[:, 2].astype(np.int8),
+        'utc_hour': data[:, 3].astype(np.int8),
+        'pm25': data[:, 4],
+        'pm10': data[:, 5],
+        'state': pd.Categorical([state] * len(data)),
+        'timestamp': lam.make_datetime_array(data),
+    })
+
+
+def iter_state_data(states, latest, workers):
+    """
+    :param states: (list) states to fetch
+    :param latest: (dict) state -> hour after which rows are kept (None keeps every row)
+    :param workers: (int) concurrent downloads (and at most twice as many parsed states waiting)
+    :return: generator of (state, df or exception) in the order the downloads finish
+    """
+    pending = list(states)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while pending or running:
+            # a bounded window of submitted states keeps memory independent of the number of states
+            while pending and len(running) < 2 * workers:
+                state = pending.pop(0)
+                running[executor.submit(lam.scrape_data, state, None, latest.get(state))] = state
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                state = running.pop(future)
+                try:
+                    yield state, to_columns(future.result()[1], state)
+                except Exception as exc:
+                    yield state, exc
+
+
+def add_aqi(df, window):
+    """
+    :param df: (dataframe) new rows of a state (see to_columns)
+    :param window: (aqi.RollingWindow) the state's last 24 hours before the rows, advanced past them
+    :return df: (dataframe) the rows with their aqi and aqi_category
+    """
+    values, categories = window.update(df['timestamp'].to_numpy(), df['pm25'].to_numpy(), df['pm10'].to_numpy())
+    return df.assign(aqi=values.astype(np.float32), aqi_category=categories)
+
+
+def arrow_window(directory, state, last_hour):
+    """
+    :param last_hour: (datetime) hour the backfill resumes after
+    :return window: (aqi.RollingWindow) window of the state's hours in its Arrow files up to last_hour
+    """
+    from storage import ArrowBackend
+
+    columns = ArrowBackend(directory)._partition(state, last_hour.year)
+    window = aqi.RollingWindow()
+    if columns is not None and len(columns['timestamp']):
+        # the files may already hold later hours (e.g. exported from the database)
+        end = np.searchsorted(columns['timestamp'], np.datetime64(last_hour, 'h'), side='right')
+        last = slice(max(end - aqi.WINDOW_HOURS, 0), end)
+        window.update(columns['timestamp'][last], columns['pm25'][last], columns['pm10'][last])
+    return window
+
+
+def copy_text(part):
+    # hours without an AQI are NULL (\N) and missing concentrations NaN, as the update Lambda writes them
+    missing = part['aqi_category'].to_numpy() < 0
+    part = part.assign(aqi=part['aqi'].astype(object).where(~missing, r'\N'),
+                       aqi_category=part['aqi_category'].astype(object).where(~missing, r'\N'))
+    return part.to_csv(sep='\t', header=False, index=False, na_rep='NaN')
+
+
+def load_checkpoint(path):
+    """
+    :param path: (str) checkpoint file
+    :return checkpoint: (dict) state -> last hour written (ISO string), and REFRESH_FROM -> first day
+        written since the last rollup refresh (ISO string)
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def save_checkpoint(path, checkpoint):
+    # written to a temporary file and renamed, so an interruption never leaves a broken checkpoint
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(checkpoint, fp, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def copy_state(conn, df, state, window):
+    """
+    :param conn: (connection) database connection
+    :param df: (dataframe) rows of one state (see add_aqi)
+    :param state: (str) state
+    :param window: (aqi.RollingWindow) the state's window after the rows, stored with them
+    :return rows: (int) rows inserted or updated, committed in one transaction
+    """
+    # formatted a slice at a time as COPY reads, rather than the whole state at once
+    columns = df[list(lam.COLUMNS)]
+    buffer = lam.CopyStream(copy_text(columns.iloc[start:start + COPY_CHUNK_ROWS])
+                            for start in range(0, len(columns), COPY_CHUNK_ROWS))
+    with conn.cursor() as cur:
+        rows = lam.add_to_database(cur, buffer)
+        aqi.save_windows(cur, {state: window})
+    conn.commit()
+    return rows
+
+
+def write_state_partitions(directory, state, df):
+    """
+    :param directory: (str) root of the Arrow files
+    :param state: (str) state
+    :param df: (dataframe) new rows of the state (see add_aqi)
+    :return rows: (int) rows written
+    """
+    from storage import ArrowBackend, write_partition
+
+    existing = ArrowBackend(directory)
+    for year, part in df.groupby('year', observed=True):
+        part = part[['timestamp', 'pm25', 'pm10', 'aqi']]
+        columns = existing._partition(state, int(year))
+        if columns is not None:
+            # resuming inside a year: keep the hours written by the previous run
+            old = pd.DataFrame(columns)
+            part = pd.concat([old[old['timestamp'] < part['timestamp'].min()], part])
+        write_partition(directory, state, int(year), part)
+    return len(df)
+
+
+def backfill(states, target, since_year=None, workers=lam.MAX_WORKERS, dsn=None, directory=None,
+             checkpoint_path=None, restart=False):
+    """
+    :param states: (list) states to load
+    :param target: (str) 'db' (COPY into airquality) or 'arrow' (storage.py's Arrow files)
+    :param since_year: (int) first year to load (None for the whole history)
+    :param workers: (int) concurrent downloads
+    :param dsn: (str) libpq connection string (target 'db')
+    :param directory: (str) root of the Arrow files (target 'arrow')
+    :param checkpoint_path: (str) checkpoint file (defaults to one per target in CACHE_DIR)
+    :param restart: (bool) ignore the checkpoint and load everything again
+    :return stats: (dict) rows, seconds, rows_per_second and the failed states
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    checkpoint_path = checkpoint_path or os.path.join(CACHE_DIR, f'backfill_{target}.json')
+    checkpoint = load_checkpoint(checkpoint_path)
+    if restart:
+        # the states start over, a refresh still owed by an earlier run does not
+        checkpoint = {key: val for key, val in checkpoint.items() if key == REFRESH_FROM}
+    floor = datetime(since_year - 1, 12, 31, 23) if since_year is not None else None
+    latest = {}
+    for state in states:
+        done = datetime.fromisoformat(checkpoint[state]) if state in checkpoint else None
+        latest[state] = max((val for val in (floor, done) if val is not None), default=None)
+
+    conn = psycopg2.connect(dsn) if target == 'db' else None
+    if target == 'db':
+        with conn.cursor() as cur:
+            windows = aqi.load_windows(cur, states)
+            for state, window in windows.items():
+                # resuming below the stored window (--restart, --since-year or a checkpoint behind the
+                # update Lambda): rebuild it from the rows up to where the backfill resumes, as the
+                # new rows must come after the window
+                resume = np.datetime64(latest[state], 'h') if latest[state] else None
+                if window.last_hour is not None and (resume is None or resume < window.last_hour):
+                    windows[state] = aqi.window_at(cur, state, latest[state])
+        conn.commit()
+    else:
+        windows = {state: arrow_window(directory, state, latest[state]) if latest[state] else aqi.RollingWindow()
+                   for state in states}
+    start = time.time()
+    total, failed = 0, []
+    try:
+        for state, df in iter_state_data(states, latest, workers):
+            if isinstance(df, Exception):
+                print(f'{state}: failed ({df!r}), rerun to resume')
+                failed.append(state)
+                continue
+            if len(df):
+                df = add_aqi(df, windows[state])
+                if target == 'db':
+                    rows = copy_state(conn, df, state, windows[state])
+                    # the rollups are refreshed once at the end, from the first day saved with the states
+                    first = df['timestamp'].iloc[0].date().isoformat()
+                    checkpoint[REFRESH_FROM] = min(checkpoint.get(REFRESH_FROM, first), first)
+                else:
+                    rows = write_state_partitions(directory, state, df)
+                total += rows
+                checkpoint[state] = df['timestamp'].iloc[-1].isoformat()
+                save_checkpoint(checkpoint_path, checkpoint)
+            seconds = time.time() - start
+            print(f'{state}: {len(df)} rows, {total / seconds:,.0f} rows/s overall')
+        if target == 'db' and REFRESH_FROM in checkpoint:
+            # also owed when an earlier run stopped between its last state and the refresh
+            since = datetime.fromisoformat(checkpoint[REFRESH_FROM]).date()
+            with conn.cursor() as cur:
+                cur.execute('SELECT refresh_airquality_rollups(%s)', (since,))
+            conn.commit()
+            del checkpoint[REFRESH_FROM]
+            save_checkpoint(checkpoint_path, checkpoint)
+    finally:
+        if conn is not None:
+            conn.close()
+    seconds = time.time() - start
+    return {'rows': total, 'seconds': round(seconds, 1),
+            'rows_per_second': round(total / seconds, 1) if seconds > 0 else 0.0, 'failed_states': failed}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scrape the Berkeley Earth files into CSVs for the initial load')
+    parser.add_argument('--out-dir', default=CACHE_DIR, help='directory for the CSV files')
+    parser.add_argument('--since-year', type=int, help='drop the years before this one (default: whole history)')
+    parser.add_argument('--city', action='append', default=[], metavar='STATE/CITY',
+                        help='also load a city file, e.g. New_York/New_York_City (repeatable)')
+    parser.add_argument('--dsn', default=default_dsn(), help='database the cities are registered in')
+    parser.add_argument('--backfill', choices=('db', 'arrow'),
+                        help='load the states into the database (db) or the local Arrow files (arrow) instead of a CSV')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent downloads of --backfill')
+    parser.add_argument('--arrow-dir', help='root of the Arrow files of --backfill arrow (default: ARROW_DIR)')
+    parser.add_argument('--restart', action='store_true', help='ignore the --backfill checkpoint')
+    args = parser.parse_args()
+
+    if args.backfill:
+        if args.backfill == 'arrow' and args.arrow_dir is None:
+            from storage import storage_settings
+            args.arrow_dir = storage_settings['arrow_dir']
+        stats = backfill(states, args.backfill, args.since_year, args.workers, args.dsn, args.arrow_dir,
+                         restart=args.restart)
+        print(json.dumps(stats))
+        sys.exit(1 if stats['failed_states'] else 0)
+
+    frames = []
+    for state in states:
+        print(state)
+        frames.append(get_state_data(state))
+    all_data = pd.concat(frames)
+    if args.since_year is not None:
+        all_data = all_data.loc[all_data['year'] >= args.since_year]
+    out_fp = os.path.join(args.out_dir, 'air_quality_data.csv')
+    all_data.to_csv(out_fp, index=False)
+    print('Wrote', out_fp)
 
-out_fp = r'C:\Users\Peter\Documents\air_quality_data_2021.csv'
-all_data.to_csv(out_fp, index=False)
+    if args.city:
+        cities = [tuple(val.split('/', 1)) for val in args.city]
+        ids = register_cities(args.dsn, cities)
+        frames = []
+        for (state, city), city_id in ids.items():
+            print(state, city)
+            frames.append(get_city_data(state, city, city_id))
+        city_data = pd.concat(frames)
+        if args.since_year is not None:
+            city_data = city_data.loc[city_data['year'] >= args.since_year]
+        out_fp = os.path.join(args.out_dir, 'air_quality_cities.csv')
+        city_data.to_csv(out_fp, index=False)
+        print('Wrote', out_fp)
@@ -0,0 +1,56 @@
+# Refreshes the dashboard's local Arrow files (STORAGE_BACKEND=arrow, see storage.py) from the
+# airquality table. Each state/year partition touched since --since is rewritten whole and
+# swapped in atomically, so the app can keep serving while this runs. Schedule it on the app
+# host shortly after each ingest (INGEST_HOURS_UTC + INGEST_GRACE_MINUTES), e.g.:
+#   20 0,12 * * * python data1050/export_arrow.py
+# and run it once with --since 2021-01-01 to build the files from scratch.
+import argparse
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+
+# share the dashboard's connection pool and storage settings (they live in the repository root)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import database
+from storage import storage_settings, write_partition
+
+
+def partitions_since(since):
+    """
+    :param since: (date) first day with new data
+    :return partitions: (list) (state, year) of every partition with rows on or after since
+    """
+    # the year predicate lets the planner skip the partitions before since (see 005_partition_by_year.sql)
+    query = """SELECT DISTINCT state, year FROM airquality
+    WHERE year >= %(year)s AND timestamp >= %(since)s ORDER BY state, year"""
+    return [(state, int(year)) for state, year in
+            database.query_database(query, {'year': since.year, 'since': since})]
+
+
+def export_partition(directory, state, year):
+    """
+    :return rows: (int) number of rows written for the state/year partition
+    """
+    query = """SELECT timestamp, pm25, pm10, aqi FROM airquality
+    WHERE state = %(state)s AND year = %(year)s
+    ORDER BY timestamp"""
+    rows = database.query_database(query, {'state': state, 'year': year})
+    write_partition(directory, state, year, pd.DataFrame(rows, columns=['timestamp', 'pm25', 'pm10', 'aqi']))
+    return len(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh the local Arrow files from the airquality table')
+    parser.add_argument('--since', type=date.fromisoformat, default=date.today() - timedelta(days=2),
+                        help='rewrite the partitions with rows on or after this day (default: two days ago)')
+    parser.add_argument('--dir', default=storage_settings['arrow_dir'], help='root of the Arrow files')
+    args = parser.parse_args()
+
+    start = time.time()
+    total = 0
+    for state, year in partitions_since(args.since):
+        total += export_partition(args.dir, state, year)
+    print(f'{total} rows written to {args.dir} in {time.time() - start:.1f} s')
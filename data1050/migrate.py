@@ -0,0 +1,75 @@
+# Schema migrations for the airquality database.
+# Applies the numbered .sql files in data1050/migrations in order and records each one in
+# the schema_migrations table so reruns only apply new files. Works against RDS or a local
+# PostgreSQL stand-in, e.g.:
+#   docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=postgres postgres:14
+#   python data1050/migrate.py --dsn "host=localhost user=postgres password=postgres dbname=postgres"
+import argparse
+import glob
+import os
+
+import psycopg2
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def default_dsn():
+    """
+    :return dsn: (str) connection string built from the same RDS_* environment variables as the dashboard
+    """
+    return ' '.join([
+        f"host={os.environ.get('RDS_HOSTNAME', 'localhost')}",
+        f"port={os.environ.get('RDS_PORT', '5432')}",
+        f"user={os.environ.get('RDS_USERNAME', 'postgres')}",
+        f"password={os.environ.get('RDS_PASSWORD', 'postgres')}",
+        f"dbname={os.environ.get('RDS_DB_NAME', 'postgres')}",
+    ])
+
+
+def pending_migrations(cur):
+    """
+    :param cur: (cursor) database cursor
+    :return paths: (list) migration files that have not been applied yet, in order
+    """
+    cur.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+        name text PRIMARY KEY,
+        applied_at timestamp NOT NULL DEFAULT now())""")
+    cur.execute('SELECT name FROM schema_migrations')
+    applied = {row[0] for row in cur.fetchall()}
+    paths = sorted(glob.glob(os.path.join(MIGRATIONS_DIR, '*.sql')))
+    return [path for path in paths if os.path.basename(path) not in applied]
+
+
+def migrate(dsn, dry_run=False):
+    """
+    :param dsn: (str) libpq connection string
+    :param dry_run: (bool) only list the pending migrations
+    :return applied: (list) names of the migrations applied
+    """
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    applied = []
+    try:
+        for path in pending_migrations(cur):
+            name = os.path.basename(path)
+            print('Applying' if not dry_run else 'Pending', name)
+            if dry_run:
+                continue
+            with open(path) as fp:
+                cur.execute(fp.read())
+            cur.execute('INSERT INTO schema_migrations (name) VALUES (%s)', (name,))
+            conn.commit()  # one transaction per migration file
+            applied.append(name)
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+    return applied
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply pending airquality schema migrations')
+    parser.add_argument('--dsn', default=default_dsn(), help='libpq connection string')
+    parser.add_argument('--dry-run', action='store_true', help='list pending migrations without applying them')
+    args = parser.parse_args()
+    migrate(args.dsn, dry_run=args.dry_run)
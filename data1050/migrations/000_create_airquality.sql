@@ -0,0 +1,11 @@
+-- Base table as originally created from the initial ETL CSV (etl_initial.py).
+-- Only needed when setting up a fresh (e.g. local) database; a no-op on RDS.
+CREATE TABLE IF NOT EXISTS airquality (
+    year integer,
+    month integer,
+    day integer,
+    utc_hour integer,
+    pm25 double precision,
+    pm10 double precision,
+    state text
+);
@@ -0,0 +1,14 @@
+-- Real timestamp column + (state, timestamp) index.
+-- Filtering on make_timestamp(year, month, day, utc_hour) evaluated the function on every row
+-- and forced a sequential scan of airquality. The column is generated from the same
+-- expression, so existing rows are backfilled by this statement and rows inserted by the
+-- Lambda get their timestamp without any change to the INSERT.
+ALTER TABLE airquality
+    ADD COLUMN IF NOT EXISTS timestamp timestamp
+    GENERATED ALWAYS AS (make_timestamp(CAST(year AS int), CAST(month AS int), CAST(day AS int),
+                                        CAST(utc_hour AS int), 0, CAST(0.0 AS double precision))) STORED;
+
+-- date range + state filters (apply_filter) and per-state latest hour (lambda_handler)
+CREATE INDEX IF NOT EXISTS airquality_state_timestamp_idx ON airquality (state, timestamp);
+
+ANALYZE airquality;
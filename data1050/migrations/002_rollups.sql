@@ -0,0 +1,92 @@
+-- Daily and monthly per-state rollups used for the choropleth map aggregates.
+-- Each row stores count/sum/min/max plus a mergeable quantile sketch for the median: a sparse
+-- histogram of fixed 0.5 ug/m3 wide bins (bin = floor(value / 0.5), capped at 2000) kept as
+-- two parallel arrays. Sketches merge by adding counts per bin, so monthly rows are built
+-- from daily rows and the dashboard can combine any mix of months, days and raw edge hours.
+-- The bin width must match SKETCH_BIN_WIDTH in aggregates.py.
+CREATE TABLE IF NOT EXISTS airquality_daily (
+    state text NOT NULL,
+    particulate text NOT NULL,
+    day date NOT NULL,
+    n integer NOT NULL,
+    total double precision NOT NULL,
+    min double precision NOT NULL,
+    max double precision NOT NULL,
+    sketch_bins integer[] NOT NULL,
+    sketch_counts integer[] NOT NULL,
+    PRIMARY KEY (state, particulate, day)
+);
+
+CREATE TABLE IF NOT EXISTS airquality_monthly (
+    state text NOT NULL,
+    particulate text NOT NULL,
+    month date NOT NULL,  -- first day of the month
+    n integer NOT NULL,
+    total double precision NOT NULL,
+    min double precision NOT NULL,
+    max double precision NOT NULL,
+    sketch_bins integer[] NOT NULL,
+    sketch_counts integer[] NOT NULL,
+    PRIMARY KEY (state, particulate, month)
+);
+
+-- Recompute every daily row from `since` onwards and every monthly row touching those days.
+-- Called by the update Lambda after each ingest with the day of the oldest new hour, so the
+-- cost is proportional to the new data rather than the table.
+CREATE OR REPLACE FUNCTION refresh_airquality_rollups(since date) RETURNS void AS $$
+BEGIN
+    WITH hourly AS (
+        SELECT a.state, CAST(a.timestamp AS date) AS day, p.particulate, p.value
+        FROM airquality a
+        CROSS JOIN LATERAL (VALUES ('pm25', a.pm25), ('pm10', a.pm10)) AS p(particulate, value)
+        WHERE a.timestamp >= since AND p.value IS NOT NULL AND p.value <> 'NaN'
+    ), binned AS (
+        SELECT state, day, particulate, LEAST(GREATEST(CAST(floor(value / 0.5) AS int), 0), 2000) AS bin,
+               count(*) AS n
+        FROM hourly
+        GROUP BY state, day, particulate, bin
+    ), sketches AS (
+        SELECT state, day, particulate, array_agg(bin ORDER BY bin) AS sketch_bins,
+               array_agg(CAST(n AS int) ORDER BY bin) AS sketch_counts
+        FROM binned
+        GROUP BY state, day, particulate
+    ), stats AS (
+        SELECT state, day, particulate, count(*) AS n, sum(value) AS total, min(value) AS min, max(value) AS max
+        FROM hourly
+        GROUP BY state, day, particulate
+    )
+    INSERT INTO airquality_daily (state, particulate, day, n, total, min, max, sketch_bins, sketch_counts)
+    SELECT state, particulate, day, n, total, min, max, sketch_bins, sketch_counts
+    FROM stats JOIN sketches USING (state, day, particulate)
+    ON CONFLICT (state, particulate, day) DO UPDATE
+        SET n = EXCLUDED.n, total = EXCLUDED.total, min = EXCLUDED.min, max = EXCLUDED.max,
+            sketch_bins = EXCLUDED.sketch_bins, sketch_counts = EXCLUDED.sketch_counts;
+
+    WITH days AS (
+        SELECT * FROM airquality_daily WHERE day >= date_trunc('month', since)
+    ), merged AS (
+        SELECT state, particulate, CAST(date_trunc('month', day) AS date) AS month, u.bin, sum(u.n) AS n
+        FROM days, unnest(sketch_bins, sketch_counts) AS u(bin, n)
+        GROUP BY state, particulate, month, u.bin
+    ), sketches AS (
+        SELECT state, particulate, month, array_agg(bin ORDER BY bin) AS sketch_bins,
+               array_agg(CAST(n AS int) ORDER BY bin) AS sketch_counts
+        FROM merged
+        GROUP BY state, particulate, month
+    ), stats AS (
+        SELECT state, particulate, CAST(date_trunc('month', day) AS date) AS month,
+               sum(n) AS n, sum(total) AS total, min(min) AS min, max(max) AS max
+        FROM days
+        GROUP BY state, particulate, month
+    )
+    INSERT INTO airquality_monthly (state, particulate, month, n, total, min, max, sketch_bins, sketch_counts)
+    SELECT state, particulate, month, n, total, min, max, sketch_bins, sketch_counts
+    FROM stats JOIN sketches USING (state, particulate, month)
+    ON CONFLICT (state, particulate, month) DO UPDATE
+        SET n = EXCLUDED.n, total = EXCLUDED.total, min = EXCLUDED.min, max = EXCLUDED.max,
+            sketch_bins = EXCLUDED.sketch_bins, sketch_counts = EXCLUDED.sketch_counts;
+END;
+$$ LANGUAGE plpgsql;
+
+-- backfill from the existing hourly data
+SELECT refresh_airquality_rollups(CAST('1900-01-01' AS date));
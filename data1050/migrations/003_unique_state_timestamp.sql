@@ -0,0 +1,13 @@
+-- One row per state and hour, so the update Lambda can upsert on (state, timestamp) and
+-- reruns never duplicate data.
+-- Drop duplicate hours left behind by earlier reruns (keeping one row per state and hour).
+DELETE FROM airquality a
+    USING airquality b
+    WHERE a.state = b.state AND a.timestamp = b.timestamp AND a.ctid > b.ctid;
+
+-- the unique index serves the same range scans as the plain index it replaces
+CREATE UNIQUE INDEX IF NOT EXISTS airquality_state_timestamp_key ON airquality (state, timestamp);
+DROP INDEX IF EXISTS airquality_state_timestamp_idx;
+
+-- rollups may have counted the duplicates
+SELECT refresh_airquality_rollups(CAST('1900-01-01' AS date));
@@ -0,0 +1,11 @@
+-- What the update Lambda last downloaded from each Berkeley Earth file, so the next run can
+-- ask for only the appended bytes (Range) or skip unchanged files (If-None-Match).
+-- Written in the same transaction as the rows, so it never runs ahead of the data.
+CREATE TABLE IF NOT EXISTS scrape_state (
+    url text PRIMARY KEY,
+    etag text,
+    last_modified text,
+    content_length bigint NOT NULL,
+    tail text NOT NULL,  -- last bytes of the downloaded content, re-requested to detect rewrites
+    updated_at timestamp NOT NULL DEFAULT now()
+);
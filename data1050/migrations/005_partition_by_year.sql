@@ -0,0 +1,140 @@
+-- Multi-year history and city level series.
+-- airquality becomes a table range partitioned by year, so loading the full Berkeley Earth
+-- history keeps every dashboard query (which filters on timestamp and year) inside the
+-- partitions of the years it asks for, and old years can be detached or moved cheaply.
+-- Within a partition the unique (state, timestamp, year) index keeps each state's hours together,
+-- so the partitions are not split further by state (that would only multiply relations).
+-- Partitions are created on demand by create_year_partitions (the update Lambda calls it with
+-- the years of every batch before inserting); rows of a year without a partition land in the
+-- default partition instead of failing the insert.
+-- City level series live in airquality_city, partitioned the same way, keyed by the city table.
+
+CREATE OR REPLACE FUNCTION create_year_partitions(parent text, first_year int, last_year int) RETURNS void AS $$
+DECLARE
+    y int;
+BEGIN
+    FOR y IN first_year..last_year LOOP
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%s) TO (%s)',
+                       parent || '_y' || y, parent, y, y + 1);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- move the existing rows into a partitioned table of the same name
+ALTER TABLE airquality RENAME TO airquality_unpartitioned;
+
+CREATE TABLE airquality (
+    year integer NOT NULL,
+    month integer,
+    day integer,
+    utc_hour integer,
+    pm25 double precision,
+    pm10 double precision,
+    state text NOT NULL,
+    timestamp timestamp
+        GENERATED ALWAYS AS (make_timestamp(CAST(year AS int), CAST(month AS int), CAST(day AS int),
+                                            CAST(utc_hour AS int), 0, CAST(0.0 AS double precision))) STORED
+) PARTITION BY RANGE (year);
+CREATE TABLE airquality_default PARTITION OF airquality DEFAULT;
+
+DO $$
+DECLARE
+    bounds record;
+BEGIN
+    SELECT min(year) AS first_year, max(year) AS last_year INTO bounds FROM airquality_unpartitioned;
+    IF bounds.first_year IS NOT NULL THEN
+        PERFORM create_year_partitions('airquality', bounds.first_year, bounds.last_year);
+    END IF;
+END;
+$$;
+
+INSERT INTO airquality (year, month, day, utc_hour, pm25, pm10, state)
+SELECT year, month, day, utc_hour, pm25, pm10, state FROM airquality_unpartitioned;
+
+DROP TABLE airquality_unpartitioned;
+
+-- a unique index on a partitioned table has to include the partition key; timestamp determines
+-- year, so this is the same one row per state and hour as before
+CREATE UNIQUE INDEX airquality_state_timestamp_key ON airquality (state, timestamp, year);
+
+-- the rollup refresh only reads the partitions from `since` onwards
+CREATE OR REPLACE FUNCTION refresh_airquality_rollups(since date) RETURNS void AS $$
+BEGIN
+    WITH hourly AS (
+        SELECT a.state, CAST(a.timestamp AS date) AS day, p.particulate, p.value
+        FROM airquality a
+        CROSS JOIN LATERAL (VALUES ('pm25', a.pm25), ('pm10', a.pm10)) AS p(particulate, value)
+        WHERE a.year >= extract(year FROM since) AND a.timestamp >= since
+          AND p.value IS NOT NULL AND p.value <> 'NaN'
+    ), binned AS (
+        SELECT state, day, particulate, LEAST(GREATEST(CAST(floor(value / 0.5) AS int), 0), 2000) AS bin,
+               count(*) AS n
+        FROM hourly
+        GROUP BY state, day, particulate, bin
+    ), sketches AS (
+        SELECT state, day, particulate, array_agg(bin ORDER BY bin) AS sketch_bins,
+               array_agg(CAST(n AS int) ORDER BY bin) AS sketch_counts
+        FROM binned
+        GROUP BY state, day, particulate
+    ), stats AS (
+        SELECT state, day, particulate, count(*) AS n, sum(value) AS total, min(value) AS min, max(value) AS max
+        FROM hourly
+        GROUP BY state, day, particulate
+    )
+    INSERT INTO airquality_daily (state, particulate, day, n, total, min, max, sketch_bins, sketch_counts)
+    SELECT state, particulate, day, n, total, min, max, sketch_bins, sketch_counts
+    FROM stats JOIN sketches USING (state, day, particulate)
+    ON CONFLICT (state, particulate, day) DO UPDATE
+        SET n = EXCLUDED.n, total = EXCLUDED.total, min = EXCLUDED.min, max = EXCLUDED.max,
+            sketch_bins = EXCLUDED.sketch_bins, sketch_counts = EXCLUDED.sketch_counts;
+
+    WITH days AS (
+        SELECT * FROM airquality_daily WHERE day >= date_trunc('month', since)
+    ), merged AS (
+        SELECT state, particulate, CAST(date_trunc('month', day) AS date) AS month, u.bin, sum(u.n) AS n
+        FROM days, unnest(sketch_bins, sketch_counts) AS u(bin, n)
+        GROUP BY state, particulate, month, u.bin
+    ), sketches AS (
+        SELECT state, particulate, month, array_agg(bin ORDER BY bin) AS sketch_bins,
+               array_agg(CAST(n AS int) ORDER BY bin) AS sketch_counts
+        FROM merged
+        GROUP BY state, particulate, month
+    ), stats AS (
+        SELECT state, particulate, CAST(date_trunc('month', day) AS date) AS month,
+               sum(n) AS n, sum(total) AS total, min(min) AS min, max(max) AS max
+        FROM days
+        GROUP BY state, particulate, month
+    )
+    INSERT INTO airquality_monthly (state, particulate, month, n, total, min, max, sketch_bins, sketch_counts)
+    SELECT state, particulate, month, n, total, min, max, sketch_bins, sketch_counts
+    FROM stats JOIN sketches USING (state, particulate, month)
+    ON CONFLICT (state, particulate, month) DO UPDATE
+        SET n = EXCLUDED.n, total = EXCLUDED.total, min = EXCLUDED.min, max = EXCLUDED.max,
+            sketch_bins = EXCLUDED.sketch_bins, sketch_counts = EXCLUDED.sketch_counts;
+END;
+$$ LANGUAGE plpgsql;
+
+-- city dimension: the Berkeley Earth city files to ingest (registered by etl_initial.py --city)
+CREATE TABLE IF NOT EXISTS city (
+    id serial PRIMARY KEY,
+    state text NOT NULL,  -- as in airquality.state, e.g. 'New_York'
+    name text NOT NULL,   -- as in the Berkeley Earth file name, e.g. 'New_York_City'
+    UNIQUE (state, name)
+);
+
+CREATE TABLE IF NOT EXISTS airquality_city (
+    city_id integer NOT NULL REFERENCES city (id),
+    year integer NOT NULL,
+    month integer,
+    day integer,
+    utc_hour integer,
+    pm25 double precision,
+    pm10 double precision,
+    timestamp timestamp
+        GENERATED ALWAYS AS (make_timestamp(CAST(year AS int), CAST(month AS int), CAST(day AS int),
+                                            CAST(utc_hour AS int), 0, CAST(0.0 AS double precision))) STORED
+) PARTITION BY RANGE (year);
+CREATE TABLE IF NOT EXISTS airquality_city_default PARTITION OF airquality_city DEFAULT;
+CREATE UNIQUE INDEX IF NOT EXISTS airquality_city_timestamp_key ON airquality_city (city_id, timestamp, year);
+
+ANALYZE airquality;
@@ -0,0 +1,74 @@
+-- EPA Air Quality Index of every state hour, written by the update Lambda with the rows (see
+-- data1050/aqi.py): the larger of the PM2.5 and PM10 sub-indices of the 24 hour averages ending
+-- at the hour, NULL while fewer than 18 of those hours have a value. aqi_category is the position
+-- in aqi.CATEGORIES (0 Good .. 5 Hazardous).
+-- aqi_window keeps each state's last 24 hourly values so that the Lambda only reads its new rows.
+-- Rows already in airquality get their AQI from `python data1050/aqi.py` after this migration.
+
+ALTER TABLE airquality ADD COLUMN IF NOT EXISTS aqi real, ADD COLUMN IF NOT EXISTS aqi_category smallint;
+
+CREATE TABLE IF NOT EXISTS aqi_window (
+    state text PRIMARY KEY,
+    last_hour timestamp NOT NULL,  -- newest hour of the window
+    pm25 double precision[] NOT NULL,  -- the 24 hours ending at last_hour, oldest first ('NaN' for none)
+    pm10 double precision[] NOT NULL
+);
+
+-- AQI gets daily/monthly rollups like the concentrations, so the map serves it from the same
+-- sketches (an AQI is at most 500, well inside the 0.5 wide bins)
+CREATE OR REPLACE FUNCTION refresh_airquality_rollups(since date) RETURNS void AS $$
+BEGIN
+    WITH hourly AS (
+        SELECT a.state, CAST(a.timestamp AS date) AS day, p.particulate, p.value
+        FROM airquality a
+        CROSS JOIN LATERAL (VALUES ('pm25', a.pm25), ('pm10', a.pm10),
+                                    ('aqi', CAST(a.aqi AS double precision))) AS p(particulate, value)
+        WHERE a.year >= extract(year FROM since) AND a.timestamp >= since
+          AND p.value IS NOT NULL AND p.value <> 'NaN'
+    ), binned AS (
+        SELECT state, day, particulate, LEAST(GREATEST(CAST(floor(value / 0.5) AS int), 0), 2000) AS bin,
+               count(*) AS n
+        FROM hourly
+        GROUP BY state, day, particulate, bin
+    ), sketches AS (
+        SELECT state, day, particulate, array_agg(bin ORDER BY bin) AS sketch_bins,
+               array_agg(CAST(n AS int) ORDER BY bin) AS sketch_counts
+        FROM binned
+        GROUP BY state, day, particulate
+    ), stats AS (
+        SELECT state, day, particulate, count(*) AS n, sum(value) AS total, min(value) AS min, max(value) AS max
+        FROM hourly
+        GROUP BY state, day, particulate
+    )
+    INSERT INTO airquality_daily (state, particulate, day, n, total, min, max, sketch_bins, sketch_counts)
+    SELECT state, particulate, day, n, total, min, max, sketch_bins, sketch_counts
+    FROM stats JOIN sketches USING (state, day, particulate)
+    ON CONFLICT (state, particulate, day) DO UPDATE
+        SET n = EXCLUDED.n, total = EXCLUDED.total, min = EXCLUDED.min, max = EXCLUDED.max,
+            sketch_bins = EXCLUDED.sketch_bins, sketch_counts = EXCLUDED.sketch_counts;
+
+    WITH days AS (
+        SELECT * FROM airquality_daily WHERE day >= date_trunc('month', since)
+    ), merged AS (
+        SELECT state, particulate, CAST(date_trunc('month', day) AS date) AS month, u.bin, sum(u.n) AS n
+        FROM days, unnest(sketch_bins, sketch_counts) AS u(bin, n)
+        GROUP BY state, particulate, month, u.bin
+    ), sketches AS (
+        SELECT state, particulate, month, array_agg(bin ORDER BY bin) AS sketch_bins,
+               array_agg(CAST(n AS int) ORDER BY bin) AS sketch_counts
+        FROM merged
+        GROUP BY state, particulate, month
+    ), stats AS (
+        SELECT state, particulate, CAST(date_trunc('month', day) AS date) AS month,
+               sum(n) AS n, sum(total) AS total, min(min) AS min, max(max) AS max
+        FROM days
+        GROUP BY state, particulate, month
+    )
+    INSERT INTO airquality_monthly (state, particulate, month, n, total, min, max, sketch_bins, sketch_counts)
+    SELECT state, particulate, month, n, total, min, max, sketch_bins, sketch_counts
+    FROM stats JOIN sketches USING (state, particulate, month)
+    ON CONFLICT (state, particulate, month) DO UPDATE
+        SET n = EXCLUDED.n, total = EXCLUDED.total, min = EXCLUDED.min, max = EXCLUDED.max,
+            sketch_bins = EXCLUDED.sketch_bins, sketch_counts = EXCLUDED.sketch_counts;
+END;
+$$ LANGUAGE plpgsql;
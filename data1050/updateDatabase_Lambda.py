@@ -1,6 +1,26 @@
 import psycopg2 # uploaded with .zip file from: https://github.com/jkehler/awslambda-psycopg2
 import numpy as np # add base SciPY/NumPY AWS layer
-import requests # add layer by arn: arn:aws:lambda:us-west-1:770693421928:layer:Klayers-python38-requests:26
+import io
+import os
+import time
+import warnings
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import aqi # packaged with the .zip file, like berkeley.py
+import berkeley # packaged with the .zip file (as is its tenacity dependency)
+
+# columns written by the Lambda (timestamp is generated from year/month/day/utc_hour)
+COLUMNS = ('year', 'month', 'day', 'utc_hour', 'pm25', 'pm10', 'aqi', 'aqi_category', 'state')
+CITY_COLUMNS = ('year', 'month', 'day', 'utc_hour', 'pm25', 'pm10', 'city_id')
+COLUMN_TYPES = {'year': 'integer', 'month': 'integer', 'day': 'integer', 'utc_hour': 'integer',
+                'pm25': 'double precision', 'pm10': 'double precision', 'aqi': 'real', 'aqi_category': 'smallint',
+                'state': 'text', 'city_id': 'integer'}
+
+# columns of the Berkeley Earth state files, i.e. of the parsed (n, 7) float arrays
+FILE_COLUMNS = ('year', 'month', 'day', 'utc_hour', 'pm25', 'pm10', 'retrospective')
+
+# Worker threads fetching state files (requests per host are limited in berkeley.py)
+MAX_WORKERS = int(os.environ.get('SCRAPE_MAX_WORKERS', 16))
 
 
 def lambda_handler(event, context):
@@ -15,12 +35,6 @@ def lambda_handler(event, context):
                             user=name,
                             password=password)
     cur = conn.cursor()
-    # Get the time of the last update
-    query = """SELECT max(make_timestamp(CAST(year AS int), CAST(month AS int), CAST(day AS int), CAST(utc_hour AS int), 0, CAST(0.0 AS double precision))) FROM airquality"""
-    cur.execute(query)
-    rows = cur.fetchall()
-    latest_datetime = rows[0][0]
-
     states = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado',
               'Connecticut', 'Delaware', 'Florida', 'Georgia', 'Hawaii', 'Idaho',
               'Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky', 'Louisiana', 'Maine',
@@ -31,53 +45,340 @@ def lambda_handler(event, context):
               'South_Carolina', 'South_Dakota', 'Tennessee', 'Texas', 'Utah', 'Vermont',
               'Virginia', 'Washington', 'West_Virginia', 'Wisconsin', 'Wyoming']
 
-    # scrape the data and subset for all data since the last date
-    for state in states:
-        data = scrape_data(state)
-        datetime_array = make_datetime_array(data)
+    # Get the time of the last update for each state and city (one index lookup each) and what was
+    # downloaded from each file last time
+    latest = get_latest_datetimes(cur, states)
+    cities = get_cities(cur)
+    latest_city = get_latest_city_datetimes(cur, list(cities))
+    metadata = get_scrape_state(cur)
+    windows = aqi.load_windows(cur, states)
 
-        new_data = data[datetime_array > latest_datetime]
+    # scrape all states concurrently and stream the new rows (with the AQI of each new hour, from
+    # the state's rolling 24 hour window) into one COPY + upsert as each state arrives, then
+    # refresh the daily/monthly map rollups from the oldest day that received new rows, all in a
+    # single transaction
+    run_start = time.time()
+    failed = []
+    fetched = {}
+    first_hours = {}
+    copy_stream = CopyStream(format_state_rows(new_data, state, windows[state], first_hours)
+                             for state, new_data in fetch_new_data(states, latest, metadata, fetched, failed)
+                             if len(new_data) > 0)
+    rows = add_to_database(cur, copy_stream)
+    if rows > 0 and first_hours:
+        since = min(first_hours.values()).astype('datetime64[D]').astype(object)
+        cur.execute('SELECT refresh_airquality_rollups(%s)', (since,))
+    aqi.save_windows(cur, windows)
+    save_scrape_state(cur, {berkeley.state_url(state): meta for state, (_, meta) in fetched.items()})
 
-        if len(new_data) > 0:
-            add_to_database(conn, cur, new_data, state)
+    # then the registered cities, into airquality_city (no rollups, the map is per state)
+    failed_cities = []
+    fetched_cities = {}
+    city_stream = CopyStream(format_copy_rows(new_data, city_id)
+                             for city_id, new_data in fetch_new_data(list(cities), latest_city, metadata,
+                                                                     fetched_cities, failed_cities, urls=cities)
+                             if len(new_data) > 0)
+    city_rows = add_to_database(cur, city_stream, table='airquality_city', columns=CITY_COLUMNS)
+    save_scrape_state(cur, {cities[city_id]: meta for city_id, (_, meta) in fetched_cities.items()})
+    conn.commit()
+    total_seconds = time.time() - run_start
 
     cur.close()
     conn.close()
 
-    return 'Done'
+    return {
+        'status': 'Done',
+        'rows': rows,
+        'city_rows': city_rows,
+        'failed_states': failed,
+        'failed_cities': failed_cities,
+        'fetch_status': dict(Counter(status for status, _ in list(fetched.values()) + list(fetched_cities.values()))),
+        # end-to-end throughput: rows are written while the remaining files are still being fetched
+        'rows_per_second': round((rows + city_rows) / total_seconds, 1) if total_seconds > 0 else 0.0,
+        'total_seconds': round(total_seconds, 3),
+    }
+
+
+def get_latest_datetimes(cur, states):
+    """
+    :param cur: (cursor) database cursor
+    :param states: (list) state names
+    :return latest: (dict) state -> timestamp of its most recent row in airquality
+    """
+    # max(timestamp) per state is answered from the end of the (state, timestamp) index
+    query = """SELECT s.state, (SELECT max(timestamp) FROM airquality a WHERE a.state = s.state)
+    FROM unnest(%s::text[]) AS s(state)"""
+    cur.execute(query, (states,))
+    latest = dict(cur.fetchall())
+    # a state without any rows yet starts from the most recent update of the others
+    overall = max((val for val in latest.values() if val is not None), default=None)
+    return {state: val if val is not None else overall for state, val in latest.items()}
+
+
+def get_cities(cur):
+    """
+    :param cur: (cursor) database cursor
+    :return cities: (dict) city id -> url of the city's hourly data file, for every registered city
+    """
+    cur.execute('SELECT id, state, name FROM city ORDER BY id')
+    return {city_id: berkeley.city_url(state, name) for city_id, state, name in cur.fetchall()}
+
+
+def get_latest_city_datetimes(cur, city_ids):
+    """
+    :param cur: (cursor) database cursor
+    :param city_ids: (list) city ids
+    :return latest: (dict) city id -> timestamp of its most recent row in airquality_city (None for a new
+        city, whose whole history is loaded)
+    """
+    query = """SELECT c.id, (SELECT max(timestamp) FROM airquality_city a WHERE a.city_id = c.id)
+    FROM unnest(%s::int[]) AS c(id)"""
+    cur.execute(query, (city_ids,))
+    return dict(cur.fetchall())
+
+
+def get_scrape_state(cur):
+    """
+    :param cur: (cursor) database cursor
+    :return metadata: (dict) url -> metadata of the last download (see berkeley.fetch_incremental)
+    """
+    cur.execute('SELECT url, etag, last_modified, content_length, tail FROM scrape_state')
+    return {url: {'etag': etag, 'last_modified': last_modified, 'content_length': content_length, 'tail': tail}
+            for url, etag, last_modified, content_length, tail in cur.fetchall()}
+
+
+def save_scrape_state(cur, metadata):
+    """
+    :param cur: (cursor) database cursor (the caller commits, together with the rows)
+    :param metadata: (dict) url -> metadata of this run's download
+    """
+    for url, meta in metadata.items():
+        cur.execute("""INSERT INTO scrape_state (url, etag, last_modified, content_length, tail, updated_at)
+        VALUES (%(url)s, %(etag)s, %(last_modified)s, %(content_length)s, %(tail)s, now())
+        ON CONFLICT (url) DO UPDATE SET etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified,
+            content_length = EXCLUDED.content_length, tail = EXCLUDED.tail, updated_at = EXCLUDED.updated_at""",
+                    dict(meta, url=url))
+
+
+def parse_block(block):
+    """
+    :param block: (bytes) complete lines of a state file
+    :return data: (array) (n, 7) float rows, the same as np.loadtxt(..., comments='%') gives for the lines
+    """
+    if b'%' in block or b'\n\n' in block or block.startswith(b'\n'):
+        # drop comments and blank lines (the fast path below expects one row per line)
+        lines = (line.split(b'%', 1)[0] for line in block.split(b'\n'))
+        block = b''.join(line + b'\n' for line in lines if line.strip())
+    n_lines = block.count(b'\n') + (1 if block and not block.endswith(b'\n') else 0)
+    if n_lines == 0:
+        return np.empty((0, len(FILE_COLUMNS)))
+    block = block.replace(b' ', b'')
+    # whitespace separated numbers decoded in C straight from the buffer
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            values = np.fromstring(block.decode('latin-1'), dtype=np.float64, sep=' ')
+    except ValueError:
+        values = None
+    if values is None or values.size != n_lines * len(FILE_COLUMNS):
+        # ragged or malformed lines: let loadtxt parse them (and raise on real errors)
+        return np.loadtxt(io.BytesIO(block), ndmin=2)
+    return values.reshape(n_lines, len(FILE_COLUMNS))
 
 
-def scrape_data(state):
-    target_url = f'http://berkeleyearth.lbl.gov/air-quality/maps/cities/United_States/{state}/{state}.txt'
-    res = requests.get(target_url)
-    text_file = open("/tmp/response.txt", "w")
-    n = text_file.write(res.text.replace(' ', ''))
-    text_file.close()
-    data = np.loadtxt("/tmp/response.txt", comments='%')
-    return data
+def _last_row_datetime(chunk):
+    # datetime64[h] of the last data line in the chunk (NaT if it has none)
+    end = len(chunk)
+    while end > 0:
+        start = chunk.rfind(b'\n', 0, end - 1) + 1
+        fields = chunk[start:end].split(b'%', 1)[0].replace(b' ', b'').split()
+        if len(fields) >= 4:
+            year, month, day, hour = (int(float(val)) for val in fields[:4])
+            return np.datetime64(f'{year:04d}-{month:02d}-{day:02d}T{hour:02d}', 'h')
+        end = start
+    return np.datetime64('NaT')
 
 
-def format_date(array):
-    year = str(int(array[0]))
-    month = str(int(array[1])) if len(str(int(array[1]))) > 1 else '0' + str(int(array[1]))
-    day = str(int(array[2])) if len(str(int(array[2]))) > 1 else '0' + str(int(array[2]))
-    hour = str(int(array[3])) if len(str(int(array[3]))) > 1 else '0' + str(int(array[3]))
-    return np.datetime64(f'{year}-{month}-{day}T{hour}')
+def parse_stream(chunks, latest_datetime=None, capacity=256):
+    """
+    :param chunks: (iterable) bytes chunks of a state file, each ending on a line boundary
+    :param latest_datetime: (datetime) most recent hour already in the database (None keeps every row)
+    :param capacity: (int) rows to preallocate (the buffer doubles when it fills up)
+    :return data: (array) (n, 7) float rows dated after latest_datetime, columns as in FILE_COLUMNS
+    """
+    latest = np.datetime64(latest_datetime, 'h') if latest_datetime is not None else None
+    rows = np.empty((capacity, len(FILE_COLUMNS)))
+    n = 0
+    for chunk in chunks:
+        if latest is not None and _last_row_datetime(chunk) <= latest:
+            # rows are in chronological order, so a chunk ending before latest holds nothing new
+            continue
+        block = parse_block(chunk)
+        # drop old rows chunk by chunk, so memory follows the new rows rather than the file
+        if latest is not None and len(block):
+            block = block[make_datetime_array(block) > latest]
+        if n + len(block) > len(rows):
+            grown = np.empty((max(2 * len(rows), n + len(block)), len(FILE_COLUMNS)))
+            grown[:n] = rows[:n]
+            rows = grown
+        rows[n:n + len(block)] = block
+        n += len(block)
+    return rows[:n]
+
+
+def scrape_data(state, metadata=None, latest_datetime=None, url=None):
+    """
+    :param state: (str) state to scrape
+    :param metadata: (dict) metadata of the previous download of the state's file
+    :param latest_datetime: (datetime) only rows after this hour are kept (None keeps every row)
+    :param url: (str) file to scrape instead of the state's (e.g. a city file)
+    :return status, data, metadata: (str, array, dict) fetch status ('unchanged', 'appended' or 'full'),
+        the parsed rows and the metadata to store for the next run
+    """
+    # the response body is parsed as it arrives, without a copy of the whole file in memory or on disk
+    download = berkeley.open_incremental(url or berkeley.state_url(state), metadata)
+    data = parse_stream(download.iter_chunks(), latest_datetime)
+    return download.status, data, download.metadata
+
+
+def fetch_new_rows(state, latest_datetime, metadata=None, url=None):
+    """
+    :param state: (str) state to scrape
+    :param latest_datetime: (datetime) most recent hour already in the database for this state
+    :param metadata: (dict) metadata of the previous download of the state's file
+    :param url: (str) file to scrape instead of the state's (e.g. a city file)
+    :return status, new_data, metadata: (str, array, dict) fetch status, scraped rows newer than
+        latest_datetime and the metadata to store for the next run
+    """
+    return scrape_data(state, metadata, latest_datetime, url)
+
+
+def fetch_new_data(states, latest, metadata, fetched, failed, urls=None):
+    """
+    :param states: (list) states (or other series keys, e.g. city ids) to scrape
+    :param latest: (dict) state -> most recent hour already in the database
+    :param metadata: (dict) url -> metadata of the previous download
+    :param fetched: (dict) state -> (fetch status, new metadata) is filled in for every downloaded state
+    :param failed: (list) states whose download failed after all retries are appended here
+    :param urls: (dict) state -> url of its file (defaults to the state files)
+    :return: generator of (state, new_data) in the order the downloads finish
+    """
+    urls = urls or {state: berkeley.state_url(state) for state in states}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(fetch_new_rows, state, latest[state], metadata.get(urls[state]),
+                                   urls[state]): state for state in states}
+        for future in as_completed(futures):
+            state = futures[future]
+            try:
+                status, new_data, new_metadata = future.result()
+            except Exception as exc:
+                # skip the state; the next run picks it up again from its own latest hour
+                print(f'Failed to update {state}: {exc!r}')
+                failed.append(state)
+                continue
+            fetched[state] = (status, new_metadata)
+            yield state, new_data
 
 
 def make_datetime_array(data):
-    datetime_array = np.zeros(len(data), dtype='datetime64[h]')
-    for i, val in enumerate(data):
-        datetime_array[i] = format_date(val)
-    return datetime_array
-
-
-def add_to_database(conn, cur, new_data, state):
-    for row in new_data:
-        row = list(row)
-        del row[-1] # delete last "retrospective" value
-        year, month, day, utc_hour, pm25, pm10 = row
-        query = f"""INSERT INTO public.airquality (year, month, day, utc_hour, pm25, pm10, state)
-        VALUES ({year}, {month}, {day}, {utc_hour}, {pm25}, {pm10}, \'{state}\')"""
-        cur.execute(query)
-        conn.commit()
+    """
+    :param data: (array) rows starting with year, month, day, utc_hour
+    :return datetime_array: (array) datetime64[h] of every row
+    """
+    # calendar fields -> datetime64 in one pass per unit instead of a string per row
+    fields = data[:, :4].astype(np.int64)
+    months = (fields[:, 0] - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (fields[:, 1] - 1)
+    days = months.astype('datetime64[D]') + (fields[:, 2] - 1)
+    return days.astype('datetime64[h]') + fields[:, 3]
+
+
+def format_copy_rows(new_data, state, aqi_values=None, categories=None):
+    """
+    :param new_data: (array) scraped rows (year, month, day, utc_hour, pm25, pm10, retrospective)
+    :param state: (str) state (or city id) the rows belong to
+    :param aqi_values: (array) AQI of each row (NaN for none), for the state rows only
+    :param categories: (array) AQI category of each row (-1 for none)
+    :return text: (str) rows in COPY text format, in the order of COLUMNS (CITY_COLUMNS without AQI)
+    """
+    lines = []
+    if aqi_values is None:
+        for year, month, day, utc_hour, pm25, pm10 in new_data[:, :6]:  # drop last "retrospective" value
+            lines.append(f'{int(year)}\t{int(month)}\t{int(day)}\t{int(utc_hour)}\t'
+                         f'{float(pm25)!r}\t{float(pm10)!r}\t{state}\n')
+        return ''.join(lines)
+    for (year, month, day, utc_hour, pm25, pm10), value, code in zip(new_data[:, :6], aqi_values.tolist(),
+                                                                     categories.tolist()):
+        # hours without enough data for a 24 hour average get NULLs (\N), not NaN
+        index = '\\N\t\\N' if code < 0 else f'{value:g}\t{code}'
+        lines.append(f'{int(year)}\t{int(month)}\t{int(day)}\t{int(utc_hour)}\t'
+                     f'{float(pm25)!r}\t{float(pm10)!r}\t{index}\t{state}\n')
+    return ''.join(lines)
+
+
+def format_state_rows(new_data, state, window, first_hours=None):
+    """
+    :param new_data: (array) new rows of a state, in file (time) order
+    :param state: (str) state the rows belong to
+    :param window: (aqi.RollingWindow) the state's last 24 hours, advanced past the new rows
+    :param first_hours: (dict) state -> datetime64[h] of its first new row is filled in (the rollups
+        are refreshed from the oldest of them)
+    :return text: (str) rows in COPY text format, in the order of COLUMNS
+    """
+    hours = make_datetime_array(new_data)
+    if first_hours is not None and len(hours):
+        first_hours[state] = hours[0]
+    aqi_values, categories = window.update(hours, new_data[:, 4], new_data[:, 5])
+    return format_copy_rows(new_data, state, aqi_values, categories)
+
+
+class CopyStream:
+    """Read-only file-like object that feeds COPY ... FROM STDIN from an iterator of text chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = ''
+        self._offset = 0  # position of the first unread character of the current chunk
+
+    def read(self, size=-1):
+        # each read copies only what it returns (re-slicing the rest of the chunk on every read would
+        # make a large chunk quadratic)
+        parts = []
+        remaining = size
+        while size < 0 or remaining > 0:
+            if self._offset >= len(self._chunk):
+                chunk = next(self._chunks, None) if self._chunks is not None else None
+                if chunk is None:
+                    self._chunks = None
+                    break
+                self._chunk, self._offset = chunk, 0
+                continue
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + remaining)
+            parts.append(self._chunk[self._offset:end])
+            remaining -= end - self._offset
+            self._offset = end
+        return ''.join(parts)
+
+
+def add_to_database(cur, copy_buffer, table='airquality', columns=COLUMNS):
+    """
+    :param cur: (cursor) database cursor (the caller commits)
+    :param copy_buffer: (file-like) rows in COPY text format, in the order of columns
+    :param table: (str) 'airquality' (state rows) or 'airquality_city' (city rows)
+    :param columns: (tuple) COLUMNS or CITY_COLUMNS; the last one is the series key
+    :return rows: (int) number of rows inserted or updated
+    """
+    key = columns[-1]
+    column_list = ', '.join(columns)
+    cur.execute(f"""CREATE TEMP TABLE {table}_staging (
+        {', '.join(f'{column} {COLUMN_TYPES[column]}' for column in columns)}
+    ) ON COMMIT DROP""")
+    cur.copy_expert(f"COPY {table}_staging ({column_list}) FROM STDIN", copy_buffer)
+    # every year in the batch gets its partition before the insert (see 005_partition_by_year.sql)
+    cur.execute(f"""SELECT create_year_partitions(%s, min(year), max(year)) FROM {table}_staging
+    HAVING count(*) > 0""", (table,))
+    # upsert on (key, timestamp) so reruns overwrite instead of duplicating hours
+    values = ', '.join(f'{column} = EXCLUDED.{column}' for column in columns[4:-1])
+    cur.execute(f"""INSERT INTO {table} ({column_list})
+    SELECT DISTINCT ON ({key}, year, month, day, utc_hour) {column_list} FROM {table}_staging
+    ON CONFLICT ({key}, timestamp, year) DO UPDATE SET {values}""")
+    return cur.rowcount
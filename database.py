@@ -0,0 +1,348 @@
+# Database connection pool for the Air Quality Dashboard.
+# Every "Apply Filters" click used to open (and close) its own connection to RDS, which
+# costs a TCP + TLS + auth handshake per request and can exhaust the connection slots
+# on the free tier instance. This module keeps a small, bounded pool of connections per
+# process that is safe to use under gunicorn (connections are never shared across a fork).
+import io
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from metrics import stage
+
+# Connection settings. Elastic Beanstalk exposes the attached database through the RDS_*
+# environment variables; the defaults point at the dashboard's RDS instance. The password has no
+# default: RDS_PASSWORD must be set before the first connection is opened.
+db_settings = {
+    'host': os.environ.get('RDS_HOSTNAME', 'airquality.ce6w097amgsa.us-west-1.rds.amazonaws.com'),
+    'port': int(os.environ.get('RDS_PORT', 5432)),
+    'user': os.environ.get('RDS_USERNAME', 'postgres'),
+    'password': os.environ.get('RDS_PASSWORD'),
+    'database': os.environ.get('RDS_DB_NAME', 'postgres'),
+    'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 10)),
+}
+
+# Pool settings (per process, i.e. per gunicorn worker)
+pool_settings = {
+    'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', 4)),
+    'wait_timeout': float(os.environ.get('DB_POOL_WAIT_TIMEOUT', 30)),  # seconds to wait for a free connection
+    'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', 300)),  # close connections idle for longer than this
+    'health_check_after': float(os.environ.get('DB_POOL_HEALTH_CHECK_AFTER', 30)),  # ping if idle for this long
+}
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the pool's wait timeout."""
+
+
+class ConnectionPool:
+    """
+    Bounded pool of psycopg2 connections.
+
+    Connections are created lazily, pinged before reuse when they have been idle for a while,
+    closed once they have been idle for longer than max_idle and replaced when they turn out
+    to be broken. The pool remembers the pid it was created in; after a fork (gunicorn
+    workers) the child drops the inherited connections without closing them, so the parent's
+    sockets are left untouched.
+    """
+
+    def __init__(self, connect_kwargs, max_size=4, wait_timeout=30.0, max_idle=300.0, health_check_after=30.0):
+        """
+        :param connect_kwargs: (dict) keyword arguments passed to psycopg2.connect
+        :param max_size: (int) maximum number of open connections
+        :param wait_timeout: (float) seconds to wait for a free connection before raising PoolTimeout
+        :param max_idle: (float) seconds after which an idle connection is closed
+        :param health_check_after: (float) idle seconds after which a connection is pinged before reuse
+        """
+        self.connect_kwargs = connect_kwargs
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        # (connection, time it was returned to the pool), most recently used last
+        self._idle = []
+        self._in_use = 0
+        self._checked_out_at = {}  # id(connection) -> perf_counter at checkout
+        self._pid = os.getpid()
+        self._metrics = {
+            'checkouts': 0,
+            'connections_created': 0,
+            'connections_discarded': 0,
+            'health_checks_failed': 0,
+            'wait_timeouts': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+            'checkout_seconds_total': 0.0,
+            'checkout_seconds_max': 0.0,
+        }
+
+    def _check_fork(self):
+        # Connections inherited from the parent process must not be used (or closed) by the child
+        if self._pid != os.getpid():
+            _orphaned.extend(conn for conn, _ in self._idle)
+            self._reset()
+
+    def _connect(self):
+        if 'password' in self.connect_kwargs and self.connect_kwargs['password'] is None:
+            raise RuntimeError('RDS_PASSWORD is not set: export the database password before connecting')
+        conn = psycopg2.connect(**self.connect_kwargs)
+        self._metrics['connections_created'] += 1
+        return conn
+
+    def _discard(self, conn):
+        self._metrics['connections_discarded'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _evict_idle(self, now):
+        # idle list is ordered by return time, so stale connections are at the front
+        while self._idle and now - self._idle[0][1] > self.max_idle:
+            conn, _ = self._idle.pop(0)
+            self._discard(conn)
+
+    @staticmethod
+    def _is_healthy(conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """
+        :return conn: (connection) open connection checked out of the pool
+        """
+        wait_start = time.perf_counter()
+        with self._cond:
+            self._check_fork()
+            deadline = time.monotonic() + self.wait_timeout
+            while not self._idle and self._in_use >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._metrics['wait_timeouts'] += 1
+                    raise PoolTimeout(f'no database connection available after {self.wait_timeout}s')
+                self._cond.wait(remaining)
+            now = time.monotonic()
+            self._evict_idle(now)
+            idle = self._idle.pop() if self._idle else None
+            self._in_use += 1
+            waited = time.perf_counter() - wait_start
+            self._metrics['checkouts'] += 1
+            self._metrics['wait_seconds_total'] += waited
+            self._metrics['wait_seconds_max'] = max(self._metrics['wait_seconds_max'], waited)
+
+        # connecting and pinging happen outside the lock so other threads are not blocked
+        try:
+            if idle is not None:
+                conn, returned_at = idle
+                if conn.closed or (now - returned_at > self.health_check_after and not self._is_healthy(conn)):
+                    with self._cond:
+                        self._metrics['health_checks_failed'] += 1
+                        self._discard(conn)
+                    conn = self._connect()
+            else:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._checked_out_at[id(conn)] = time.perf_counter()
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """
+        :param conn: (connection) connection previously returned by getconn
+        :param discard: (bool) close the connection instead of returning it to the pool
+        """
+        with self._cond:
+            if self._pid != os.getpid() or id(conn) not in self._checked_out_at:
+                # checked out before a fork; the child has already reset the pool
+                return
+            held = time.perf_counter() - self._checked_out_at.pop(id(conn))
+            self._in_use -= 1
+            self._metrics['checkout_seconds_total'] += held
+            self._metrics['checkout_seconds_max'] = max(self._metrics['checkout_seconds_max'], held)
+            if not discard and not conn.closed:
+                try:
+                    conn.rollback()  # never hand out a connection in the middle of a transaction
+                except psycopg2.Error:
+                    discard = True
+            if discard or conn.closed:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of a with block. Connections that raised a
+        connection-level error are discarded rather than returned to the pool.
+        """
+        with stage('db_checkout'):
+            conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def stats(self):
+        """
+        :return stats: (dict) pool counters plus the current number of idle and checked out connections
+        """
+        with self._cond:
+            self._check_fork()
+            stats = dict(self._metrics)
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._in_use
+            stats['max_size'] = self.max_size
+            stats['wait_seconds_avg'] = stats['wait_seconds_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+            stats['checkout_seconds_avg'] = (stats['checkout_seconds_total'] / stats['checkouts']
+                                             if stats['checkouts'] else 0.0)
+        return stats
+
+    def closeall(self):
+        """Close every idle connection (checked out connections are closed when they are returned)."""
+        with self._cond:
+            self._check_fork()
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+
+
+# Connections inherited across a fork are parked here so they are never garbage collected
+# (closing them in the child would terminate the parent's session)
+_orphaned = []
+
+pool = ConnectionPool(db_settings, **pool_settings)
+
+
+def _run(work):
+    # a connection that dropped while idle (e.g. RDS restart) is retried once on a fresh connection
+    for attempt in range(2):
+        with pool.connection() as conn:
+            try:
+                return work(conn)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # only a dead connection is worth retrying; query errors are raised as is
+                if attempt == 1 or not conn.closed:
+                    raise
+
+
+def query_database(query, params=None):
+    """
+    :param query: (str) query to send to airquality database
+    :param params: (tuple or dict) optional query parameters
+    :return rows: (list of lists) all rows returned from sql query
+    """
+    def work(conn):
+        with conn.cursor() as cur:
+            with stage('sql_execute'):
+                cur.execute(query, params)
+            with stage('fetch'):  # psycopg2 decodes the rows as they are fetched
+                return cur.fetchall()
+    return _run(work)
+
+
+class ColumnSink:
+    """
+    File-like target of COPY ... TO STDOUT (CSV) for results made only of numbers. Rows are
+    collected as raw bytes and decoded into typed NumPy columns every chunk_bytes, so no Python
+    object is created per row or value and the undecoded text never exceeds one chunk.
+    """
+
+    def __init__(self, dtypes, chunk_bytes=1 << 20):
+        """
+        :param dtypes: (list) NumPy dtype of each column
+        :param chunk_bytes: (int) bytes of CSV decoded at a time
+        """
+        self.dtypes = dtypes
+        self.chunk_bytes = chunk_bytes
+        self._pending = []
+        self._pending_bytes = 0
+        self._chunks = [[] for _ in dtypes]
+
+    def write(self, data):
+        # psycopg2 writes one row per call, so the pending text always ends on a line boundary
+        if isinstance(data, str):
+            data = data.encode()
+        self._pending.append(data)
+        self._pending_bytes += len(data)
+        if self._pending_bytes >= self.chunk_bytes:
+            self._decode()
+        return len(data)
+
+    def _decode(self):
+        if not self._pending:
+            return
+        block = b''.join(self._pending).rstrip(b'\n')
+        self._pending, self._pending_bytes = [], 0
+        if not block:
+            return
+        # separators per row, from the running count of commas at each line end
+        raw = np.frombuffer(block, dtype=np.uint8)
+        commas = np.cumsum(raw == ord(','))
+        per_row = np.diff(commas[np.flatnonzero(raw == ord('\n'))], prepend=0, append=commas[-1])
+        if (per_row != len(self.dtypes) - 1).any():
+            raise ValueError(f'COPY returned a row without {len(self.dtypes)} fields')
+        # decoded in C straight from the buffer by pandas' CSV parser, which raises on any field that
+        # is not a number (only NaN is accepted, so a NULL, i.e. an empty field, is an error too)
+        values = pd.read_csv(io.BytesIO(block), header=None, dtype=np.float64, keep_default_na=False,
+                             na_values=['NaN'], engine='c').to_numpy()
+        if values.shape != (len(per_row), len(self.dtypes)):
+            raise ValueError(f'COPY returned {values.shape[0]} rows, {len(per_row)} were written')
+        for chunks, column, dtype in zip(self._chunks, values.T, self.dtypes):
+            chunks.append(column.astype(dtype))
+
+    def columns(self):
+        """
+        :return columns: (list) one typed array per column
+        """
+        self._decode()
+        return [np.concatenate(chunks) if chunks else np.empty(0, dtype) for chunks, dtype in
+                zip(self._chunks, self.dtypes)]
+
+
+def copy_columns(query, params, dtypes):
+    """
+    :param query: (str) SELECT returning numeric columns only (no NULLs, e.g. COALESCE(value, 'NaN'))
+    :param params: (tuple or dict) query parameters
+    :param dtypes: (list) NumPy dtype of each column
+    :return columns: (list) one typed array per column of the result
+    """
+    def work(conn):
+        sink = ColumnSink(dtypes)
+        with conn.cursor() as cur:
+            copy = 'COPY ({}) TO STDOUT WITH (FORMAT csv)'.format(cur.mogrify(query, params).decode())
+            with stage('copy_decode'):
+                cur.copy_expert(copy, sink)
+                return sink.columns()
+    return _run(work)
+
+
+def pool_stats():
+    """
+    :return stats: (dict) metrics of this process' connection pool
+    """
+    return pool.stats()
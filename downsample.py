@@ -0,0 +1,48 @@
+# Downsampling of the hourly time series for the line chart.
+# A year of hourly data is 8,760 points per state, far more than the plot has pixels. Min/max
+# bucketing keeps, for each of `buckets` equal slices of a series, the points with the lowest and
+# highest value (in time order), so peaks and dips survive and the line looks the same at the
+# plot's resolution with at most 2 * buckets points.
+import numpy as np
+
+
+def minmax_indices(values, buckets):
+    """
+    :param values: (array) series values in time order (NaN for missing hours)
+    :param buckets: (int) number of buckets (about the plot width in pixels)
+    :return indices: (array) sorted positions of the points to keep
+    """
+    n = len(values)
+    if n <= 2 * buckets:
+        return np.arange(n)
+    size = -(-n // buckets)  # ceil(n / buckets) points per bucket
+    padded = np.full(size * buckets, np.nan)
+    padded[:n] = values
+    padded = padded.reshape(buckets, size)
+    # missing values never win; an all-missing bucket keeps its first point (a gap in the line)
+    nan = np.isnan(padded)
+    low = np.where(nan, np.inf, padded).argmin(axis=1)
+    high = np.where(nan, -np.inf, padded).argmax(axis=1)
+    offsets = np.arange(buckets) * size
+    indices = np.unique(np.concatenate([offsets + low, offsets + high]))
+    return indices[indices < n]
+
+
+def downsample(data, y, buckets, by=None):
+    """
+    :param data: (dataframe) series sorted by time
+    :param y: (str) value column
+    :param buckets: (int) number of buckets per series
+    :param by: (str) column identifying separate series (e.g. state), or None for a single series
+    :return data: (dataframe) downsampled rows of each series, in the original order
+    """
+    values = data[y].to_numpy(dtype=float)
+    if by is None:
+        return data.iloc[minmax_indices(values, buckets)]
+    positions = []
+    for group in data.groupby(by, sort=False).indices.values():
+        group = np.sort(group)
+        positions.append(group[minmax_indices(values[group], buckets)])
+    if not positions:
+        return data
+    return data.iloc[np.sort(np.concatenate(positions))]
@@ -0,0 +1,169 @@
+# State geometries for the map.
+# The census GeoJSON is loaded once per process, reduced to the dashboard's states (features keyed
+# by the state identifiers used in the airquality table, e.g. 'New_Hampshire') and simplified into
+# one variant per zoom range. Each variant is encoded and gzipped once and served from /geojson
+# under a content hashed URL, so browsers download it once and cache it; map figures only carry
+# the URL and the 50 values.
+# Simplifying takes seconds, so the variants are built once per host and kept in GEOJSON_CACHE_DIR
+# (keyed on the source file, the states and the levels); only their gzipped bodies are kept in
+# memory, which under gunicorn --preload are shared by every worker.
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+GEOJSON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'gz_2010_us_040_00_5m.json')
+GEOJSON_CACHE_DIR = os.environ.get('GEOJSON_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'airquality-geojson'))
+URL_PREFIX = '/geojson/'
+
+# (minimum map zoom, simplification tolerance in degrees, decimals kept)
+LEVELS = ((0, 0.02, 3), (5, 0.005, 4), (7, 0.0, 6))
+
+
+def simplify_ring(ring, tolerance):
+    """
+    Douglas-Peucker simplification of a closed ring.
+    :param ring: (array) n x 2 coordinates, first point equal to the last
+    :param tolerance: (float) maximum distance (degrees) of a dropped point from the simplified ring
+    :return ring: (array) simplified ring (None if it collapses to less than a triangle)
+    """
+    if tolerance <= 0 or len(ring) <= 4:
+        return ring
+    keep = np.zeros(len(ring), dtype=bool)
+    keep[0] = keep[-1] = True
+    # a closed ring has no usable first segment, so split it at the point farthest from its start
+    far = int(np.argmax(((ring - ring[0]) ** 2).sum(axis=1)))
+    keep[far] = True
+    stack = [(0, far), (far, len(ring) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = ring[first], ring[last]
+        points = ring[first + 1:last]
+        dx, dy = end - start
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(*(points - start).T)
+        else:
+            distances = np.abs(dx * (points[:, 1] - start[1]) - dy * (points[:, 0] - start[0])) / length
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            keep[first + 1 + index] = True
+            stack.append((first, first + 1 + index))
+            stack.append((first + 1 + index, last))
+    ring = ring[keep]
+    return ring if len(ring) >= 4 else None
+
+
+def simplify_polygon(rings, tolerance, decimals):
+    """
+    :param rings: (list) GeoJSON polygon coordinates (exterior ring, then holes)
+    :param tolerance: (float) simplification tolerance in degrees
+    :param decimals: (int) decimals kept in the coordinates
+    :return rings: (list) simplified polygon coordinates (empty if the exterior collapses)
+    """
+    simplified = []
+    for ring in rings:
+        ring = simplify_ring(np.asarray(ring, dtype=float), tolerance)
+        if ring is None:
+            if not simplified:
+                return []  # exterior collapsed: drop the polygon (small islands)
+            continue  # drop collapsed holes
+        simplified.append(np.round(ring, decimals).tolist())
+    return simplified
+
+
+def simplify_geometry(geometry, tolerance, decimals):
+    """
+    :param geometry: (dict) GeoJSON Polygon or MultiPolygon
+    :param tolerance: (float) simplification tolerance in degrees
+    :param decimals: (int) decimals kept in the coordinates
+    :return geometry: (dict) simplified MultiPolygon (the largest polygon is kept if every polygon collapses)
+    """
+    polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+    simplified = [rings for rings in (simplify_polygon(polygon, tolerance, decimals) for polygon in polygons)
+                  if rings]
+    if not simplified:
+        largest = max(polygons, key=lambda polygon: len(polygon[0]))
+        simplified = [simplify_polygon(largest, 0, decimals)]
+    return {'type': 'MultiPolygon', 'coordinates': simplified}
+
+
+def load_features(ids, path=GEOJSON_PATH):
+    """
+    :param ids: (iterable) state identifiers to keep (matched against the NAME property)
+    :param path: (str) census GeoJSON file
+    :return features: (dict) geometry of each state by identifier
+    """
+    with open(path) as fp:
+        collection = json.load(fp)
+    ids = set(ids)
+    return {feature['properties']['NAME']: feature['geometry'] for feature in collection['features']
+            if feature['properties']['NAME'] in ids}
+
+
+def build_variants(ids, path=GEOJSON_PATH, levels=LEVELS):
+    """
+    :param ids: (iterable) state identifiers to keep
+    :param path: (str) census GeoJSON file
+    :param levels: (tuple) (minimum zoom, tolerance, decimals) of each variant
+    :return variants: (list) one dict per level, by increasing zoom, with min_zoom, url, gzip (the
+        encoded GeoJSON, compressed), size (bytes uncompressed) and etag
+    """
+    geometries = load_features(ids, path)
+    variants = []
+    for min_zoom, tolerance, decimals in levels:
+        collection = {'type': 'FeatureCollection',
+                      'features': [{'type': 'Feature', 'id': state, 'properties': {},
+                                    'geometry': simplify_geometry(geometry, tolerance, decimals)}
+                                   for state, geometry in sorted(geometries.items())]}
+        body = json.dumps(collection, separators=(',', ':')).encode()
+        digest = hashlib.sha1(body).hexdigest()[:12]
+        variants.append({'min_zoom': min_zoom, 'url': f'{URL_PREFIX}states-{digest}.json',
+                         'gzip': gzip.compress(body), 'size': len(body), 'etag': f'"{digest}"'})
+    return variants
+
+
+def load_variants(ids, path=GEOJSON_PATH, levels=LEVELS, cache_dir=GEOJSON_CACHE_DIR):
+    """
+    :param ids: (iterable) state identifiers to keep
+    :param path: (str) census GeoJSON file
+    :param levels: (tuple) (minimum zoom, tolerance, decimals) of each variant
+    :param cache_dir: (str) directory of the built variants
+    :return variants: (list) build_variants result, built on the first call for these arguments
+    """
+    stat = os.stat(path)
+    key = hashlib.sha1(repr((os.path.abspath(path), stat.st_size, stat.st_mtime_ns, sorted(ids), levels))
+                       .encode()).hexdigest()
+    cache_path = os.path.join(cache_dir, f'variants-{key}.pkl')
+    try:
+        with open(cache_path, 'rb') as fp:
+            return pickle.load(fp)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    variants = build_variants(ids, path, levels)
+    # written to a temporary file and renamed, so workers starting together never read a partial file
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fp:
+        pickle.dump(variants, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    return variants
+
+
+def variant_for_zoom(variants, zoom):
+    """
+    :param variants: (list) variants from build_variants
+    :param zoom: (float) map zoom
+    :return variant: (dict) most detailed variant whose minimum zoom is at most zoom
+    """
+    chosen = variants[0]
+    for variant in variants:
+        if zoom >= variant['min_zoom']:
+            chosen = variant
+    return chosen
@@ -0,0 +1,46 @@
+# gunicorn settings, read from the working directory (`gunicorn application:application`).
+# The app is preloaded by default: the master imports application.py and warms up what the
+# figures import on first use (application.warm_up), then forks the workers, which share those
+# pages copy-on-write instead of each importing (and simplifying the state geometries) again.
+# Nothing opens a connection or file handle at import (the connection pool, Redis client and
+# long callback cache all connect on first use in the worker), so preloading is safe.
+# GUNICORN_PRELOAD=0 imports the app in every worker instead (e.g. to reload code with HUP).
+import gc
+import os
+import time
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+_started = time.perf_counter()
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    import application
+    import metrics
+
+    application.warm_up()
+    # objects alive now are never freed; moving them out of the collector's generations keeps a
+    # collection in a worker from writing to (and so copying) the pages they are on
+    gc.collect()
+    gc.freeze()
+    server.log.info('Master ready in %.2f s (application imported in %.2f s), %.0f MB resident',
+                    time.perf_counter() - _started, application.startup_stats['import_seconds'],
+                    metrics.process_memory()['resident_bytes'] / 2 ** 20)
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    import application
+    import metrics
+
+    application.startup_stats['preloaded'] = int(preload_app)
+    application.startup_stats['worker_boot_seconds'] = round(time.perf_counter() - worker.forked_at, 3)
+    memory = metrics.process_memory()
+    worker.log.info('Worker %s booted in %.2f s, %.0f MB resident (%.0f MB private)', worker.pid,
+                    application.startup_stats['worker_boot_seconds'], memory['resident_bytes'] / 2 ** 20,
+                    memory.get('private_bytes', memory['resident_bytes']) / 2 ** 20)
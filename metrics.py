@@ -0,0 +1,273 @@
+# Request timing and Prometheus metrics for the dashboard.
+# The stages of a request worth watching (connection checkout, SQL, fetch, DataFrame build,
+# figure building, ...) are wrapped in `with stage('name'):` (or the @timed decorator). Every
+# stage feeds a per process histogram, and the stages of the request being served are collected
+# so that slow requests can be logged with their normalized filters (see annotate). The metrics
+# are served in the Prometheus text format on /metrics; like /pool-stats they describe the
+# gunicorn worker that answers, so scrape every worker (or aggregate with sum() by instance).
+# Requests slower than PROFILE_SECONDS can also leave a cProfile or pyinstrument profile behind.
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+metrics_settings = {
+    'slow_request_seconds': float(os.environ.get('SLOW_REQUEST_SECONDS', 2.0)),  # log requests slower than this
+    'profiler': os.environ.get('PROFILE_REQUESTS', ''),  # '' (off), cprofile or pyinstrument
+    'profile_seconds': float(os.environ.get('PROFILE_SECONDS', 5.0)),  # keep profiles of requests slower than this
+    'profile_dir': os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'airquality-profiles')),
+}
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+logger = logging.getLogger('airquality.requests')
+
+
+class Histogram:
+    """Cumulative Prometheus histogram with one series per label value."""
+
+    def __init__(self, name, help_text, label, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = {}  # label value -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value):
+        with self._lock:
+            series = self._series.setdefault(label_value, [0] * len(self.buckets) + [0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        """
+        :return lines: (list) the histogram in the Prometheus text format
+        """
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {key: list(val) for key, val in self._series.items()}
+        for label_value, values in sorted(series.items()):
+            label = f'{self.label}="{_escape(label_value)}"'
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound:g}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {values[-2]}')
+            lines.append(f'{self.name}_count{{{label}}} {values[-2]}')
+            lines.append(f'{self.name}_sum{{{label}}} {values[-1]:.6f}')
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+stage_seconds = Histogram('airquality_stage_seconds', 'Time spent in each stage of a request.', 'stage',
+                          SECONDS_BUCKETS)
+request_seconds = Histogram('airquality_request_seconds', 'Time to answer a request.', 'endpoint', SECONDS_BUCKETS)
+response_bytes = Histogram('airquality_response_bytes', 'Size of the response body.', 'endpoint', BYTES_BUCKETS)
+_slow_requests = {}  # endpoint -> number of requests over slow_request_seconds
+_slow_lock = threading.Lock()
+
+# the request being served by this thread: {'endpoint', 'start', 'stages', 'params', 'callback_seconds'}
+_local = threading.local()
+
+
+def current_request():
+    """
+    :return request: (dict) timing record of the request served by this thread, or None
+    """
+    return getattr(_local, 'request', None)
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a block as one stage of the current request (stages outside a request, e.g. in
+    background threads, only feed the histogram).
+    :param name: (str) stage name, e.g. 'sql_execute'
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stage_seconds.observe(seconds, name)
+        record = current_request()
+        if record is not None:
+            record['stages'][name] = record['stages'].get(name, 0.0) + seconds
+
+
+def timed(name, callback=False):
+    """
+    :param name: (str) stage name
+    :param callback: (bool) the function is a Dash callback (the rest of the request is Dash's
+        dispatch and JSON serialization, reported as the 'serialize' stage)
+    :return decorator: times every call of the decorated function as the stage
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                with stage(name):
+                    return fn(*args, **kwargs)
+            finally:
+                record = current_request()
+                if callback and record is not None:
+                    record['callback_seconds'] += time.perf_counter() - start
+        return wrapper
+    return decorator
+
+
+def annotate(**params):
+    """
+    Attach normalized parameters (e.g. the filters) to the current request for the slow request log.
+    """
+    record = current_request()
+    if record is not None:
+        record['params'].update(params)
+
+
+def _endpoint(request):
+    # a bounded label: the outputs of a Dash callback, or the route rule (never the raw path)
+    if request.path.endswith('_dash-update-component'):
+        body = request.get_json(silent=True) or {}
+        return 'callback:' + re.sub(r'^\.\.|\.\.$', '', str(body.get('output', '?')))
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _start_profiler():
+    if metrics_settings['profiler'] == 'pyinstrument':
+        from pyinstrument import Profiler  # optional dependency, only needed for PROFILE_REQUESTS=pyinstrument
+        profiler = Profiler()
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        profiler.start() if hasattr(profiler, 'start') else profiler.enable()
+    except (RuntimeError, ValueError):
+        # cProfile allows one active profiler per process; concurrent requests go unprofiled
+        return None
+    return profiler
+
+
+def _save_profile(profiler, record, seconds):
+    directory = metrics_settings['profile_dir']
+    os.makedirs(directory, exist_ok=True)
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', record['endpoint'])[:80]
+    stem = os.path.join(directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{seconds:.1f}s-{name}")
+    if metrics_settings['profiler'] == 'pyinstrument':
+        with open(stem + '.html', 'w') as fp:
+            fp.write(profiler.output_html())
+        return stem + '.html'
+    profiler.dump_stats(stem + '.prof')
+    return stem + '.prof'
+
+
+def _stop_profiler(profiler):
+    if hasattr(profiler, 'stop'):
+        profiler.stop()
+    else:
+        profiler.disable()
+
+
+def process_memory():
+    """
+    :return memory: (dict) resident_bytes of this process and, on Linux, proportional_bytes (shared
+        pages split between the processes sharing them) and private_bytes (pages no other process maps)
+    """
+    try:
+        with open('/proc/self/smaps_rollup') as fp:
+            values = {parts[0].rstrip(':'): int(parts[1]) * 1024 for parts in map(str.split, fp)
+                      if len(parts) == 3 and parts[2] == 'kB'}
+    except OSError:
+        # not Linux (or an old kernel): the peak resident size is the best available
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {'resident_bytes': peak if sys.platform == 'darwin' else peak * 1024}
+    return {'resident_bytes': values['Rss'], 'proportional_bytes': values['Pss'],
+            'private_bytes': values['Private_Clean'] + values['Private_Dirty']}
+
+
+def render(collectors=()):
+    """
+    :param collectors: (iterable) (prefix, function returning a dict of numbers) pairs, e.g. pool stats
+    :return text: (str) all metrics of this process in the Prometheus text format
+    """
+    lines = []
+    for histogram in (stage_seconds, request_seconds, response_bytes):
+        lines.extend(histogram.render())
+    lines.extend(['# HELP airquality_slow_requests_total Requests slower than SLOW_REQUEST_SECONDS.',
+                  '# TYPE airquality_slow_requests_total counter'])
+    with _slow_lock:
+        slow = dict(_slow_requests)
+    for endpoint, count in sorted(slow.items()):
+        lines.append(f'airquality_slow_requests_total{{endpoint="{_escape(endpoint)}"}} {count}')
+    for prefix, collect in collectors:
+        for key, value in sorted(collect().items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f'# TYPE {prefix}_{key} gauge')
+                lines.append(f'{prefix}_{key} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(server, collectors=()):
+    """
+    Time every request of a Flask server and serve the metrics on /metrics.
+    :param server: (Flask) the Dash app's server
+    :param collectors: (iterable) extra (prefix, function) gauges, see render
+    """
+    from flask import Response, request
+
+    @server.before_request
+    def start_request():
+        _local.request = {'endpoint': _endpoint(request), 'start': time.perf_counter(), 'stages': {},
+                          'params': {}, 'callback_seconds': 0.0,
+                          'profiler': _start_profiler() if metrics_settings['profiler'] else None}
+
+    @server.after_request
+    def finish_request(response):
+        record = current_request()
+        if record is None:
+            return response
+        _local.request = None
+        seconds = time.perf_counter() - record['start']
+        if record['callback_seconds']:
+            serialize = max(seconds - record['callback_seconds'], 0.0)
+            stage_seconds.observe(serialize, 'serialize')
+            record['stages']['serialize'] = serialize
+        request_seconds.observe(seconds, record['endpoint'])
+        size = None if response.direct_passthrough or response.is_streamed else response.calculate_content_length()
+        if size is not None:
+            response_bytes.observe(size, record['endpoint'])
+
+        profiler = record['profiler']
+        profile = None
+        if profiler is not None:
+            _stop_profiler(profiler)
+            if seconds >= metrics_settings['profile_seconds']:
+                profile = _save_profile(profiler, record, seconds)
+
+        if seconds >= metrics_settings['slow_request_seconds']:
+            with _slow_lock:
+                _slow_requests[record['endpoint']] = _slow_requests.get(record['endpoint'], 0) + 1
+            logger.warning('slow request %s', json.dumps({
+                'endpoint': record['endpoint'], 'seconds': round(seconds, 3), 'bytes': size,
+                'params': record['params'], 'profile': profile,
+                'stages': {name: round(val, 4) for name, val in sorted(record['stages'].items())},
+            }, default=str))
+        return response
+
+    @server.route('/metrics')
+    def metrics_route():
+        return Response(render(collectors), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,147 @@
+# Precomputed landing page.
+# Every page load opens on the same view (all states, the latest year, PM2.5, median), the most
+# expensive query of the dashboard. After each ingest `python snapshot.py` builds that view once:
+# the outputs of apply_filter, update_line and update_hist are saved with the cache key of each
+# callback and the version of the data they were built from (the newest hour in storage). The
+# layout embeds the outputs directly, and the callbacks answer from the snapshot when their result
+# cache misses. A snapshot built from other data (or for other default dates) is ignored, and the
+# callbacks fall back to live queries.
+# The file is replaced atomically, so workers see the old snapshot or the new one, never a mix;
+# a new data version also clears the result cache before the view is rebuilt.
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+snapshot_settings = {
+    'enabled': os.environ.get('SNAPSHOT', '1') == '1',
+    'directory': os.environ.get('SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'airquality-snapshot')),
+}
+
+FORMAT_VERSION = 1  # bumped when the saved outputs change shape
+
+_loaded = {'mtime': None, 'snapshot': None}
+_lock = threading.Lock()
+
+
+def snapshot_path(directory=None):
+    """
+    :return path: (str) file of the default view snapshot
+    """
+    return os.path.join(directory or snapshot_settings['directory'], 'default_view.json')
+
+
+def read_snapshot(directory=None):
+    """
+    :param directory: (str) snapshot directory (defaults to SNAPSHOT_DIR)
+    :return snapshot: (dict) the saved snapshot, or None if there is none (parsed once per file version)
+    """
+    path = snapshot_path(directory)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    with _lock:
+        if _loaded['mtime'] == mtime:
+            return _loaded['snapshot']
+    try:
+        with open(path) as fp:
+            snapshot = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if snapshot.get('format') != FORMAT_VERSION:
+        snapshot = None
+    with _lock:
+        _loaded.update(mtime=mtime, snapshot=snapshot)
+    return snapshot
+
+
+def write_snapshot(snapshot, directory=None):
+    """
+    Replace the snapshot atomically (readers see the old or the new file, never a partial one).
+    :param snapshot: (dict) data_version, built_at and entries (callback name -> [cache key, outputs])
+    :param directory: (str) snapshot directory (defaults to SNAPSHOT_DIR)
+    :return path: (str) file written
+    """
+    from plotly.utils import PlotlyJSONEncoder  # figures hold NumPy arrays, encoded as Dash does
+
+    path = snapshot_path(directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(dict(snapshot, format=FORMAT_VERSION), fp, cls=PlotlyJSONEncoder)
+    os.replace(tmp_path, path)
+    return path
+
+
+def lookup(name, key, data_version):
+    """
+    :param name: (str) callback the outputs belong to (apply_filter, update_line or update_hist)
+    :param key: (str) result cache key of the request
+    :param data_version: (str) version of the data currently in storage (None if unknown)
+    :return outputs: the saved outputs, or None if there is no snapshot for this key and data
+    """
+    if not snapshot_settings['enabled'] or data_version is None:
+        return None
+    snapshot = read_snapshot()
+    if snapshot is None or snapshot['data_version'] != data_version:
+        return None
+    entry = snapshot['entries'].get(name)
+    if entry is None or entry[0] != key:
+        return None
+    return entry[1]
+
+
+def build(force=False):
+    """
+    Build the default view from the current data, unless the snapshot is already of this data.
+    :param force: (bool) rebuild even if the snapshot is current
+    :return snapshot, built: (dict, bool) the current snapshot and whether it was rebuilt
+    """
+    import inspect
+    import application as app
+
+    # the version is read from storage, not from the result cache (which may predate the ingest),
+    # and cached again so the callbacks below key their results on it
+    hours = app.data_hours(refresh=True)
+    if hours is None:
+        raise RuntimeError('no data in storage, or the date bounds could not be read')
+    data_version = hours[1].isoformat()
+    current = read_snapshot()
+    if current is not None and current['data_version'] == data_version and not force:
+        return current, False
+    if current is None or current['data_version'] != data_version:
+        # results cached before the new data landed would otherwise end up in the snapshot
+        app.result_cache.clear()
+
+    # the callbacks themselves (undecorated), so the snapshot holds exactly what they return
+    apply_filter, update_line, update_hist = (inspect.unwrap(fn) for fn in
+                                              (app.apply_filter, app.update_line, app.update_hist))
+    enabled, snapshot_settings['enabled'] = snapshot_settings['enabled'], False  # never answer from the old one
+    try:
+        start_date, end_date, particulate, state, aggregate_fxn = app.normalize_filters(None, None, None, None, None)
+        outputs = apply_filter(1, start_date, end_date, particulate, None, aggregate_fxn)
+        handle = outputs[0]
+        entries = {
+            'apply_filter': [handle['key'], outputs],
+            'update_line': [app.cache_key('update_line', handle['key'], None), update_line(handle, None)],
+            'update_hist': [app.cache_key('update_hist', handle['key']), update_hist(handle, 'hist')],
+        }
+    finally:
+        snapshot_settings['enabled'] = enabled
+    snapshot = {'data_version': data_version, 'built_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'entries': entries}
+    write_snapshot(snapshot)
+    return read_snapshot(), True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the precomputed default view of the dashboard')
+    parser.add_argument('--force', action='store_true', help='rebuild even if the snapshot is of the current data')
+    args = parser.parse_args()
+
+    start = time.time()
+    snapshot, built = build(args.force)
+    print(f"{'Built' if built else 'Up to date:'} {snapshot_path()} for data up to {snapshot['data_version']} "
+          f"in {time.time() - start:.1f} s ({os.path.getsize(snapshot_path()) / 1024:.0f} KB)")
@@ -0,0 +1,258 @@
+# Storage backends for the dashboard's queries.
+# The dashboard asks two things of the data: the hourly rows of some states over a date range
+# (line chart, export) and the per state summary over that range (map aggregates, histograms).
+# STORAGE_BACKEND selects where they are answered:
+#   postgres  the airquality table and its rollups on RDS (default)
+#   arrow     columnar files on the app host, one per state and year
+#             ({ARROW_DIR}/state=Utah/year=2021/data.arrow), scanned in process with NumPy.
+#             data1050/export_arrow.py refreshes them after each ingest.
+# The files are uncompressed Arrow IPC rather than Parquet so they can be memory-mapped without
+# decoding: the arrays point straight into the page cache, which every gunicorn worker shares.
+# Both return the same DataFrames, so the callbacks do not know which one is in use.
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from aggregates import SKETCH_BIN_WIDTH, SKETCH_MAX_BIN, state_summary, summarize
+from database import copy_columns, query_database
+from metrics import stage
+
+storage_settings = {
+    'backend': os.environ.get('STORAGE_BACKEND', 'postgres'),  # postgres or arrow
+    'arrow_dir': os.environ.get('ARROW_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'arrow')),
+    'max_partitions': int(os.environ.get('ARROW_MAX_PARTITIONS', 512)),  # open partitions kept per process
+}
+
+# series a query can ask for (the hourly AQI is computed at ingest, see data1050/aqi.py)
+PARTICULATES = ('pm25', 'pm10', 'aqi')
+
+
+def partition_path(directory, state, year):
+    """
+    :return path: (str) file of the state/year partition
+    """
+    return os.path.join(directory, f'state={state}', f'year={year}', 'data.arrow')
+
+
+def _day(value):
+    # the date picker sends 'YYYY-MM-DD' (or a full ISO timestamp)
+    return np.datetime64(str(value)[:10], 's')
+
+
+class PostgresBackend:
+    """Queries the airquality table (hourly rows) and the rollup tables (summaries)."""
+
+    def load(self, state, start_date, end_date, particulate):
+        """
+        :param state: (tuple) states to load
+        :param start_date: (str) first day of the range
+        :param end_date: (str) last day of the range
+        :param particulate: (str) 'pm25', 'pm10' or 'aqi'
+        :return df: (dataframe) state (categorical), timestamp and particulate value (float32) of every
+            hour in the range
+        """
+        # range scan on the (state, timestamp) index of the partitions of the years in range;
+        # particulate is validated by the caller. Every column is sent as a number (state as its
+        # position in the request, timestamp as hours since 1970), so COPY's CSV decodes straight
+        # into typed arrays (see database.copy_columns)
+        query = f"""SELECT array_position(CAST(%(state_list)s AS text[]), state) - 1,
+            CAST(extract(epoch FROM timestamp) AS bigint) / 3600,
+            COALESCE({particulate}, 'NaN')
+        FROM airquality
+        WHERE state IN %(state)s
+        AND year BETWEEN %(start_year)s AND %(end_year)s
+        AND timestamp BETWEEN CAST(%(start_date)s AS DATE) AND CAST(%(end_date)s AS DATE)"""
+        state = list(state)
+        params = {'state': tuple(state), 'state_list': state, 'start_date': start_date, 'end_date': end_date,
+                  'start_year': int(str(start_date)[:4]), 'end_year': int(str(end_date)[:4])}
+        codes, hours, values = copy_columns(query, params, (np.int16, np.int64, np.float32))
+        with stage('dataframe'):
+            return pd.DataFrame({
+                'state': pd.Categorical.from_codes(codes, categories=state),
+                'timestamp': hours.astype('datetime64[h]'),
+                particulate: values,
+            })
+
+    def summary(self, state, start_date, end_date, particulate):
+        """
+        :return df: (dataframe) per state summary, see aggregates.state_summary
+        """
+        return state_summary(state, start_date, end_date, particulate)
+
+    def date_bounds(self):
+        """
+        :return first, last: (datetime) first and last hour in the data, or None if there is none
+        """
+        # the year partitions (see 005_partition_by_year.sql) tell which years hold data, so only
+        # the oldest and the newest partition are read
+        query = """SELECT CAST(substring(c.relname FROM '_y([0-9]+)$') AS int) AS year
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = CAST('airquality' AS regclass) AND c.relname ~ '_y[0-9]+$'
+        ORDER BY year"""
+        years = [year for year, in query_database(query)]
+        if not years:
+            return None
+        (first,), = query_database('SELECT min(timestamp) FROM airquality WHERE year = %s', (years[0],))
+        (last,), = query_database('SELECT max(timestamp) FROM airquality WHERE year = %s', (years[-1],))
+        if first is None or last is None:
+            return None
+        return first, last
+
+
+class ArrowBackend:
+    """
+    Hourly rows in Arrow IPC files partitioned by state and year, each sorted by timestamp. Files
+    are memory-mapped and their columns viewed as NumPy arrays without copying (LRU bounded); a
+    partition is reopened when its file has been replaced by a refresh.
+    """
+
+    def __init__(self, directory, max_partitions=512):
+        self.directory = directory
+        self.max_partitions = max_partitions
+        self._partitions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _partition(self, state, year):
+        """
+        :return columns: (dict) timestamp (datetime64[s]), pm25, pm10 and aqi arrays, or None if there is no file
+        """
+        import pyarrow as pa  # optional dependency, only needed for this backend
+
+        path = partition_path(self.directory, state, year)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        key = (state, year)
+        with self._lock:
+            entry = self._partitions.get(key)
+            if entry is not None and entry[0] == mtime:
+                self._partitions.move_to_end(key)
+                return entry[1]
+        # the arrays keep the mapping open; a replaced file stays readable until they are dropped
+        batch = pa.ipc.open_file(pa.memory_map(path)).get_batch(0)  # one batch per file, see write_partition
+        columns = {name: batch.column(name).to_numpy(zero_copy_only=True)
+                   for name in ('timestamp',) + PARTICULATES if name in batch.schema.names}
+        # files written before the AQI column existed read as hours without an AQI
+        columns.setdefault('aqi', np.full(len(columns['timestamp']), np.nan))
+        with self._lock:
+            self._partitions[key] = (mtime, columns)
+            self._partitions.move_to_end(key)
+            while len(self._partitions) > self.max_partitions:
+                self._partitions.popitem(last=False)
+        return columns
+
+    def _scan(self, state, start_date, end_date, particulate):
+        """
+        :return series: (list) (state, timestamps, values) of each state with rows between start_date
+            00:00 and end_date 00:00 inclusive (as BETWEEN on the DATE casts in PostgreSQL)
+        """
+        lo, hi = _day(start_date), _day(end_date)
+        series = []
+        for name in state:
+            stamps, values = [], []
+            for year in range(int(str(start_date)[:4]), int(str(end_date)[:4]) + 1):
+                columns = self._partition(name, year)
+                if columns is None:
+                    continue
+                first = np.searchsorted(columns['timestamp'], lo, side='left')
+                last = np.searchsorted(columns['timestamp'], hi, side='right')
+                stamps.append(columns['timestamp'][first:last])
+                values.append(columns[particulate][first:last])
+            if stamps:
+                series.append((name, np.concatenate(stamps), np.concatenate(values)))
+        return series
+
+    def load(self, state, start_date, end_date, particulate):
+        """
+        :return df: (dataframe) state (categorical), timestamp and particulate value (float32) of every
+            hour in the range
+        """
+        with stage('arrow_scan'):
+            series = self._scan(state, start_date, end_date, particulate)
+        if not series:
+            return pd.DataFrame(columns=['state', 'timestamp', particulate])
+        state = list(state)
+        with stage('dataframe'):
+            codes = np.repeat([state.index(name) for name, _, _ in series], [len(stamps) for _, stamps, _ in series])
+            return pd.DataFrame({
+                'state': pd.Categorical.from_codes(codes, categories=state),
+                'timestamp': np.concatenate([stamps for _, stamps, _ in series]),
+                particulate: np.concatenate([values for _, _, values in series], dtype=np.float32),
+            })
+
+    def date_bounds(self):
+        """
+        :return first, last: (datetime) first and last hour in the data, or None if there is none
+        """
+        # the partition directories tell which years hold data
+        partitions = [(int(year[len('year='):]), state[len('state='):])
+                      for state in os.listdir(self.directory) if state.startswith('state=')
+                      for year in os.listdir(os.path.join(self.directory, state)) if year.startswith('year=')]
+        if not partitions:
+            return None
+        first_year, last_year = min(partitions)[0], max(partitions)[0]
+        first = min(self._partition(state, year)['timestamp'][0] for year, state in partitions if year == first_year)
+        last = max(self._partition(state, year)['timestamp'][-1] for year, state in partitions if year == last_year)
+        return first.astype(datetime), last.astype(datetime)
+
+    def summary(self, state, start_date, end_date, particulate):
+        """
+        :return df: (dataframe) per state summary, the same as PostgresBackend's (sketch based median)
+        """
+        rows = []
+        with stage('arrow_scan'):
+            series = self._scan(state, start_date, end_date, particulate)
+        for name, _, values in series:
+            values = values[~np.isnan(values)]
+            if len(values) == 0:
+                continue
+            bins = np.clip(np.floor(values / SKETCH_BIN_WIDTH).astype(int), 0, SKETCH_MAX_BIN)
+            bins, counts = np.unique(bins, return_counts=True)
+            rows.append((name, len(values), values.sum(), values.min(), values.max(), bins, counts))
+        with stage('summarize'):
+            return summarize(rows)
+
+
+def write_partition(directory, state, year, df):
+    """
+    Replace one state/year partition atomically (readers see the old or the new file, never a partial one).
+    :param directory: (str) root of the Arrow files
+    :param state: (str) state
+    :param year: (int) year
+    :param df: (dataframe) timestamp, pm25, pm10 and (optionally) aqi of the partition's hours
+    """
+    import pyarrow as pa
+
+    df = df.drop_duplicates('timestamp', keep='last').sort_values('timestamp')
+    # missing values stay NaN (not nulls), so readers can view the columns without copying
+    batch = pa.record_batch({
+        'timestamp': pa.array(df['timestamp'].to_numpy().astype('datetime64[s]')),
+        'pm25': pa.array(df['pm25'].to_numpy(dtype=float)),
+        'pm10': pa.array(df['pm10'].to_numpy(dtype=float)),
+        'aqi': pa.array(df['aqi'].to_numpy(dtype=float) if 'aqi' in df else np.full(len(df), np.nan)),
+    })
+    path = partition_path(directory, state, year)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as sink, pa.ipc.new_file(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    os.replace(tmp_path, path)
+
+
+def make_backend(settings=storage_settings):
+    """
+    :param settings: (dict) storage settings
+    :return backend: configured storage backend
+    """
+    if settings['backend'] == 'arrow':
+        return ArrowBackend(settings['arrow_dir'], settings['max_partitions'])
+    return PostgresBackend()
+
+
+storage = make_backend()
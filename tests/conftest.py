@@ -0,0 +1,7 @@
+# The modules are not a package: the dashboard's live in the repository root and the ingest
+# side's in data1050/, so both directories are put on the path for the tests.
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'data1050')]
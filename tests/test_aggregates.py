@@ -0,0 +1,67 @@
+# plan_ranges and the sketch helpers of aggregates.py, checked against brute force (no database).
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregates import SKETCH_BIN_WIDTH, histogram, plan_ranges, sketch_quantile
+
+
+def hours_of(plan):
+    # every hour the plan reads, from whichever table answers it
+    hours = []
+    for start, end in ([plan['months']] if plan['months'] else []) + plan['days']:
+        assert start < end
+        hours.extend(pd.date_range(start, end - timedelta(hours=1), freq='h'))
+    for start, end in plan['hours']:
+        assert start <= end
+        hours.extend(pd.date_range(start, end, freq='h'))
+    return hours
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_plan_ranges_covers_each_hour_once(seed):
+    rng = np.random.default_rng(seed)
+    start = datetime(2020, 1, 1) + timedelta(days=int(rng.integers(0, 800)))
+    end = start + timedelta(days=int(rng.integers(0, 500)))
+    plan = plan_ranges(start.date().isoformat(), end.date().isoformat())
+
+    hours = hours_of(plan)
+    # BETWEEN start_date AND end_date: every hour from start 00:00 up to and including end 00:00
+    assert len(hours) == len(set(hours))
+    assert sorted(hours) == list(pd.date_range(start, end, freq='h'))
+    if plan['months']:
+        assert all(val.day == 1 and val.hour == 0 for val in plan['months'])
+    assert all(val.hour == 0 for day_range in plan['days'] for val in day_range)
+
+
+def test_plan_ranges_single_day_and_empty_range():
+    assert plan_ranges('2021-03-05', '2021-03-05') == {
+        'months': None, 'days': [], 'hours': [(datetime(2021, 3, 5), datetime(2021, 3, 5))]}
+    assert plan_ranges('2021-03-05', '2021-03-04') == {'months': None, 'days': [], 'hours': []}
+
+
+@pytest.mark.parametrize('q', [0.1, 0.5, 0.9])
+def test_sketch_quantile_within_a_bin(q):
+    values = np.random.default_rng(1).gamma(2.0, 4.0, 5000)
+    bins, counts = np.unique(np.floor(values / SKETCH_BIN_WIDTH).astype(int), return_counts=True)
+    estimate = sketch_quantile(bins, counts, q, values.min(), values.max())
+    assert abs(estimate - np.quantile(values, q)) <= SKETCH_BIN_WIDTH
+
+
+def test_sketch_quantile_clamped_and_empty():
+    # a single value: the estimate is its bin, clamped to the exact min/max
+    assert sketch_quantile([20], [1], 0.5, 10.2, 10.2) == 10.2
+    assert np.isnan(sketch_quantile([], [], 0.5))
+
+
+def test_histogram_regroups_sketch_bins():
+    summary = pd.DataFrame({'state': ['Utah', 'Idaho'],
+                            'sketch_bins': [np.array([0, 1, 2, 5]), np.array([1, 4])],
+                            'sketch_counts': [np.array([1, 2, 3, 4]), np.array([5, 6])]})
+    df = histogram(summary, 'pm25')  # 1 ug/m3 bins: two sketch bins each
+    assert df[df['state'] == 'Utah'][['bin', 'count']].values.tolist() == [[0.0, 3], [1.0, 3], [2.0, 4]]
+    combined = histogram(summary, 'pm25', combine=True)
+    assert combined['count'].sum() == 21
+    assert combined[['bin', 'count']].values.tolist() == [[0.0, 8], [1.0, 3], [2.0, 10]]
@@ -0,0 +1,67 @@
+# EPA AQI of the hourly rows (data1050/aqi.py): breakpoints, and the rolling 24 hour window fed
+# in batches against a brute force average over all of the hours.
+import numpy as np
+import pytest
+
+import aqi
+
+
+@pytest.mark.parametrize('pollutant, average, index', [
+    ('pm25', 0.0, 0), ('pm25', 9.0, 50), ('pm25', 9.09, 50), ('pm25', 9.1, 51), ('pm25', 35.4, 100),
+    ('pm25', 55.5, 151), ('pm25', 1000.0, 500), ('pm10', 54.9, 50), ('pm10', 154, 100), ('pm10', 425, 301),
+])
+def test_sub_index_breakpoints(pollutant, average, index):
+    assert aqi.sub_index([average], pollutant)[0] == index
+
+
+def test_category_and_missing():
+    assert aqi.category([0, 50, 51, 100, 101, 300, 301, np.nan]).tolist() == [0, 0, 1, 1, 2, 4, 5, -1]
+    assert np.isnan(aqi.sub_index([np.nan], 'pm25')[0])
+
+
+def brute_force(hours, pm25, pm10):
+    # AQI of every hour from the averages of all the values in its 24 hour window
+    by_hour = {hour: (a, b) for hour, a, b in zip(hours.tolist(), pm25, pm10)}
+    expected = []
+    for hour in hours.tolist():
+        window = [by_hour[val] for val in range(hour - aqi.WINDOW_HOURS + 1, hour + 1) if val in by_hour]
+        averages = []
+        for column, pollutant in ((0, 'pm25'), (1, 'pm10')):
+            values = [row[column] for row in window if not np.isnan(row[column])]
+            average = np.mean(values) if len(values) >= aqi.MIN_HOURS else np.nan
+            averages.append(aqi.sub_index([average], pollutant)[0])
+        expected.append(np.fmax(*averages))
+    return np.array(expected)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_rolling_window_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    # hourly rows with gaps (missing hours) and missing values
+    hours = np.cumsum(rng.choice([1, 1, 1, 1, 2, 30], 2000)) + 450000
+    pm25 = np.round(rng.gamma(2.0, 6.0, len(hours)), 1)
+    pm10 = np.round(rng.gamma(2.0, 15.0, len(hours)))
+    pm25[rng.random(len(hours)) < 0.1] = np.nan
+    pm10[rng.random(len(hours)) < 0.1] = np.nan
+
+    window = aqi.RollingWindow()
+    values, categories = [], []
+    cuts = np.sort(rng.choice(np.arange(1, len(hours)), 20, replace=False))
+    for batch in np.split(np.arange(len(hours)), cuts):
+        batch_hours = hours[batch].astype('datetime64[h]')
+        result = window.update(batch_hours, pm25[batch], pm10[batch])
+        values.append(result[0])
+        categories.append(result[1])
+        # as save_windows stores it and load_windows reads it back between runs
+        window = aqi.RollingWindow(window.last_hour.astype(object), window.values['pm25'].tolist(),
+                                   window.values['pm10'].tolist())
+    values = np.concatenate(values)
+    expected = brute_force(hours, pm25, pm10)
+    assert np.array_equal(values, expected, equal_nan=True)
+    assert np.array_equal(np.concatenate(categories), aqi.category(expected))
+
+
+def test_empty_update():
+    window = aqi.RollingWindow()
+    values, categories = window.update(np.empty(0, dtype='datetime64[h]'), [], [])
+    assert len(values) == 0 and len(categories) == 0 and window.last_hour is None
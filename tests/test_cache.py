@@ -0,0 +1,30 @@
+# The filesystem cache backend's eviction sweep.
+import os
+
+from cache import FileSystemBackend
+
+
+def entries(backend):
+    return sorted(name for name in os.listdir(backend.directory) if name.endswith('.pkl'))
+
+
+def test_evicts_every_n_writes(tmp_path):
+    backend = FileSystemBackend(str(tmp_path), max_entries=4, evict_every=3)
+    for index in range(5):
+        backend.set(f'k{index}', index, ttl=60)
+    # swept after the third write only
+    assert len(entries(backend)) == 5
+    backend.set('k5', 5, ttl=60)
+    assert len(entries(backend)) == 4
+    assert backend.get('k5') == 5 and backend.get('k0') is None
+
+
+def test_keeps_recently_used(tmp_path):
+    backend = FileSystemBackend(str(tmp_path), max_entries=2, evict_every=1)
+    backend.set('a', 1, ttl=60)
+    backend.set('b', 2, ttl=60)
+    os.utime(os.path.join(backend.directory, 'a.pkl'), (1, 1))
+    os.utime(os.path.join(backend.directory, 'b.pkl'), (2, 2))
+    backend.get('a')  # touched, so b is the least recently used
+    backend.set('c', 3, ttl=60)
+    assert entries(backend) == ['a.pkl', 'c.pkl']
@@ -0,0 +1,52 @@
+# ColumnSink, the COPY ... TO STDOUT target decoding the hourly rows into typed columns, and the
+# pool's refusal to connect without RDS_PASSWORD.
+import numpy as np
+import pytest
+
+from database import ColumnSink, ConnectionPool
+
+DTYPES = (np.int16, np.int64, np.float32)
+
+
+def decode(rows, chunk_bytes=1 << 20):
+    sink = ColumnSink(DTYPES, chunk_bytes)
+    for row in rows:
+        sink.write(row)  # one row per write, as psycopg2 does
+    return sink.columns()
+
+
+@pytest.mark.parametrize('chunk_bytes', [1, 20, 1 << 20])
+def test_decodes_typed_columns(chunk_bytes):
+    rng = np.random.default_rng(0)
+    codes, hours = rng.integers(0, 50, 1000), np.arange(1000) + 450000
+    values = np.round(rng.gamma(2.0, 4.0, 1000), 1).astype(np.float32)
+    values[::7] = np.nan
+    rows = [f'{code},{hour},{value!r}\n'.replace('nan', 'NaN').encode()
+            for code, hour, value in zip(codes.tolist(), hours.tolist(), values.tolist())]
+    decoded = decode(rows, chunk_bytes)
+    assert [column.dtype for column in decoded] == [np.dtype(dtype) for dtype in DTYPES]
+    assert np.array_equal(decoded[0], codes) and np.array_equal(decoded[1], hours)
+    assert np.array_equal(decoded[2], values, equal_nan=True)
+
+
+def test_empty_result():
+    assert [len(column) for column in decode([])] == [0, 0, 0]
+
+
+@pytest.mark.parametrize('rows', [
+    [b'1,100,abc\n', b'2,101,3\n'],  # not a number
+    [b'1,,2.5\n'],  # NULL
+    [b'1,100,2.5x\n'],  # trailing garbage
+    [b'1,100\n', b'2,3\n', b'4,5\n'],  # too few fields
+    [b'1,100\n', b'2,101,3,4\n'],  # right total, wrong rows
+])
+def test_rejects_malformed_rows(rows):
+    with pytest.raises(ValueError):
+        decode(rows)
+
+
+def test_pool_requires_password():
+    pool = ConnectionPool({'host': 'localhost', 'password': None}, max_size=1, wait_timeout=0.1)
+    for _ in range(2):  # the failed connect gives its slot back
+        with pytest.raises(RuntimeError, match='RDS_PASSWORD'):
+            pool.getconn()
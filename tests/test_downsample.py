@@ -0,0 +1,42 @@
+# Min/max bucketing of the line chart series (downsample.py), against brute force.
+import numpy as np
+import pandas as pd
+
+from downsample import downsample, minmax_indices
+
+
+def test_keeps_each_buckets_extremes():
+    values = np.random.default_rng(0).gamma(2.0, 4.0, 8760)
+    values[100:300] = np.nan
+    buckets = 600
+    kept = minmax_indices(values, buckets)
+    assert len(kept) <= 2 * buckets
+    assert np.array_equal(kept, np.unique(kept))
+    size = -(-len(values) // buckets)
+    for start in range(0, len(values), size):
+        bucket = values[start:start + size]
+        inside = kept[(kept >= start) & (kept < start + size)]
+        if np.isnan(bucket).all():
+            assert list(inside) == [start]  # a gap keeps its first point
+        else:
+            assert np.nanmin(bucket) in values[inside] and np.nanmax(bucket) in values[inside]
+    assert np.nanmax(values) in values[kept] and np.nanmin(values) in values[kept]
+
+
+def test_short_series_unchanged():
+    assert np.array_equal(minmax_indices(np.arange(10.0), 5), np.arange(10))
+
+
+def test_downsample_per_series_keeps_order():
+    stamps = pd.date_range('2021-01-01', periods=1000, freq='h')
+    rng = np.random.default_rng(1)
+    data = pd.DataFrame({'timestamp': np.tile(stamps, 2), 'state': np.repeat(['Utah', 'Idaho'], 1000),
+                         'pm25': rng.gamma(2.0, 4.0, 2000)}).sample(frac=1, random_state=0).sort_values('timestamp')
+    result = downsample(data, 'pm25', 50, by='state')
+    # rows keep their original order, and every state keeps its own extremes
+    assert list(result.index) == [index for index in data.index if index in set(result.index)]
+    for state, group in data.groupby('state'):
+        kept = result[result['state'] == state]['pm25']
+        assert len(kept) <= 100
+        assert group['pm25'].max() in kept.values and group['pm25'].min() in kept.values
+    assert downsample(data, 'pm25', 50).shape[0] <= 100
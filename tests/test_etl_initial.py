@@ -0,0 +1,85 @@
+# The backfill's checkpoint: a rerun after a failure between the last state and the rollup refresh
+# must still refresh the rollups.
+import json
+from datetime import date
+
+import pandas as pd
+import pytest
+
+import aqi
+import etl_initial
+
+STATES = ['Utah', 'Ohio']
+
+
+class FakeCursor:
+    def __init__(self, calls, fail):
+        self.calls, self.fail = calls, fail
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        if 'refresh_airquality_rollups' in sql and self.fail:
+            raise RuntimeError('connection lost during the refresh')
+        self.calls.append((sql, params))
+
+
+class FakeConnection:
+    def __init__(self, calls, fail):
+        self.calls, self.fail = calls, fail
+
+    def cursor(self):
+        return FakeCursor(self.calls, self.fail)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def run(monkeypatch, checkpoint_path, new_rows, fail=False):
+    """
+    :return refreshes: (list) days the rollups were refreshed from
+    """
+    calls = []
+    monkeypatch.setattr(etl_initial.psycopg2, 'connect', lambda dsn: FakeConnection(calls, fail))
+    monkeypatch.setattr(aqi, 'load_windows', lambda cur, states: {state: aqi.RollingWindow() for state in states})
+    monkeypatch.setattr(etl_initial, 'add_aqi', lambda df, window: df)
+    monkeypatch.setattr(etl_initial, 'copy_state', lambda conn, df, state, window: len(df))
+    monkeypatch.setattr(etl_initial, 'iter_state_data',
+                        lambda states, latest, workers: ((state, new_rows[state]) for state in states))
+    etl_initial.backfill(STATES, 'db', dsn='', checkpoint_path=str(checkpoint_path))
+    return [params[0] for sql, params in calls if 'refresh_airquality_rollups' in sql]
+
+
+def rows(start, hours):
+    return pd.DataFrame({'timestamp': pd.date_range(start, periods=hours, freq='h')})
+
+
+def test_rerun_refreshes_after_failed_refresh(monkeypatch, tmp_path):
+    path = tmp_path / 'backfill_db.json'
+    loaded = {'Utah': rows('2021-03-02', 48), 'Ohio': rows('2021-01-05', 24)}
+    with pytest.raises(RuntimeError):
+        run(monkeypatch, path, loaded, fail=True)
+    checkpoint = json.loads(path.read_text())
+    assert set(checkpoint) == {'Utah', 'Ohio', etl_initial.REFRESH_FROM}
+
+    # every state is checkpointed, so the rerun writes nothing, but still owes the refresh
+    nothing = {state: rows('2021-01-01', 0) for state in STATES}
+    assert run(monkeypatch, path, nothing) == [date(2021, 1, 5)]
+    assert etl_initial.REFRESH_FROM not in json.loads(path.read_text())
+    assert run(monkeypatch, path, nothing) == []
+
+
+def test_refresh_from_oldest_of_runs(monkeypatch, tmp_path):
+    path = tmp_path / 'backfill_db.json'
+    with pytest.raises(RuntimeError):
+        run(monkeypatch, path, {'Utah': rows('2021-06-01', 24), 'Ohio': rows('2021-06-03', 24)}, fail=True)
+    # the rerun writes newer rows only; the refresh starts at the older day of the failed run
+    assert run(monkeypatch, path, {'Utah': rows('2021-07-01', 24), 'Ohio': rows('2021-01-01', 0)}) == \
+        [date(2021, 6, 1)]
@@ -0,0 +1,45 @@
+# Douglas-Peucker simplification of the state rings (geo.simplify_ring).
+import numpy as np
+import pytest
+
+from geo import simplify_ring
+
+
+def noisy_ring(n, seed=0):
+    angles = np.linspace(0, 2 * np.pi, n, endpoint=False)
+    radius = 1 + 0.05 * np.random.default_rng(seed).standard_normal(n)
+    ring = np.column_stack([radius * np.cos(angles), radius * np.sin(angles)])
+    return np.vstack([ring, ring[:1]])
+
+
+def line_distance(point, start, end):
+    (dx, dy), length = end - start, np.hypot(*(end - start))
+    if length == 0:
+        return np.hypot(*(point - start))
+    return abs(dx * (point[1] - start[1]) - dy * (point[0] - start[0])) / length
+
+
+@pytest.mark.parametrize('tolerance', [0.01, 0.05, 0.2])
+def test_dropped_points_within_tolerance(tolerance):
+    ring = noisy_ring(500)
+    simplified = simplify_ring(ring, tolerance)
+    assert np.array_equal(simplified[0], simplified[-1])  # still closed
+    assert 4 <= len(simplified) < len(ring)
+    # the kept points are original points, in order
+    kept = [int(np.flatnonzero((ring == point).all(axis=1))[0]) for point in simplified[:-1]] + [len(ring) - 1]
+    assert kept == sorted(kept)
+    for first, last in zip(kept, kept[1:]):
+        for point in ring[first + 1:last]:
+            assert line_distance(point, ring[first], ring[last]) <= tolerance + 1e-12
+
+
+def test_no_tolerance_or_tiny_ring_unchanged():
+    ring = noisy_ring(50)
+    assert simplify_ring(ring, 0) is ring
+    triangle = np.array([[0, 0], [1, 0], [0, 1], [0, 0]], dtype=float)
+    assert simplify_ring(triangle, 10) is triangle
+
+
+def test_small_ring_collapses():
+    # an island far smaller than the tolerance
+    assert simplify_ring(noisy_ring(40) * 1e-3, 0.5) is None
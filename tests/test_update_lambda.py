@@ -0,0 +1,33 @@
+# CopyStream, the file-like object COPY ... FROM STDIN reads the Lambda's rows from.
+import updateDatabase_Lambda as lam
+
+
+def read_all(stream, size):
+    parts = []
+    while True:
+        data = stream.read(size)
+        if not data:
+            return parts
+        parts.append(data)
+
+
+def test_copy_stream_reads_across_chunks():
+    chunks = ['abc', '', 'defgh', 'i', 'jklmnopq']
+    for size in (1, 2, 3, 7, 100):
+        parts = read_all(lam.CopyStream(chunks), size)
+        assert ''.join(parts) == ''.join(chunks)
+        assert all(len(part) == size for part in parts[:-1])
+
+
+def test_copy_stream_read_all_and_empty():
+    stream = lam.CopyStream(iter(['ab', 'cd']))
+    assert stream.read(1) == 'a'
+    assert stream.read() == 'bcd'
+    assert stream.read() == ''
+    assert lam.CopyStream([]).read(10) == ''
+
+
+def test_copy_stream_large_chunk():
+    # one chunk much larger than COPY's reads (e.g. etl_initial's COPY_CHUNK_ROWS rows)
+    chunk = ''.join(f'{i}\t{i * 0.5!r}\n' for i in range(200000))
+    assert ''.join(read_all(lam.CopyStream([chunk, 'tail\n']), 8192)) == chunk + 'tail\n'